@@ -0,0 +1,70 @@
+"""Compare the decoder backends on the access patterns of the gui.
+
+playback reads the frames in order, looping twice over the video. stepping goes
+forward and backward one frame at a time, as the Forward / Backward buttons do.
+
+Usage: python -m benchmarks.decode [video ...] [--backends pims pyav indexed]
+       [--width 960 --height 540]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+from typing import List
+from core.decoder import BACKENDS, open_decoder
+from core.frame_format import FULL, FrameFormat
+from benchmarks.synthetic import write_video
+
+
+def playback(n_frames: int) -> List[int]:
+    return list(range(n_frames)) * 2
+
+
+def stepping(n_frames: int) -> List[int]:
+    "Five frames forward then two back, from the middle of the video."
+    frame_ix, indices = n_frames // 2, []
+    for _ in range(40):
+        for step in [1] * 5 + [-1] * 2:
+            frame_ix = min(max(frame_ix + step, 0), n_frames - 1)
+            indices.append(frame_ix)
+    return indices
+
+
+def run(video_path: str, backend: str, indices: List[int], fmt: FrameFormat):
+    """Return (frames per second, number of seeks or None) of reading the frames."""
+    video = open_decoder(video_path, backend)
+    # Not timed, the indexed backend scans the file when opened the first time
+    video.read(indices[0], fmt)
+    t_start = time.perf_counter()
+    for frame_ix in indices:
+        video.read(frame_ix, fmt)
+    duration = time.perf_counter() - t_start
+    n_seeks = getattr(video, 'n_seeks', None)
+    video.close()
+    return len(indices) / duration, n_seeks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('videos', nargs='*', help='Videos to decode, a synthetic 1080p '
+                                                  'video by default')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument('--width', type=int, default=None,
+                        help='Maximum width of the decoded frames, full resolution by default')
+    parser.add_argument('--height', type=int, default=None)
+    args = parser.parse_args()
+
+    fmt = FULL if args.width is None and args.height is None else \
+        FrameFormat(args.width, args.height)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        videos = args.videos or [str(write_video(Path(tmp_dir) / 'video.mp4'))]
+        print(f'{"backend":>8} {"pattern":>9} {"fps":>8} {"ms/frame":>9} {"seeks":>6}   video')
+        for video_path in videos:
+            n_frames = len(open_decoder(video_path, 'pyav'))
+            for pattern in (playback, stepping):
+                indices = pattern(n_frames)
+                for backend in args.backends:
+                    fps, n_seeks = run(video_path, backend, indices, fmt)
+                    seeks = '-' if n_seeks is None else str(n_seeks)
+                    print(f'{backend:>8} {pattern.__name__:>9} {fps:>8.1f} {1000 / fps:>9.2f} '
+                          f'{seeks:>6}   {video_path}')
@@ -0,0 +1,39 @@
+"""Compare the time and peak memory needed to load VideoBase files of increasing size.
+
+Usage: python -m benchmarks.load [--sizes 1000 10000 100000]
+"""
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from core import crud
+from benchmarks.synthetic import write_videobase
+
+
+def measure(func, *args, **kwargs):
+    "Return (duration in s, peak memory in MB) of a call. Timed without tracemalloc."
+    t_start = time.perf_counter()
+    func(*args, **kwargs)
+    duration = time.perf_counter() - t_start
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak / 1024 ** 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(f'json parser: {"orjson" if crud.orjson is not None else "json"}')
+    print(f'{"segments":>10} {"MB":>8} {"mode":>10} {"time (s)":>10} {"peak (MB)":>10}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_segments in args.sizes:
+            path = write_videobase(Path(tmp_dir) / f'vb_{n_segments}.json', n_segments)
+            size_mb = path.stat().st_size / 1024 ** 2
+            for mode, validate in [('validated', True), ('fast', False)]:
+                duration, peak = measure(crud.load_videobase, path, validate=validate)
+                print(f'{n_segments:>10} {size_mb:>8.1f} {mode:>10} {duration:>10.2f} {peak:>10.1f}')
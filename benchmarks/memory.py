@@ -0,0 +1,59 @@
+"""Compare the memory held by a loaded VideoBase and by a CompactVideoBase, and by their
+LabelIndex, as traced by tracemalloc.
+
+Usage: python -m benchmarks.memory [--sizes 1000 10000 100000]
+"""
+import argparse
+import gc
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from core import crud
+from core.compact import CompactVideoBase
+from core.label_index import LabelIndex
+from benchmarks.synthetic import write_videobase
+
+
+def retained(func, *args):
+    """
+    Return (duration in s, bytes retained by the result according to tracemalloc, result)
+    of a call. Timed without tracing, in a first call.
+    """
+    gc.collect()
+    t_start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - t_start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, current, result
+
+
+def label_index(vb):
+    return vb.label_index() if isinstance(vb, CompactVideoBase) else LabelIndex(vb)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(f'{"segments":>10} {"MB":>8} {"format":>10} {"load (s)":>10} {"memory (MB)":>12} '
+          f'{"index (MB)":>11} {"B/segment":>10}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_segments in args.sizes:
+            path = write_videobase(Path(tmp_dir) / f'vb_{n_segments}.json', n_segments)
+            size_mb = path.stat().st_size / 1024 ** 2
+            for name, load in [('models', crud.load_videobase),
+                               ('compact', CompactVideoBase.load)]:
+                duration, n_bytes, vb = retained(load, path)
+                _, index_bytes, index = retained(label_index, vb)
+                del vb, index
+                print(f'{n_segments:>10} {size_mb:>8.1f} {name:>10} {duration:>10.2f} '
+                      f'{n_bytes / 1024 ** 2:>12.1f} {index_bytes / 1024 ** 2:>11.1f} '
+                      f'{(n_bytes + index_bytes) / n_segments:>10.0f}')
@@ -0,0 +1,59 @@
+import json
+from pathlib import Path
+from typing import List, Union
+import numpy as np
+
+LABELS = ['Head_grooming_L', 'Head_grooming_R', 'Body_grooming_L', 'Body_grooming_R',
+          'Head_scratch_L', 'Head_scratch_R', 'Rearing_L', 'Rearing_R', 'Paw_licking']
+USERS = ['alice', 'bob', 'carol']
+
+
+def make_videobase(n_segments: int, n_cameras: int = 5, labels: List[str] = LABELS,
+                   users: List[str] = USERS, seed: int = 0) -> dict:
+    """Random VideoBase, as parsed json, with 0 to 2 annotations per segment."""
+    rng = np.random.default_rng(seed)
+    segments = []
+    for ix in range(n_segments):
+        subject = f'RF{ix % 20:03d}'
+        session = f'session_{ix % 7}'
+        annotations = []
+        for user in rng.choice(users, size=rng.integers(0, 3), replace=False):
+            n_labels = rng.integers(1, 4)
+            annotations.append(dict(user=str(user), date='2022_04_01-10_00_00',
+                                    labels=[str(lb) for lb in
+                                            rng.choice(labels, n_labels, replace=False)]))
+        segments.append(dict(subject=subject, date='01/04/2022', session=session,
+                             uid=f'{subject}_{session}_{ix:07d}', folder='.',
+                             files=[f'{subject}/{session}/{ix:07d}_cam{c}.mp4'
+                                    for c in range(n_cameras)],
+                             frames=dict(begin=0, end=150), annotations=annotations))
+    return dict(segments=segments, notes=None)
+
+
+def write_videobase(path: Union[Path, str], n_segments: int, **kwargs) -> Path:
+    path = Path(path)
+    with path.open('w') as f:
+        json.dump(make_videobase(n_segments, **kwargs), f, indent=2)
+    return path
+
+
+def write_video(path: Union[Path, str], n_frames: int = 300, width: int = 1920,
+                height: int = 1080, gop: int = 30, rate: int = 30) -> Path:
+    """mpeg4 video of a bar moving over a changing background, keyframe every gop frames."""
+    import av
+    path = Path(path)
+    with av.open(str(path), 'w') as container:
+        stream = container.add_stream('mpeg4', rate=rate)
+        stream.width, stream.height, stream.pix_fmt = width, height, 'yuv420p'
+        stream.bit_rate = 4_000_000
+        stream.codec_context.gop_size = gop
+        for ix in range(n_frames):
+            image = np.zeros((height, width, 3), dtype=np.uint8)
+            image[:, :, 0] = (ix * 2) % 256
+            left = (ix * 10) % width
+            image[height // 10:height // 4, left:left + width // 20] = 255
+            for packet in stream.encode(av.VideoFrame.from_ndarray(image, format='rgb24')):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return path
@@ -0,0 +1,341 @@
+import copy
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+import numpy as np
+from core import crud
+from core.label_index import LabelIndex
+from core.models import Segment, VideoBase
+
+
+class StringPool:
+    """Interned strings: each distinct string is stored once and referred to by its code."""
+
+    def __init__(self) -> None:
+        self.strings: List[str] = []
+        self.codes: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, code: int) -> str:
+        return self.strings[code]
+
+    def code(self, string: str) -> int:
+        code = self.codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.strings.append(string)
+            self.codes[string] = code
+        return code
+
+
+class PackedStrings:
+    """
+    Read-only list of strings stored as a single utf-8 buffer and offsets.
+
+    find looks strings up by binary search over a sorted permutation of the list, built
+    on the first lookup: 8 bytes per string instead of a dict of str.
+    """
+
+    def __init__(self, strings: Iterable[str]) -> None:
+        encoded = [s.encode() for s in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=self.offsets[1:])
+        self.data = b''.join(encoded)
+        self._sorted: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, ix: int) -> str:
+        return self._bytes(ix).decode()
+
+    def _bytes(self, ix: int) -> bytes:
+        return self.data[self.offsets[ix]:self.offsets[ix + 1]]
+
+    def find(self, string: str) -> Optional[int]:
+        """Index of the first occurrence of string, None if it is not in the list."""
+        if self._sorted is None:
+            # utf-8 bytes sort like the strings. Fixed width keys, only while sorting
+            keys = np.array([self._bytes(ix) for ix in range(len(self))], dtype=bytes)
+            self._sorted = np.argsort(keys, kind='stable')
+        target = string.encode()
+        lo, hi = 0, len(self._sorted)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._bytes(self._sorted[mid]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._sorted) and self._bytes(self._sorted[lo]) == target:
+            return int(self._sorted[lo])
+        return None
+
+
+class SegmentList:
+    """
+    Sequence of the segments of a CompactVideoBase, as accessed by the gui.
+
+    Indexing returns a regular Segment, built from the arrays the first time and then
+    kept: changes made to it (annotations) are part of the base.
+    """
+
+    def __init__(self, base: 'CompactVideoBase') -> None:
+        self._base = base
+
+    def __len__(self):
+        return len(self._base)
+
+    def __getitem__(self, row: int) -> Segment:
+        return self._base.segment(row)
+
+    def __setitem__(self, row: int, seg: Segment):
+        self._base.edited[int(row)] = seg
+
+    def __iter__(self) -> Iterator[Segment]:
+        for row in range(len(self)):
+            yield self._base.segment(row)
+
+
+class CompactVideoBase:
+    """
+    VideoBase stored in numpy arrays, for large bases.
+
+    Strings repeated across segments (subject, date, session, folder, user, annotation
+    date, label) are stored once and referred to by integer codes. Frames are two arrays,
+    files and annotations are stored in CSR layout: the annotations of segment i are
+    an_ptr[i]:an_ptr[i + 1], the labels of annotation j label_ptr[j]:label_ptr[j + 1].
+    Only a handful of Python objects exist whatever the number of segments.
+
+    Segments accessed through `segments` are materialized as regular Segment objects and
+    kept in `edited`, which overrides the arrays. iter_segments builds the other segments
+    without keeping them.
+
+    Parameters
+    ----------
+    segments: Iterable[Segment]
+        See also from_videobase and load
+    notes: str, optional
+    """
+    POOLS = ('subject', 'date', 'session', 'folder', 'user', 'an_date', 'label')
+
+    def __init__(self, segments: Iterable[Segment] = (), notes: Optional[str] = None) -> None:
+        self.notes = notes
+        self.pools = {name: StringPool() for name in self.POOLS}
+        code = {name: pool.code for name, pool in self.pools.items()}
+        uids, files = [], []
+        cols: Dict[str, list] = {name: [] for name in ('subject', 'date', 'session', 'folder',
+                                                       'begin', 'end', 'n_files', 'n_an',
+                                                       'user', 'an_date', 'n_labels',
+                                                       'label')}
+        for seg in segments:
+            uids.append(seg.uid)
+            for name in ('subject', 'date', 'session', 'folder'):
+                cols[name].append(code[name](getattr(seg, name)))
+            cols['begin'].append(seg.frames.begin)
+            cols['end'].append(seg.frames.end)
+            cols['n_files'].append(len(seg.files))
+            files.extend(seg.files)
+            cols['n_an'].append(len(seg.annotations))
+            for an in seg.annotations:
+                cols['user'].append(code['user'](an.user))
+                cols['an_date'].append(code['an_date'](an.date))
+                cols['n_labels'].append(len(an.labels))
+                cols['label'].extend(code['label'](lb) for lb in an.labels)
+        self.uids = PackedStrings(uids)
+        del uids
+        self.files = PackedStrings(files)
+        del files
+        self.codes = {name: np.array(cols[name], dtype=np.int32)
+                      for name in ('subject', 'date', 'session', 'folder', 'user', 'an_date',
+                                   'label')}
+        self.begin = np.array(cols['begin'], dtype=np.int64)
+        self.end = np.array(cols['end'], dtype=np.int64)
+        self.file_ptr = self._ptr(cols['n_files'])
+        self.an_ptr = self._ptr(cols['n_an'])
+        self.label_ptr = self._ptr(cols['n_labels'])
+        # Materialized segments, by row
+        self.edited: Dict[int, Segment] = {}
+
+    @staticmethod
+    def _ptr(counts: List[int]) -> np.ndarray:
+        ptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        return ptr
+
+    @classmethod
+    def from_videobase(cls, vb: VideoBase) -> 'CompactVideoBase':
+        return cls(vb.segments, vb.notes)
+
+    @classmethod
+    def load(cls, json_path: Union[Path, str]) -> 'CompactVideoBase':
+        """Load a VideoBase file one segment at a time, see stream.VideoBaseStream."""
+        from core.stream import VideoBaseStream
+        stream = VideoBaseStream(json_path)
+        base = cls(stream)
+        base.notes = stream.notes
+        return base
+
+    def __len__(self):
+        return len(self.begin)
+
+    @property
+    def segments(self) -> SegmentList:
+        return SegmentList(self)
+
+    def n_annotations(self, row: int) -> int:
+        if row in self.edited:
+            return len(self.edited[row].annotations)
+        return int(self.an_ptr[row + 1] - self.an_ptr[row])
+
+    def segment_dict(self, row: int) -> dict:
+        """Segment as parsed json, from the arrays (or the materialized segment)."""
+        if row in self.edited:
+            return self.edited[row].dict()
+        pools, codes = self.pools, self.codes
+        annotations = []
+        for an in range(self.an_ptr[row], self.an_ptr[row + 1]):
+            labels = codes['label'][self.label_ptr[an]:self.label_ptr[an + 1]]
+            annotations.append(dict(user=pools['user'][codes['user'][an]],
+                                    date=pools['an_date'][codes['an_date'][an]],
+                                    labels=[pools['label'][lb] for lb in labels]))
+        return dict(subject=pools['subject'][codes['subject'][row]],
+                    date=pools['date'][codes['date'][row]],
+                    session=pools['session'][codes['session'][row]],
+                    uid=self.uids[row],
+                    folder=pools['folder'][codes['folder'][row]],
+                    files=[self.files[ix] for ix in
+                           range(self.file_ptr[row], self.file_ptr[row + 1])],
+                    frames=dict(begin=int(self.begin[row]), end=int(self.end[row])),
+                    annotations=annotations)
+
+    def segment(self, row: int) -> Segment:
+        """Materialize a segment, see SegmentList."""
+        row = int(row)
+        seg = self.edited.get(row)
+        if seg is None:
+            seg = crud.segment_from_dict(self.segment_dict(row))
+            self.edited[row] = seg
+        return seg
+
+    def find_segment(self, uid: str) -> Optional[Segment]:
+        row = self.uids.find(uid)
+        return None if row is None else self.segment(row)
+
+    def iter_segments(self) -> Iterator[Segment]:
+        "All the segments, without keeping the ones not materialized yet."
+        for row in range(len(self)):
+            seg = self.edited.get(row)
+            yield seg if seg is not None else crud.segment_from_dict(self.segment_dict(row))
+
+    def snapshot(self) -> 'CompactVideoBase':
+        """
+        Copy to serialize from another thread, see crud.videobase_snapshot.
+
+        The arrays are shared, relabel replaces them instead of modifying them, and the
+        pools only grow. The materialized segments are copied with their annotations.
+        """
+        base = copy.copy(self)
+        base.codes = dict(self.codes)
+        base.edited = {row: crud.copy_segment(seg) for row, seg in self.edited.items()}
+        return base
+
+    def to_videobase(self) -> VideoBase:
+        return crud._unvalidated(VideoBase, dict(segments=list(self.iter_segments()),
+                                                 notes=self.notes))
+
+    def dict(self) -> dict:
+        return dict(segments=[seg.dict() for seg in self.iter_segments()], notes=self.notes)
+
+    def json(self, indent: Optional[int] = None) -> str:
+        if crud.orjson is not None:
+            return crud.videobase_to_json(self, indent=indent is not None)
+        return json.dumps(self.dict(), indent=indent)
+
+    # Vectorized queries on the arrays, the materialized segments override them
+    def _label_rows(self):
+        "Segment row and annotation of each label."
+        label_an = np.repeat(np.arange(len(self.label_ptr) - 1), np.diff(self.label_ptr))
+        an_row = np.repeat(np.arange(len(self)), np.diff(self.an_ptr))
+        return an_row[label_an], label_an
+
+    def segments_have_annotations(self) -> List[bool]:
+        has_an = np.diff(self.an_ptr) > 0
+        for row, seg in self.edited.items():
+            has_an[row] = seg.has_annotations()
+        return has_an.tolist()
+
+    def label_in_segments(self, label: str) -> List[bool]:
+        has_label = np.zeros(len(self), dtype=bool)
+        code = self.pools['label'].codes.get(label)
+        if code is not None:
+            rows, _ = self._label_rows()
+            has_label[rows[self.codes['label'] == code]] = True
+        for row, seg in self.edited.items():
+            has_label[row] = seg.label_in_segment(label)
+        return has_label.tolist()
+
+    def label_index(self) -> LabelIndex:
+        """LabelIndex of the base, built from the arrays."""
+        index = LabelIndex()
+        index.labels = list(self.pools['label'].strings)
+        index.columns = dict(self.pools['label'].codes)
+        index.users = list(self.pools['user'].strings)
+        index.user_ids = dict(self.pools['user'].codes)
+        index.n_annotations = np.diff(self.an_ptr).astype(np.int32)
+        rows, label_an = self._label_rows()
+        # A label repeated in an annotation counts once
+        keys = np.unique(np.stack([label_an, self.codes['label']]), axis=1)
+        index.counts = np.zeros((len(self), len(index.labels), len(index.users)),
+                                dtype=np.uint16)
+        np.add.at(index.counts, (rows[np.searchsorted(label_an, keys[0])], keys[1],
+                                 self.codes['user'][keys[0]]), 1)
+        if self.edited:
+            labels = {lb for seg in self.edited.values() for an in seg.annotations
+                      for lb in an.labels}
+            labels.update(index.labels)
+            index.rebuild_labels(self, sorted(labels), rows=list(self.edited))
+            for row, seg in self.edited.items():
+                index.n_annotations[row] = len(seg.annotations)
+        return index
+
+    def relabel(self, mapping: Dict[str, Optional[str]], counts: Dict[str, int]) -> List[int]:
+        """
+        Apply a label mapping to the arrays and the materialized segments, see crud.relabel.
+
+        Returns
+        -------
+        rows: List[int]
+            Rows of the segments changed
+        """
+        changed = {row for row, seg in self.edited.items()
+                   if crud.relabel_segment(seg, mapping, counts)}
+        pool = self.pools['label']
+        old_codes = np.array([pool.codes.get(old, -1) for old in mapping], dtype=np.int32)
+        is_mapped = np.isin(self.codes['label'], old_codes)
+        rows, label_an = self._label_rows()
+        not_edited = ~np.isin(rows, list(self.edited))
+        is_mapped &= not_edited
+        if not is_mapped.any():
+            return sorted(changed)
+        for old, code in zip(mapping, old_codes):
+            counts[old] = counts.get(old, 0) + int((self.codes['label'][is_mapped] == code).sum())
+        # New codes, -1 for deleted labels
+        new_code = np.arange(len(pool), dtype=np.int32)
+        for old, new in mapping.items():
+            if old in pool.codes:
+                new_code[pool.codes[old]] = -1 if new is None else pool.code(new)
+        labels = new_code[self.codes['label']]
+        # Drop deleted labels and labels merged into one already in the annotation
+        keep = labels >= 0
+        order = np.lexsort((np.arange(len(labels)), labels, label_an))
+        dup = np.zeros(len(labels), dtype=bool)
+        same = (np.diff(label_an[order]) == 0) & (np.diff(labels[order]) == 0)
+        dup[order[1:][same]] = True
+        keep &= ~dup | ~not_edited
+        self.codes['label'] = labels[keep]
+        n_labels = np.bincount(label_an[keep], minlength=len(self.label_ptr) - 1)
+        self.label_ptr = self._ptr(n_labels)
+        changed.update(np.unique(rows[is_mapped]).tolist())
+        return sorted(changed)
@@ -1,53 +1,196 @@
-from pydantic import parse_file_as
+import gc
+import json
+from functools import partial
+from pydantic import parse_file_as, parse_obj_as
 from pathlib import Path
-from typing import List, Union, Tuple, Optional
-from core.models import Category, VideoBase, AllGroups, Segment, Annotation
+from typing import Callable, Dict, List, Union, Tuple, Optional
+from core.models import Category, VideoBase, AllGroups, Segment, Annotation, Frames
+from core.label_index import LabelIndex
+from core.label_registry import LabelRegistry
+from core.ordering import LabelsFirst, SegmentOrder, UnlabelledFirst
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def create_order(vb: VideoBase,
-                 labels_ticked_all: Optional[List[List[str]]] = None):
-    """Create the order in which videos will be shown."""
+                 labels_ticked_all: Optional[List[List[str]]] = None,
+                 index: Optional[LabelIndex] = None,
+                 seed: Optional[int] = None):
+    """
+    Create the order in which videos will be shown, see ordering.build_order for more
+    strategies. Reproducible if seed is provided.
+    """
     print(f"Currently ticked labels: \n{labels_ticked_all}")
+    if index is None:
+        index = LabelIndex(vb)
 
-    idx_all = np.arange(len(vb.segments))
-    
     # Random permutation if the ticked labels were not provided
     if labels_ticked_all is None:
-        return np.random.permutation(idx_all), len(vb.segments), 0
-    
+        return SegmentOrder(index, [], seed).order, len(vb.segments), 0
+
     # If no labels were ticked, put the unlabelled segments first
     if len(labels_ticked_all) == 0:
-        is_not_labelled = ~np.array(vb.segments_have_annotations())
-        n_total_seg = len(is_not_labelled)
+        n_total_seg = len(vb.segments)
         print(f"Total segments: {n_total_seg}")
-        n_unlabelled = is_not_labelled.sum()
-        print(f"Currently unlabelled: {n_unlabelled}")
-        idx_not_labelled = np.random.permutation(idx_all[is_not_labelled])
-        idx_labelled = np.random.permutation(idx_all[~is_not_labelled])
-        order = np.append(idx_not_labelled, idx_labelled)
-        return order, n_total_seg, n_total_seg - n_unlabelled
-    
+        n_labelled = int(index.has_annotations().sum())
+        print(f"Currently unlabelled: {n_total_seg - n_labelled}")
+        order = SegmentOrder(index, [UnlabelledFirst()], seed).order
+        return order, n_total_seg, n_labelled
+
     # If some labels were ticked, put them first
     else:
         labels_ticked_all = [l[1] for l in labels_ticked_all]
-        labels_are_ticked = np.vstack([vb.label_in_segments(label) for label in labels_ticked_all])
-        any_label_ticked = np.any(labels_are_ticked, axis=0)
-        n_total_seg = len(any_label_ticked)
+        n_total_seg = len(vb.segments)
         print(f"Total segments: {n_total_seg}")
-        n_with_ticked = any_label_ticked.sum()
+        n_with_ticked = int(index.label_in_segments(labels_ticked_all).sum())
         print(f"Currently with the ticked labels: {n_with_ticked}")
-        # Create the new order, ticked element first
-        idx_ticked = np.random.permutation(idx_all[any_label_ticked])
-        idx_not_ticked = np.random.permutation(idx_all[~any_label_ticked])
-
-        order = np.append(idx_ticked, idx_not_ticked)
+        order = SegmentOrder(index, [LabelsFirst(labels_ticked_all)], seed).order
         return order, n_total_seg, n_with_ticked
  
 
-def load_videobase(json_path: Union[Path, str]):
-    vb = parse_file_as(VideoBase, json_path)
-    return vb
+def read_json(json_path: Union[Path, str]):
+    """Parse a json file, with orjson if it is installed."""
+    with open(json_path, 'rb') as f:
+        raw = f.read()
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _unvalidated(model, values: dict):
+    "Lighter BaseModel.construct: no defaults, no copy of values, which is used as is."
+    obj = model.__new__(model)
+    object.__setattr__(obj, '__dict__', values)
+    object.__setattr__(obj, '__fields_set__', set(values))
+    obj._init_private_attributes()
+    return obj
+
+
+def segment_from_dict(seg: dict) -> Segment:
+    "Build a Segment from parsed json without validating it, reusing the dictionary."
+    seg['frames'] = _unvalidated(Frames, seg['frames'])
+    seg['annotations'] = [_unvalidated(Annotation, an) for an in seg['annotations']]
+    return _unvalidated(Segment, seg)
+
+
+def videobase_from_dict(data: dict) -> VideoBase:
+    """
+    Build a VideoBase from parsed json without validating it. For trusted files only.
+    The input dictionaries are reused by the models.
+
+    Parameters
+    ----------
+    data: dict
+
+    Returns
+    -------
+    vb: VideoBase
+    """
+    segments = [segment_from_dict(seg) for seg in data['segments']]
+    return _unvalidated(VideoBase, dict(segments=segments, notes=data.get('notes')))
+
+
+def load_videobase(json_path: Union[Path, str], validate: bool = False) -> VideoBase:
+    """
+    Load a VideoBase json file.
+
+    Parameters
+    ----------
+    json_path: Path or str
+        Json file, or SQLite database (.sqlite or .db, see db.VideoBaseDB)
+    validate: bool
+        Fully validate every segment, frames and annotation (slow for large bases).
+        By default the models are built without validation.
+
+    Returns
+    -------
+    vb: VideoBase
+    """
+    from core.db import VideoBaseDB, is_database
+    if is_database(json_path):
+        db = VideoBaseDB(json_path)
+        try:
+            vb = db.load()
+        finally:
+            db.close()
+        return parse_obj_as(VideoBase, vb.dict()) if validate else vb
+    # Millions of objects are allocated, none of them garbage: pause the cyclic collector
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        data = read_json(json_path)
+        if validate:
+            return parse_obj_as(VideoBase, data)
+        return videobase_from_dict(data)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def videobase_to_json(vb: VideoBase, indent: bool = True) -> str:
+    """Serialize a VideoBase, with orjson if it is installed (2 spaces indent)."""
+    if orjson is not None:
+        return _dumps(vb.dict(), indent)
+    return vb.json(indent=2 if indent else None)
+
+
+def _dumps(data: dict, indent: bool) -> str:
+    "Parsed json of a VideoBase to text, as VideoBase.json would."
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+    return json.dumps(data, indent=2 if indent else None)
+
+
+def videobase_snapshot(vb: VideoBase) -> Callable[[], str]:
+    """
+    Consistent snapshot of a VideoBase, to be serialized from another thread while the
+    annotations keep changing.
+
+    Only the annotations change while annotating: (user, date, labels) of each annotation
+    is copied, the other fields of the segments are shared with the VideoBase. A
+    CompactVideoBase is copied with CompactVideoBase.snapshot.
+
+    Returns
+    -------
+    serialize: Callable[[], str]
+        Json of the VideoBase as it was when the snapshot was taken, see videobase_to_json
+    """
+    from core.compact import CompactVideoBase
+    if isinstance(vb, CompactVideoBase):
+        return partial(videobase_to_json, vb.snapshot())
+    # Many small lists allocated, none of them garbage
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        segments = [(seg, [(an.user, an.date, list(an.labels)) for an in seg.annotations])
+                    for seg in vb.segments]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    notes = vb.notes
+
+    def serialize() -> str:
+        data = dict(segments=[], notes=notes)
+        for seg, annotations in segments:
+            seg_dict = seg.dict(exclude={'annotations'})
+            seg_dict['annotations'] = [dict(user=user, date=date, labels=labels)
+                                       for user, date, labels in annotations]
+            data['segments'].append(seg_dict)
+        return _dumps(data, indent=True)
+
+    return serialize
+
+
+def copy_segment(seg: Segment) -> Segment:
+    "Copy of a segment with its own annotations, the other fields are shared."
+    annotations = [_unvalidated(Annotation, dict(user=an.user, date=an.date,
+                                                 labels=list(an.labels)))
+                   for an in seg.annotations]
+    return _unvalidated(Segment, dict(seg.__dict__, annotations=annotations))
 
 
 def load_labels(json_path: Union[Path, str]):
@@ -56,13 +199,19 @@ def load_labels(json_path: Union[Path, str]):
     return groups
 
 
-def find_category(categories: List[Category], category: str) -> Union[Tuple[int, Category], None]:
+def load_label_registry(json_path: Union[Path, str]) -> LabelRegistry:
+    return LabelRegistry.from_groups(parse_file_as(AllGroups, json_path))
+
+
+def find_category(categories: Union[List[Category], LabelRegistry],
+                  category: str) -> Union[Tuple[int, Category], None]:
     """
     Find a category, and its index, by its name
 
     Parameters
     ----------
-    categories: List[Category]
+    categories: List[Category] or LabelRegistry
+        Dict lookup for a LabelRegistry, linear scan otherwise
     category: str
 
     Returns
@@ -70,29 +219,35 @@ def find_category(categories: List[Category], category: str) -> Union[Tuple[int,
     ix: int
     cat: Category
     """
+    if isinstance(categories, LabelRegistry):
+        return categories.find_category(category)
     for ix, cat in enumerate(categories):
         if cat.name == category:
             return ix, cat
     return None
 
 
-def create_label(categories: List[Category], category: str, label: str) -> List[Category]:
+def create_label(categories: Union[List[Category], LabelRegistry],
+                 category: str, label: str) -> Union[List[Category], LabelRegistry]:
     """
     Add a label to a given category. Creates the category if needed.
     Avoids duplicating labels in the same category
 
     Parameters
     ----------
-    categories: List[Category]
+    categories: List[Category] or LabelRegistry
     category: str
         Name of the category to add to
     label: str
 
     Returns
     -------
-    cat: List[Category]
+    cat: List[Category] or LabelRegistry
 
     """
+    if isinstance(categories, LabelRegistry):
+        categories.add_label(category, label)
+        return categories
     match = find_category(categories, category)
     if match is None:
         categories.append(Category(name=category, labels=[label]))
@@ -104,13 +259,15 @@ def create_label(categories: List[Category], category: str, label: str) -> List[
     return categories
 
 
-def find_label_category(categories: List[Category], label: str) -> Union[None, Tuple[int, Category]]:
+def find_label_category(categories: Union[List[Category], LabelRegistry],
+                        label: str) -> Union[None, Tuple[int, Category]]:
     """
     Find to which category a label belongs, if any
 
     Parameters
     ----------
-    categories: List[Category]
+    categories: List[Category] or LabelRegistry
+        Dict lookup for a LabelRegistry, linear scan otherwise
     label: str
 
     Returns
@@ -119,13 +276,16 @@ def find_label_category(categories: List[Category], label: str) -> Union[None, T
         Index of category in the given list
     cat: Category or None
     """
+    if isinstance(categories, LabelRegistry):
+        return categories.find_label_category(label)
     for ix, cat in enumerate(categories):
         if label in cat.labels:
             return ix, cat
     return None
 
 
-def create_annotation(segment: Segment, user: str, date: str, label: str):
+def create_annotation(segment: Segment, user: str, date: str, label: str,
+                      index: Optional[LabelIndex] = None, row: Optional[int] = None):
     """
     Add a label to a given segment. Either to an existing annotation session or to a new one
 
@@ -135,28 +295,35 @@ def create_annotation(segment: Segment, user: str, date: str, label: str):
     user: str
     date: str
     label: str
+    index: LabelIndex, optional
+        Label index kept up to date
+    row: int, optional
+        Row of the segment in index, required with index (uids are not unique)
 
     Returns
     -------
     segment: models.Segment
         Updated segment
     """
-    m_an = None
-    for an in segment.annotations:
-        if an.user == user and an.date == date:
-            m_an = an
-            break
+    _check_row(index, row)
+    m_an = segment.find_annotation(user, date)
     if m_an is None:
         m_an = Annotation(user=user, date=date, labels=[label])
-        segment.annotations.append(m_an)
+        segment.add_annotation(m_an)
+        if index is not None:
+            index.annotation_added(row)
+            index.label_added(row, user, label)
     else:
         # Plays on the reference to the item
         if label not in m_an.labels:
             m_an.labels.append(label)
+            if index is not None:
+                index.label_added(row, user, label)
     return segment
 
 
-def remove_annotation(segment: Segment, user: str, label: str):
+def remove_annotation(segment: Segment, user: str, label: str,
+                      index: Optional[LabelIndex] = None, row: Optional[int] = None):
     """
     Remove a label from a segment. Do it in a user specific manner
 
@@ -165,16 +332,17 @@ def remove_annotation(segment: Segment, user: str, label: str):
     segment
     user
     label
+    index: LabelIndex, optional
+        Label index kept up to date
+    row: int, optional
+        Row of the segment in index, required with index
 
     Returns
     -------
 
     """
-    m_an = None
-    for an in segment.annotations:
-        if an.user == user:
-            m_an = an
-            break
+    _check_row(index, row)
+    m_an = segment.find_annotation(user)
     if m_an is None:
         # No previous annotation was found, no need to remove anything
         return segment
@@ -182,43 +350,129 @@ def remove_annotation(segment: Segment, user: str, label: str):
         # This label is not present, can not remove it
         return segment
     m_an.labels.remove(label)
+    if index is not None and label not in m_an.labels:
+        index.label_removed(row, user, label)
     return segment
 
 
-def find_segments_label(vb: VideoBase, label: str) -> List[Segment]:
+def _check_row(index: Optional[LabelIndex], row: Optional[int]):
+    if index is not None and row is None:
+        raise ValueError('The row of the segment is required to update the label index')
+
+
+def find_segments_label(vb: VideoBase, label: str,
+                        index: Optional[LabelIndex] = None) -> List[Segment]:
     """
-    Find all segments annotate with a given label
+    Find all segments annotate with a given label. Each segment is returned once.
      
     Parameters
     ----------
     vb: VideoBase
     label: str
+    index: LabelIndex, optional
+        Used instead of scanning the segments if provided
 
     Returns
     -------
     matched: List[Segment]
     """
-    matched: List[Segment] = []
     if vb is None:
-        return matched
-    # Could be a long list comprehension. Unrolled for now.
-    for seg in vb.segments:
-        for an in seg.annotations:
-            if label in an.labels:
-                matched.append(seg)
-    return matched
-
-
-def rename_label(categories: List[Category], vb: VideoBase,
-                 old_label: str, new_label: str) -> Tuple[List[Category], VideoBase]:
-    ix, cat = find_label_category(categories, old_label)
-    if cat is None:
+        return []
+    if index is not None:
+        return [vb.segments[row] for row in np.flatnonzero(index.label_in_segments(label))]
+    return [seg for seg in vb.segments if seg.label_in_segment(label)]
+
+
+def relabel_categories(categories: Union[List[Category], LabelRegistry],
+                       mapping: Dict[str, Optional[str]]):
+    """Apply a label mapping to the categories, see relabel."""
+    mapping = {old: new for old, new in mapping.items() if old != new}
+    kept = {lb for cat in categories for lb in cat.labels if lb not in mapping}
+    placed = set()
+    for cat in categories:
+        labels = []
+        for lb in cat.labels:
+            if lb in mapping:
+                lb = mapping[lb]
+                if lb is None or lb in kept or lb in placed:
+                    # Deleted, or merged into a label already listed
+                    continue
+                placed.add(lb)
+            if lb not in labels:
+                labels.append(lb)
+        cat.labels = labels
+    if isinstance(categories, LabelRegistry):
+        categories.reindex()
+
+
+def relabel_segment(segment: Segment, mapping: Dict[str, Optional[str]],
+                    counts: Dict[str, int]) -> bool:
+    """Apply a label mapping to the annotations of a segment, see relabel.
+    counts is incremented for each label changed. Return True if the segment changed."""
+    changed = False
+    for an in segment.annotations:
+        if not any(lb in mapping for lb in an.labels):
+            continue
+        labels = []
+        for lb in an.labels:
+            if lb in mapping:
+                counts[lb] = counts.get(lb, 0) + 1
+                lb = mapping[lb]
+            if lb is not None and lb not in labels:
+                labels.append(lb)
+        an.labels = labels
+        changed = True
+    return changed
+
+
+def relabel(categories: Union[List[Category], LabelRegistry], vb: Optional[VideoBase],
+            mapping: Dict[str, Optional[str]],
+            index: Optional[LabelIndex] = None) -> Dict[str, int]:
+    """
+    Rename, merge or delete labels, in the categories and in all the annotations.
+
+    Annotations are rewritten in a single pass over the segments. Several labels mapped to
+    the same one are merged, each annotation keeping a single copy of it.
+
+    Parameters
+    ----------
+    categories: List[Category] or LabelRegistry
+        Modified in place. Labels mapped to a label already present in the categories are
+        removed from their own category, otherwise they are renamed where they stand.
+    vb: VideoBase or None
+        Modified in place
+    mapping: Dict[str, Optional[str]]
+        New name of each label, None to delete it
+    index: LabelIndex, optional
+        Label index kept up to date
+
+    Returns
+    -------
+    counts: Dict[str, int]
+        Number of annotations changed for each label of the mapping
+    """
+    mapping = {old: new for old, new in mapping.items() if old != new}
+    counts = {old: 0 for old in mapping}
+    if len(mapping) == 0:
+        return counts
+    relabel_categories(categories, mapping)
+    from core.compact import CompactVideoBase
+    if isinstance(vb, CompactVideoBase):
+        # Vectorized on the label codes
+        rows = vb.relabel(mapping, counts)
+    else:
+        rows = [row for row, seg in enumerate(vb.segments if vb is not None else [])
+                if relabel_segment(seg, mapping, counts)]
+    if index is not None and len(rows) > 0:
+        labels = set(mapping) | {new for new in mapping.values() if new is not None}
+        index.rebuild_labels(vb, sorted(labels), rows=rows)
+    return counts
+
+
+def rename_label(categories: Union[List[Category], LabelRegistry], vb: VideoBase,
+                 old_label: str, new_label: str,
+                 index: Optional[LabelIndex] = None) -> Tuple[List[Category], VideoBase]:
+    if find_label_category(categories, old_label) is None:
         raise ValueError(f'{old_label} is not a valid label. Can not be renamed')
-    # Replace the label in the category list
-    cat.labels = [lb if lb != old_label else new_label for lb in cat.labels]
-    # Rename in all previously annotated segments
-    segments = find_segments_label(vb, old_label)
-    for seg in segments:
-        for an in seg.annotations:
-            an.labels = [lb if lb != old_label else new_label for lb in an.labels]
+    relabel(categories, vb, {old_label: new_label}, index)
     return categories, vb
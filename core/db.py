@@ -0,0 +1,268 @@
+import argparse
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+import numpy as np
+from core import crud
+from core.journal import ADD
+from core.models import Segment, VideoBase
+
+SUFFIXES = ('.sqlite', '.db')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL UNIQUE,
+    subject TEXT, date TEXT, session TEXT, folder TEXT,
+    begin INTEGER, end INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    segment_id INTEGER NOT NULL REFERENCES segments(id),
+    camera INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (segment_id, camera)
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY,
+    segment_id INTEGER NOT NULL REFERENCES segments(id),
+    user TEXT NOT NULL,
+    date TEXT NOT NULL,
+    UNIQUE (segment_id, user, date)
+);
+CREATE TABLE IF NOT EXISTS labels (
+    annotation_id INTEGER NOT NULL REFERENCES annotations(id),
+    label TEXT NOT NULL,
+    UNIQUE (annotation_id, label)
+);
+CREATE INDEX IF NOT EXISTS labels_label ON labels (label);
+CREATE INDEX IF NOT EXISTS annotations_segment ON annotations (segment_id);
+'''
+
+
+def is_database(path: Union[Path, str]) -> bool:
+    return Path(path).suffix in SUFFIXES
+
+
+class VideoBaseDB:
+    """
+    VideoBase stored in a SQLite database, with one table for the segments, their files,
+    their annotations and the labels of the annotations.
+
+    Label changes are single transactions (see record), so nothing has to be rewritten
+    when a label is checked. Segments keep their position in the VideoBase as id.
+
+    Parameters
+    ----------
+    path: Path or str
+        Created if needed
+    """
+
+    def __init__(self, path: Union[Path, str]) -> None:
+        self.path = Path(path)
+        self._con = sqlite3.connect(str(self.path))
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.executescript(SCHEMA)
+
+    def __len__(self):
+        return self._con.execute('SELECT COUNT(*) FROM segments').fetchone()[0]
+
+    def close(self):
+        self._con.close()
+
+    @property
+    def notes(self) -> Optional[str]:
+        row = self._con.execute("SELECT value FROM meta WHERE key = 'notes'").fetchone()
+        return None if row is None else row[0]
+
+    @notes.setter
+    def notes(self, notes: Optional[str]):
+        with self._con as con:
+            con.execute("INSERT OR REPLACE INTO meta VALUES ('notes', ?)", (notes,))
+
+    # Import / export
+    def import_segments(self, segments: Iterable[Segment], notes: Optional[str] = None):
+        """Replace the content of the database, in a single transaction."""
+        con = self._con
+        with con:
+            for table in ('labels', 'annotations', 'files', 'segments', 'meta'):
+                con.execute(f'DELETE FROM {table}')
+            con.execute("INSERT INTO meta VALUES ('notes', ?)", (notes,))
+            an_id = 0
+            for seg_id, seg in enumerate(segments):
+                con.execute('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (seg_id, seg.uid, seg.subject, seg.date, seg.session, seg.folder,
+                             seg.frames.begin, seg.frames.end))
+                con.executemany('INSERT INTO files VALUES (?, ?, ?)',
+                                [(seg_id, cam, f) for cam, f in enumerate(seg.files)])
+                # Annotations sharing user and date are merged
+                seg_an_ids = {}
+                for an in seg.annotations:
+                    key = (an.user, an.date)
+                    if key not in seg_an_ids:
+                        seg_an_ids[key] = an_id
+                        con.execute('INSERT INTO annotations VALUES (?, ?, ?, ?)',
+                                    (an_id, seg_id, an.user, an.date))
+                        an_id += 1
+                    con.executemany('INSERT OR IGNORE INTO labels VALUES (?, ?)',
+                                    [(seg_an_ids[key], lb) for lb in an.labels])
+
+    def import_videobase(self, vb: VideoBase):
+        self.import_segments(vb.segments, vb.notes)
+
+    def iter_segments(self) -> Iterator[Segment]:
+        "Segments in order, built without validation (see crud.segment_from_dict)."
+        con = self._con
+        files = con.execute('SELECT segment_id, path FROM files ORDER BY segment_id, camera')
+        annotations = con.execute('SELECT id, segment_id, user, date FROM annotations '
+                                  'ORDER BY segment_id, id')
+        labels = con.execute('SELECT l.annotation_id, l.label FROM labels l JOIN annotations a '
+                             'ON l.annotation_id = a.id ORDER BY a.segment_id, a.id, l.rowid')
+        # The four queries are ordered by segment, read side by side
+        next_file = next(files, None)
+        next_an = next(annotations, None)
+        next_label = next(labels, None)
+        for seg_id, uid, subject, date, session, folder, begin, end in con.execute(
+                'SELECT * FROM segments ORDER BY id'):
+            seg_files = []
+            while next_file is not None and next_file[0] == seg_id:
+                seg_files.append(next_file[1])
+                next_file = next(files, None)
+            seg_annotations = []
+            while next_an is not None and next_an[1] == seg_id:
+                an_id, _, user, an_date = next_an
+                an_labels = []
+                while next_label is not None and next_label[0] == an_id:
+                    an_labels.append(next_label[1])
+                    next_label = next(labels, None)
+                seg_annotations.append(dict(user=user, date=an_date, labels=an_labels))
+                next_an = next(annotations, None)
+            yield crud.segment_from_dict(dict(subject=subject, date=date, session=session,
+                                              uid=uid, folder=folder, files=seg_files,
+                                              frames=dict(begin=begin, end=end),
+                                              annotations=seg_annotations))
+
+    def load(self) -> VideoBase:
+        return crud._unvalidated(VideoBase, dict(segments=list(self.iter_segments()),
+                                                 notes=self.notes))
+
+    # Single label changes, same behaviour as crud.create_annotation / remove_annotation
+    def _segment_id(self, uid: str) -> int:
+        row = self._con.execute('SELECT id FROM segments WHERE uid = ?', (uid,)).fetchone()
+        if row is None:
+            raise KeyError(f'No segment {uid} in {self.path}')
+        return row[0]
+
+    def add_label(self, uid: str, user: str, date: str, label: str):
+        with self._con as con:
+            seg_id = self._segment_id(uid)
+            con.execute('INSERT OR IGNORE INTO annotations (segment_id, user, date) '
+                        'VALUES (?, ?, ?)', (seg_id, user, date))
+            an_id = con.execute('SELECT id FROM annotations WHERE segment_id = ? AND user = ? '
+                                'AND date = ?', (seg_id, user, date)).fetchone()[0]
+            con.execute('INSERT OR IGNORE INTO labels VALUES (?, ?)', (an_id, label))
+
+    def remove_label(self, uid: str, user: str, label: str):
+        "Remove a label from the first annotation of the user."
+        with self._con as con:
+            seg_id = self._segment_id(uid)
+            row = con.execute('SELECT id FROM annotations WHERE segment_id = ? AND user = ? '
+                              'ORDER BY id LIMIT 1', (seg_id, user)).fetchone()
+            if row is not None:
+                con.execute('DELETE FROM labels WHERE annotation_id = ? AND label = ?',
+                            (row[0], label))
+
+    def relabel(self, mapping: Dict[str, Optional[str]]) -> Dict[str, int]:
+        """
+        Rename, merge or delete labels, see crud.relabel. Return the annotations changed by
+        label.
+
+        The mapping is applied in a single step, through temporary tables: labels renamed to
+        one another (swaps, chains) do not see each other's new names.
+        """
+        mapping = {old: new for old, new in mapping.items() if old != new}
+        counts = {old: 0 for old in mapping}
+        if len(mapping) == 0:
+            return counts
+        with self._con as con:
+            # Left behind if a previous relabel failed on this connection
+            con.execute('DROP TABLE IF EXISTS temp.relabel_map')
+            con.execute('DROP TABLE IF EXISTS temp.relabeled')
+            con.execute('CREATE TEMP TABLE relabel_map (old TEXT PRIMARY KEY, new TEXT)')
+            con.executemany('INSERT INTO relabel_map VALUES (?, ?)', mapping.items())
+            # New labels, keeping the rowid of the old ones to keep their place
+            con.execute('CREATE TEMP TABLE relabeled AS SELECT l.rowid AS id, l.annotation_id, '
+                        'm.new AS label FROM labels l JOIN relabel_map m ON l.label = m.old '
+                        'WHERE m.new IS NOT NULL')
+            for old, n_changed in con.execute('SELECT m.old, COUNT(*) FROM labels l JOIN '
+                                              'relabel_map m ON l.label = m.old GROUP BY m.old'):
+                counts[old] = n_changed
+            con.execute('DELETE FROM labels WHERE label IN (SELECT old FROM relabel_map)')
+            # Ignored when the annotation already has the new label (merge)
+            con.execute('INSERT OR IGNORE INTO labels (rowid, annotation_id, label) '
+                        'SELECT id, annotation_id, label FROM relabeled ORDER BY id')
+            con.execute('DROP TABLE relabel_map')
+            con.execute('DROP TABLE relabeled')
+        return counts
+
+    def record(self, uid: str, user: str, date: str, label: str, op: str):
+        "Apply a label change, same arguments as journal.AnnotationJournal.record."
+        if op == ADD:
+            self.add_label(uid, user, date, label)
+        else:
+            self.remove_label(uid, user, label)
+
+    # Queries, same as LabelIndex so that it can be used by crud.create_order
+    def has_annotations(self, user: Optional[str] = None) -> np.ndarray:
+        "Boolean vector indicating if the segments are annotated (by user if provided)."
+        if user is None:
+            query, args = 'SELECT DISTINCT segment_id FROM annotations', ()
+        else:
+            query = ('SELECT DISTINCT a.segment_id FROM annotations a JOIN labels l '
+                     'ON l.annotation_id = a.id WHERE a.user = ?')
+            args = (user,)
+        return self._mask(query, args)
+
+    def label_in_segments(self, labels: Iterable[str], user: Optional[str] = None) -> np.ndarray:
+        "Boolean vector indicating if the segments have any of the input labels."
+        if isinstance(labels, str):
+            labels = [labels]
+        labels = list(labels)
+        query = ('SELECT DISTINCT a.segment_id FROM labels l JOIN annotations a '
+                 f'ON l.annotation_id = a.id WHERE l.label IN ({",".join("?" * len(labels))})')
+        args: List[str] = labels
+        if user is not None:
+            query += ' AND a.user = ?'
+            args = labels + [user]
+        return self._mask(query, args)
+
+    def _mask(self, query: str, args) -> np.ndarray:
+        mask = np.zeros(len(self), dtype=bool)
+        ids = np.array([row[0] for row in self._con.execute(query, args)], dtype=np.intp)
+        mask[ids] = True
+        return mask
+
+
+if __name__ == '__main__':
+    from core.stream import VideoBaseStream, VideoBaseWriter
+
+    parser = argparse.ArgumentParser(
+        description='Convert a VideoBase between the json and the SQLite formats.')
+    parser.add_argument('input', help='VideoBase json file or database')
+    parser.add_argument('output', help='VideoBase database or json file')
+    args = parser.parse_args()
+
+    if is_database(args.input) == is_database(args.output):
+        parser.error(f'Convert from json ({SUFFIXES}) to a database or the opposite')
+    if is_database(args.output):
+        db = VideoBaseDB(args.output)
+        stream = VideoBaseStream(args.input)
+        db.import_segments(stream)
+        # Only known once the whole file was read
+        db.notes = stream.notes
+    else:
+        db = VideoBaseDB(args.input)
+        with VideoBaseWriter(args.output, db.notes) as writer:
+            writer.write_all(db.iter_segments())
+    print(f'{len(db)} segments written to {args.output}')
+    db.close()
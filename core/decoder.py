@@ -0,0 +1,262 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Dict, Iterator, Optional
+import av
+import numpy as np
+from pims import Video
+from core.frame_format import FULL, FrameFormat, read_frame, to_ndarray
+
+
+class DecoderBackend(ABC):
+    """
+    Opened video file, read by the DecodeWorkers of a VideoReader.
+
+    Same interface as pims.Video for what the reader needs (len, indexing, close), plus
+    read which returns a frame in a given FrameFormat. Backends are opened by
+    open_decoder, or given to the reader and to the VideoPool as open_video.
+    """
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    def __getitem__(self, frame_ix: int) -> np.ndarray:
+        return self.read(frame_ix)
+
+    @abstractmethod
+    def read(self, frame_ix: int, fmt: FrameFormat = FULL) -> np.ndarray:
+        pass
+
+    @property
+    @abstractmethod
+    def frame_rate(self) -> float:
+        "Average frame rate, frame indices are presentation times times the frame rate."
+
+    def close(self):
+        pass
+
+
+class PimsDecoder(DecoderBackend):
+    """
+    Frames read through pims.Video, the previous default. Every frame is converted to
+    full resolution RGB by pims before being shrunk to fmt.
+    """
+
+    def __init__(self, video_path: str) -> None:
+        self.video_path = str(video_path)
+        self._video = Video(self.video_path)
+
+    def __len__(self):
+        return len(self._video)
+
+    @property
+    def frame_rate(self) -> float:
+        return self._video.frame_rate
+
+    def read(self, frame_ix: int, fmt: FrameFormat = FULL) -> np.ndarray:
+        try:
+            return read_frame(self._video, frame_ix, fmt)
+        except AttributeError:
+            # We reached the end of the video and can't seek
+            self._video.close()
+            self._video = Video(self.video_path)
+            return read_frame(self._video, frame_ix, fmt)
+
+    def close(self):
+        self._video.close()
+
+
+class PyAVDecoder(DecoderBackend):
+    """
+    Frames decoded by PyAV, reading the packets sequentially.
+
+    Reading the frame after the last one read (playback) only decodes it. Other frames
+    close ahead are reached by decoding forward. Once a frame before the last one is read
+    (stepping back), the last few frames returned are kept, until playback goes on for
+    longer than the history: keeping them (and allocating new ones) during playback was
+    slower. The decoder only seeks (to the keyframe before the frame) for other jumps:
+    loop wrap, segment change. FFmpeg decodes with slice threads, frame threads were also
+    slower for sequential reads.
+
+    Frame indices are computed from the presentation timestamps and the average frame
+    rate, as pims does. Frames after the end of the stream (when the frame count in the
+    header is too high) repeat the last frame. With fmt.keyframes, FFmpeg skips the
+    other frames, and frame i is the last keyframe at or before i.
+
+    Parameters
+    ----------
+    video_path: str
+    thread_count: int
+        Number of decoding threads, 0 to let FFmpeg choose
+    fast_forward: int
+        Largest forward jump decoded through instead of seeking
+    history: int
+        Number of frames returned kept when stepping, in the format they were returned in
+    """
+    MAX_SEEK_BACK = 4
+
+    def __init__(self, video_path: str, thread_count: int = 0, fast_forward: int = 32,
+                 history: int = 8) -> None:
+        self.video_path = str(video_path)
+        self.fast_forward = fast_forward
+        self.thread_count = thread_count
+        self._keyframes = False
+        self._open()
+        self._time_base = self._stream.time_base
+        self._rate = self._stream.average_rate
+        self._start = self._stream.start_time or 0
+        if self._stream.frames > 0:
+            self._n_frames = self._stream.frames
+        else:
+            duration = self._stream.duration
+            if duration is None:
+                seconds = self._container.duration / av.time_base
+            else:
+                seconds = float(duration * self._time_base)
+            self._n_frames = int(seconds * self._rate)
+        self._frames: Optional[Iterator[av.VideoFrame]] = None
+        self._last = -1
+        self._last_frame: Optional[av.VideoFrame] = None
+        # Frame decoded after the one asked for, not returned yet
+        self._ahead: Optional[av.VideoFrame] = None
+        self._history = deque(maxlen=history)
+        self._stepping = False
+        # Last frame returned, and number of frames returned in order since stepping back
+        self._last_read = -1
+        self._n_forward = 0
+        # Last keyframe converted, returned again if asked again in the same format
+        self._converted = (None, None, None)
+        # Counters, see benchmarks.decode
+        self.n_decoded = 0
+        self.n_seeks = 0
+
+    def __len__(self):
+        return self._n_frames
+
+    @property
+    def frame_rate(self) -> float:
+        return float(self._rate)
+
+    def _open(self):
+        self._container = av.open(self.video_path)
+        self._stream = self._container.streams.video[0]
+        self._stream.thread_type = 'SLICE'
+        self._stream.thread_count = self.thread_count
+        # Only read when the decoder is opened (by the first decode)
+        self._stream.codec_context.skip_frame = 'NONKEY' if self._keyframes else 'DEFAULT'
+
+    def _frame_index(self, frame: av.VideoFrame) -> int:
+        if frame.pts is None:
+            return self._last + 1
+        return int(round((frame.pts - self._start) * self._time_base * self._rate))
+
+    def _seek(self, frame_ix: int):
+        target = self._start + int(frame_ix / (self._rate * self._time_base))
+        self._container.seek(max(target, self._start), stream=self._stream)
+        self._frames = self._container.decode(self._stream)
+        self._last = -1
+        self._last_frame = None
+        self._ahead = None
+        self.n_seeks += 1
+
+    def _read_until(self, frame_ix: int) -> Optional[av.VideoFrame]:
+        "Decode forward up to frame_ix. None if the decoder started after it."
+        while True:
+            frame, self._ahead = self._ahead, None
+            if frame is None:
+                frame = next(self._frames, None)
+                if frame is None:
+                    # End of the stream
+                    self._frames = None
+                    return self._last_frame
+                self.n_decoded += 1
+            ix = self._frame_index(frame)
+            if ix > frame_ix and self._last_frame is None:
+                return None
+            if ix > frame_ix:
+                # Missing (or skipped) frame, the previous one is shown longer
+                self._ahead = frame
+                return self._last_frame
+            self._last, self._last_frame = ix, frame
+            if ix == frame_ix:
+                return frame
+
+    def read(self, frame_ix: int, fmt: FrameFormat = FULL) -> np.ndarray:
+        if frame_ix < 0:
+            frame_ix += len(self)
+        if not 0 <= frame_ix < len(self):
+            raise IndexError(f'Frame {frame_ix} out of range for {self.video_path}')
+        if fmt.keyframes != self._keyframes:
+            # skip_frame cannot be changed once the decoder is opened
+            self._keyframes = fmt.keyframes
+            self._container.close()
+            self._open()
+            self._frames = None
+            self._history.clear()
+        if frame_ix < self._last_read:
+            self._stepping = True
+            self._n_forward = 0
+        elif frame_ix == self._last_read + 1 and self._stepping:
+            self._n_forward += 1
+            if self._n_forward > self._history.maxlen:
+                self._stepping = False
+                self._history.clear()
+        self._last_read = frame_ix
+        for ix, hist_fmt, array in self._history:
+            if ix == frame_ix and hist_fmt == fmt:
+                return array
+        if (self._frames is None or frame_ix < self._last
+                or frame_ix > self._last + self.fast_forward):
+            self._seek(frame_ix)
+        frame = self._read_until(frame_ix)
+        n_back = 0
+        while frame is None and n_back < self.MAX_SEEK_BACK:
+            # Seek landed after the frame, start one second earlier
+            n_back += 1
+            self._seek(max(frame_ix - n_back * int(self._rate), 0))
+            frame = self._read_until(frame_ix)
+        if frame is None:
+            raise IndexError(f'Frame {frame_ix} could not be decoded from {self.video_path}')
+        array = self._to_ndarray(frame, fmt)
+        if self._stepping:
+            self._history.append((frame_ix, fmt, array))
+        return array
+
+    def _to_ndarray(self, frame: av.VideoFrame, fmt: FrameFormat) -> np.ndarray:
+        if not fmt.keyframes:
+            return to_ndarray(frame, fmt)
+        # Keyframes are asked many times in a row during fast playback
+        last_frame, last_fmt, array = self._converted
+        if frame is not last_frame or fmt != last_fmt:
+            array = to_ndarray(frame, fmt)
+            self._converted = (frame, fmt, array)
+        return array
+
+    def close(self):
+        self._frames = None
+        self._last_frame = None
+        self._history.clear()
+        self._converted = (None, None, None)
+        self._container.close()
+
+
+def _indexed_video(video_path: str):
+    from core.video_index import IndexedVideo
+    return IndexedVideo(video_path)
+
+
+# Backends by name. 'indexed' (core.video_index.IndexedVideo) uses a keyframe index built
+# once per file, for ranges of long recordings.
+BACKENDS: Dict[str, Callable[[str], DecoderBackend]] = {
+    'pyav': PyAVDecoder,
+    'pims': PimsDecoder,
+    'indexed': _indexed_video,
+}
+
+
+def open_decoder(video_path: str, backend: str = 'pyav') -> DecoderBackend:
+    try:
+        open_video = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f'Unknown decoder {backend}, expected one of {list(BACKENDS)}')
+    return open_video(video_path)
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+import numpy as np
+from core.frame_format import FULL, FrameFormat
+
+
+class FrameCache:
+    """
+    Decoded frames shared by all cameras, keyed by (file, frame index, frame format).
+
+    Least recently used frames are evicted when the total size of the cached frames goes
+    above max_mb. Safe to use from the decoding threads. The cached arrays are shared,
+    they should not be modified in place.
+
+    Parameters
+    ----------
+    max_mb: float
+        Memory budget, in MB
+    """
+
+    def __init__(self, max_mb: float = 512) -> None:
+        self.max_bytes = int(max_mb * 1024 ** 2)
+        self._frames: 'OrderedDict[Tuple[str, int, FrameFormat], np.ndarray]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key: Tuple[str, int, FrameFormat]) -> bool:
+        return key in self._frames
+
+    def get(self, path: str, frame_ix: int, fmt: FrameFormat = FULL) -> Optional[np.ndarray]:
+        "Return the cached frame, None (and count a miss) if it is not in the cache."
+        with self._lock:
+            frame = self._frames.get((path, frame_ix, fmt))
+            if frame is None:
+                self.misses += 1
+                return None
+            self._frames.move_to_end((path, frame_ix, fmt))
+            self.hits += 1
+            return frame
+
+    def put(self, path: str, frame_ix: int, frame: np.ndarray, fmt: FrameFormat = FULL):
+        if frame.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            key = (path, frame_ix, fmt)
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self._frames.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    @property
+    def hit_rate(self) -> float:
+        n_requests = self.hits + self.misses
+        if n_requests == 0:
+            return 0.
+        return self.hits / n_requests
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
@@ -0,0 +1,67 @@
+from typing import NamedTuple, Optional, Tuple
+import av
+import numpy as np
+
+# Pixel formats the frames can be decoded to, and their number of channels
+PIX_FMTS = {'rgb24': 3, 'rgba': 4, 'gray': 1}
+
+
+class FrameFormat(NamedTuple):
+    """
+    Size and pixel format decoded frames are converted to.
+
+    Frames are shrunk to fit in width x height keeping their aspect ratio, never
+    enlarged. None means no limit in that direction. pix_fmt is one of PIX_FMTS, the
+    formats ArrayImage can display. With keyframes, only the keyframes are decoded (for
+    fast playback): frame i is the last keyframe at or before i. Decoders that cannot
+    skip frames (pims.Video) ignore it.
+    """
+    width: Optional[int] = None
+    height: Optional[int] = None
+    pix_fmt: str = 'rgb24'
+    keyframes: bool = False
+
+    def size_for(self, src_width: int, src_height: int) -> Tuple[int, int]:
+        "Output size of a src_width x src_height frame."
+        scale = 1.
+        if self.width is not None:
+            scale = min(scale, self.width / src_width)
+        if self.height is not None:
+            scale = min(scale, self.height / src_height)
+        if scale >= 1:
+            return src_width, src_height
+        # Even sizes, for the chroma planes of yuv420 frames
+        return max(2, int(src_width * scale) // 2 * 2), max(2, int(src_height * scale) // 2 * 2)
+
+
+FULL = FrameFormat()
+
+
+def to_ndarray(frame: av.VideoFrame, fmt: FrameFormat = FULL) -> np.ndarray:
+    """
+    Convert a decoded frame to an array in format fmt.
+
+    The frame is scaled in its own pixel format (usually planar yuv, straight out of the
+    decoder) before the conversion, so that the conversion only handles the output pixels.
+    """
+    width, height = fmt.size_for(frame.width, frame.height)
+    if (width, height) != (frame.width, frame.height):
+        frame = frame.reformat(width=width, height=height, interpolation='AREA')
+    return frame.to_ndarray(format=fmt.pix_fmt)
+
+
+def read_frame(video, frame_ix: int, fmt: FrameFormat = FULL) -> np.ndarray:
+    """
+    Frame frame_ix of an opened video in format fmt.
+
+    Decoder backends (core.decoder) convert the decoded frame directly. Other videos
+    (pims.Video) only return full resolution RGB frames, which are then shrunk.
+    """
+    read = getattr(video, 'read', None)
+    if read is not None:
+        return read(frame_ix, fmt)
+    frame = video[frame_ix]
+    if fmt._replace(keyframes=False) == FULL:
+        return frame
+    frame = av.VideoFrame.from_ndarray(np.ascontiguousarray(frame), format='rgb24')
+    return to_ndarray(frame, fmt)
@@ -0,0 +1,157 @@
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Union
+from pydantic import BaseModel
+from core.models import Segment, VideoBase
+from core import crud
+
+ADD = 'add'
+REMOVE = 'remove'
+
+
+class AnnotationEvent(BaseModel):
+    uid: str
+    user: str
+    date: str
+    label: str
+    op: str
+
+
+def journal_path(snapshot_path: Union[Path, str]) -> Path:
+    "Journal associated to a VideoBase snapshot: schema.json -> schema.journal.jsonl"
+    snapshot_path = Path(snapshot_path)
+    return snapshot_path.with_name(f'{snapshot_path.stem}.journal.jsonl')
+
+
+class AnnotationJournal:
+    """
+    Append-only log (one json event per line) of the label changes of a session.
+
+    Each check / uncheck costs one line appended to the journal. The full VideoBase
+    snapshot only has to be written from time to time (see compaction), after which the
+    events it contains are dropped from the journal. Events are idempotent so replaying a
+    journal over a snapshot that already contains some of them is harmless.
+
+    Parameters
+    ----------
+    path: Path or str
+    fsync: bool
+        Also flush the OS buffers after each event (survives a system crash, slower)
+    """
+
+    def __init__(self, path: Union[Path, str], fsync: bool = False) -> None:
+        self.path = Path(path)
+        self.fsync = fsync
+        self._file = self.path.open('a+')
+        self._lock = threading.Lock()
+        # Events recorded since the last compaction
+        self.n_events = 0
+
+    def record(self, uid: str, user: str, date: str, label: str, op: str):
+        event = AnnotationEvent(uid=uid, user=user, date=date, label=label, op=op)
+        with self._lock:
+            self._file.write(event.json() + '\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        self.n_events += 1
+
+    def offset(self) -> int:
+        "Position of the end of the journal, all the events before it were applied."
+        with self._lock:
+            return self._file.tell()
+
+    def drop_until(self, offset: int):
+        """Remove the events written before offset, keep the ones written after."""
+        with self._lock:
+            self._file.seek(offset)
+            tail = self._file.read()
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(tail)
+            self._file.flush()
+
+    def compaction(self) -> Callable[[], None]:
+        """
+        Mark the end of the journal when taking a snapshot, see crud.videobase_snapshot.
+
+        Returns
+        -------
+        on_written: Callable[[], None]
+            Drops the events before the mark from the journal, to be called once the
+            snapshot is written
+        """
+        mark = self.offset()
+        self.n_events = 0
+
+        def on_written():
+            self.drop_until(mark)
+
+        return on_written
+
+    def close(self, remove_if_empty: bool = True):
+        with self._lock:
+            self._file.close()
+        if remove_if_empty and self.path.stat().st_size == 0:
+            self.path.unlink()
+
+
+def retire_journal(path: Union[Path, str]) -> Path:
+    """
+    Rename a journal once its events are saved in a newer snapshot, so that it is not
+    replayed again over its VideoBase (which could bring back labels removed since).
+    Kept as <journal>.replayed.
+    """
+    path = Path(path)
+    retired = path.with_name(f'{path.name}.replayed')
+    os.replace(path, retired)
+    return retired
+
+
+def read_journal(path: Union[Path, str]) -> Iterator[AnnotationEvent]:
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield AnnotationEvent.parse_raw(line)
+            except ValueError:
+                # Line truncated by a crash
+                continue
+
+
+def _apply(segment: Segment, event: AnnotationEvent) -> bool:
+    if event.op == ADD:
+        crud.create_annotation(segment, event.user, event.date, event.label)
+    elif event.op == REMOVE:
+        crud.remove_annotation(segment, event.user, event.label)
+    else:
+        return False
+    return True
+
+
+def replay(vb: VideoBase, events: Iterator[AnnotationEvent]) -> int:
+    """Apply journal events to a VideoBase. Return the number of events applied."""
+    find_segment = getattr(vb, 'find_segment', None)
+    if find_segment is None:
+        find_segment = {seg.uid: seg for seg in vb.segments}.get
+    n_applied = 0
+    for ev in events:
+        seg = find_segment(ev.uid)
+        if seg is not None and _apply(seg, ev):
+            n_applied += 1
+    return n_applied
+
+
+def replay_stream(segments: Iterable[Segment],
+                  events: Iterator[AnnotationEvent]) -> Iterator[Segment]:
+    """Apply journal events to segments as they are read, see stream.VideoBaseStream."""
+    by_uid: Dict[str, List[AnnotationEvent]] = {}
+    for ev in events:
+        by_uid.setdefault(ev.uid, []).append(ev)
+    for seg in segments:
+        for ev in by_uid.get(seg.uid, ()):
+            _apply(seg, ev)
+        yield seg
@@ -0,0 +1,152 @@
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from core.models import VideoBase
+
+
+class LabelIndex:
+    """
+    Columnar index of the labels of a VideoBase, for vectorized queries.
+
+    Stores, for each segment, label and user, the number of annotations (one per user
+    and date) of the segment by that user having the label. Rows follow the order of
+    vb.segments, and segments are referred to by row: uids need not be unique. Built once
+    at load, then kept up to date by the crud functions.
+
+    counts is a view on a larger array: the label and user axes double their capacity
+    when full, so that new labels and users do not copy the whole array each time.
+
+    Parameters
+    ----------
+    vb: VideoBase, optional
+    """
+
+    def __init__(self, vb: Optional[VideoBase] = None) -> None:
+        self.labels: List[str] = []
+        self.columns: Dict[str, int] = {}
+        self.users: List[str] = []
+        self.user_ids: Dict[str, int] = {}
+        # segments x label capacity x user capacity, see counts
+        self._counts = np.zeros((0, 0, 0), dtype=np.uint16)
+        # Number of annotations (labelled or not) of each segment
+        self.n_annotations = np.zeros(0, dtype=np.int32)
+        if vb is not None:
+            self.build(vb)
+
+    def __len__(self):
+        return len(self.n_annotations)
+
+    @property
+    def counts(self) -> np.ndarray:
+        "segments x labels x users"
+        return self._counts[:, :len(self.labels), :len(self.users)]
+
+    @counts.setter
+    def counts(self, value: np.ndarray):
+        self._counts = value
+
+    def _reserve(self, n_labels: int, n_users: int):
+        "Make room for n_labels labels and n_users users."
+        n_rows, label_cap, user_cap = self._counts.shape
+        if n_labels <= label_cap and n_users <= user_cap:
+            return
+        if n_labels > label_cap:
+            label_cap = max(n_labels, 2 * label_cap, 4)
+        if n_users > user_cap:
+            user_cap = max(n_users, 2 * user_cap, 4)
+        counts = np.zeros((n_rows, label_cap, user_cap), dtype=self._counts.dtype)
+        counts[:, :len(self.labels), :len(self.users)] = self.counts
+        self._counts = counts
+
+    def build(self, vb: VideoBase):
+        rows, cols, users = [], [], []
+        self.n_annotations = np.zeros(len(vb.segments), dtype=np.int32)
+        for row, seg in enumerate(vb.segments):
+            self.n_annotations[row] = len(seg.annotations)
+            for an in seg.annotations:
+                user = self._user_id(an.user, grow=False)
+                for label in set(an.labels):
+                    rows.append(row)
+                    cols.append(self._column(label, grow=False))
+                    users.append(user)
+        self.counts = np.zeros((len(vb.segments), len(self.labels), len(self.users)),
+                               dtype=np.uint16)
+        np.add.at(self.counts, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp),
+                                np.array(users, dtype=np.intp)), 1)
+
+    def _column(self, label: str, grow: bool = True) -> int:
+        col = self.columns.get(label)
+        if col is None:
+            col = len(self.labels)
+            if grow:
+                self._reserve(col + 1, len(self.users))
+            self.labels.append(label)
+            self.columns[label] = col
+        return col
+
+    def _user_id(self, user: str, grow: bool = True) -> int:
+        ix = self.user_ids.get(user)
+        if ix is None:
+            ix = len(self.users)
+            if grow:
+                self._reserve(len(self.labels), ix + 1)
+            self.users.append(user)
+            self.user_ids[user] = ix
+        return ix
+
+    # Incremental updates by row, see crud.create_annotation / remove_annotation
+    def annotation_added(self, row: int):
+        self.n_annotations[row] += 1
+
+    def label_added(self, row: int, user: str, label: str):
+        col, user_id = self._column(label), self._user_id(user)
+        self.counts[row, col, user_id] += 1
+
+    def label_removed(self, row: int, user: str, label: str):
+        if label not in self.columns or user not in self.user_ids:
+            return
+        ix = (row, self.columns[label], self.user_ids[user])
+        if self.counts[ix] > 0:
+            self.counts[ix] -= 1
+
+    def rebuild_labels(self, vb: VideoBase, labels: List[str],
+                       rows: Optional[Iterable[int]] = None):
+        """Recompute the columns of some labels from the VideoBase, for some rows or all."""
+        cols = [self._column(label) for label in labels]
+        col_of = dict(zip(labels, cols))
+        rows = range(len(self)) if rows is None else sorted(set(rows))
+        for row in rows:
+            self.counts[row, cols, :] = 0
+            for an in vb.segments[row].annotations:
+                for label in set(an.labels):
+                    col = col_of.get(label)
+                    if col is not None:
+                        user_id = self._user_id(an.user)
+                        self.counts[row, col, user_id] += 1
+
+    # Queries
+    def label_matrix(self, user: Optional[str] = None) -> np.ndarray:
+        """Boolean segments x labels matrix, for all users or for a single one."""
+        if user is None:
+            return self.counts.any(axis=2)
+        if user not in self.user_ids:
+            return np.zeros(self.counts.shape[:2], dtype=bool)
+        return self.counts[:, :, self.user_ids[user]] > 0
+
+    def has_annotations(self, user: Optional[str] = None) -> np.ndarray:
+        "Boolean vector indicating if the segments are annotated (by user if provided)."
+        if user is None:
+            return self.n_annotations > 0
+        return self.label_matrix(user).any(axis=1)
+
+    def label_in_segments(self, labels: Iterable[str], user: Optional[str] = None) -> np.ndarray:
+        "Boolean vector indicating if the segments have any of the input labels."
+        if isinstance(labels, str):
+            labels = [labels]
+        cols = [self.columns[label] for label in labels if label in self.columns]
+        if len(cols) == 0:
+            return np.zeros(len(self), dtype=bool)
+        return self.label_matrix(user)[:, cols].any(axis=1)
+
+    def label_counts(self, user: Optional[str] = None) -> Dict[str, int]:
+        "Number of segments having each label."
+        return dict(zip(self.labels, self.label_matrix(user).sum(axis=0).tolist()))
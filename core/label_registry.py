@@ -0,0 +1,94 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from core.models import AllGroups, Category
+
+
+class LabelRegistry:
+    """
+    Ordered list of categories, with dict indexes by category name and by label.
+
+    Behaves like the List[Category] it wraps (iteration, len, indexing, in, append) and keeps
+    the order of the labels file. The crud functions taking a list of categories use the
+    indexes when given a LabelRegistry. Labels of the categories should be modified through
+    the registry (add_label) or crud.relabel, which also rewrites the annotations, or
+    reindex called afterwards.
+
+    Parameters
+    ----------
+    categories: Iterable[Category]
+    """
+
+    def __init__(self, categories: Iterable[Category] = ()) -> None:
+        self._categories: List[Category] = []
+        self._by_name: Dict[str, int] = {}
+        self._by_label: Dict[str, int] = {}
+        for cat in categories:
+            self.append(cat)
+
+    @classmethod
+    def from_groups(cls, groups: AllGroups) -> 'LabelRegistry':
+        return cls(groups.groups)
+
+    def to_groups(self) -> AllGroups:
+        return AllGroups(groups=list(self._categories))
+
+    def __iter__(self) -> Iterator[Category]:
+        return iter(self._categories)
+
+    def __len__(self):
+        return len(self._categories)
+
+    def __getitem__(self, ix: int) -> Category:
+        return self._categories[ix]
+
+    def __setitem__(self, ix: int, cat: Category):
+        self._categories[ix] = cat
+        self.reindex()
+
+    def __contains__(self, cat: Category) -> bool:
+        "Category membership, as for the list. See has_category and has_label for names."
+        return cat in self._categories
+
+    def has_category(self, name: str) -> bool:
+        return name in self._by_name
+
+    def has_label(self, label: str) -> bool:
+        return label in self._by_label
+
+    def append(self, cat: Category):
+        ix = len(self._categories)
+        self._categories.append(cat)
+        self._by_name.setdefault(cat.name, ix)
+        for label in cat.labels:
+            # A label listed in several categories belongs to the first one
+            self._by_label.setdefault(label, ix)
+
+    def reindex(self):
+        categories = self._categories
+        self._categories, self._by_name, self._by_label = [], {}, {}
+        for cat in categories:
+            self.append(cat)
+
+    def find_category(self, name: str) -> Optional[Tuple[int, Category]]:
+        ix = self._by_name.get(name)
+        if ix is None:
+            return None
+        return ix, self._categories[ix]
+
+    def find_label_category(self, label: str) -> Optional[Tuple[int, Category]]:
+        ix = self._by_label.get(label)
+        if ix is None:
+            return None
+        return ix, self._categories[ix]
+
+    def add_label(self, category: str, label: str):
+        """Add a label to a category, created if needed. Labels are not duplicated."""
+        match = self.find_category(category)
+        if match is None:
+            self.append(Category(name=category, labels=[label]))
+            return
+        ix, cat = match
+        label_ix = self._by_label.get(label)
+        if label_ix == ix or (label_ix is not None and label in cat.labels):
+            return
+        cat.labels.append(label)
+        self._by_label.setdefault(label, ix)
@@ -0,0 +1,138 @@
+import argparse
+import csv
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+from pydantic import BaseModel
+from core import crud
+from core.journal import journal_path, read_journal, replay_stream
+from core.models import Segment, VideoBase
+from core.stream import VideoBaseStream, VideoBaseWriter
+
+LATEST = 'latest'
+FIRST = 'first'
+UNION = 'union'
+
+
+class MergeConflict(BaseModel):
+    uid: str
+    user: str
+    date: str
+    # Labels in the merged base, and in the snapshot being added
+    merged: List[str]
+    other: List[str]
+    source: str
+
+
+class SnapshotMerger:
+    """
+    Merge VideoBase snapshots, one at a time, into a single VideoBase.
+
+    Segments are matched by uid, their annotations by (user, date). Segments and
+    annotations missing from the merged base are added to it. An annotation present in
+    both with different labels is a conflict, resolved according to on_conflict. Only the
+    merged base is kept in memory: snapshots can be added segment by segment, see
+    add_segments and stream.VideoBaseStream.
+
+    Parameters
+    ----------
+    on_conflict: str
+        'latest': keep the labels of the snapshot added last
+        'first': keep the labels of the snapshot added first
+        'union': keep the labels found in either
+    """
+
+    def __init__(self, on_conflict: str = LATEST) -> None:
+        if on_conflict not in (LATEST, FIRST, UNION):
+            raise ValueError(f'Unknown conflict resolution {on_conflict}')
+        self.on_conflict = on_conflict
+        self.segments: Dict[str, Segment] = {}
+        self.notes: Optional[str] = None
+        self.conflicts: List[MergeConflict] = []
+        # Segments with the same uid but different videos or frames, first one kept
+        self.mismatches: List[str] = []
+        self.n_snapshots = 0
+        self.n_added = 0
+
+    def add(self, vb: VideoBase, source: str = ''):
+        self.add_segments(vb.segments, source, vb.notes)
+
+    def add_segments(self, segments: Iterable[Segment], source: str = '',
+                     notes: Optional[str] = None):
+        for seg in segments:
+            merged = self.segments.get(seg.uid)
+            if merged is None:
+                # Adopted as is, the rest of the snapshot can be freed
+                self.segments[seg.uid] = seg
+                continue
+            if merged.files != seg.files or merged.frames != seg.frames:
+                self.mismatches.append(seg.uid)
+            for an in seg.annotations:
+                m_an = merged.find_annotation(an.user, an.date)
+                if m_an is None:
+                    merged.add_annotation(an)
+                    self.n_added += 1
+                elif set(m_an.labels) != set(an.labels):
+                    self.conflicts.append(MergeConflict(uid=seg.uid, user=an.user,
+                                                        date=an.date, merged=m_an.labels,
+                                                        other=an.labels, source=source))
+                    if self.on_conflict == LATEST:
+                        m_an.labels = list(an.labels)
+                    elif self.on_conflict == UNION:
+                        m_an.labels += [lb for lb in an.labels if lb not in m_an.labels]
+        if self.notes is None:
+            self.notes = notes
+        self.n_snapshots += 1
+
+    def result(self) -> VideoBase:
+        return crud._unvalidated(VideoBase, dict(segments=list(self.segments.values()),
+                                                 notes=self.notes))
+
+
+def write_conflicts(conflicts: List[MergeConflict], path: Union[Path, str]):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['uid', 'user', 'date', 'merged', 'other', 'source'])
+        for c in conflicts:
+            writer.writerow([c.uid, c.user, c.date, ';'.join(c.merged), ';'.join(c.other),
+                             c.source])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Merge VideoBase snapshots written by several annotators into one.')
+    parser.add_argument('snapshots', nargs='+', help='VideoBase json files')
+    parser.add_argument('-o', '--output', required=True, help='Merged VideoBase file')
+    parser.add_argument('--on-conflict', choices=[LATEST, FIRST, UNION], default=LATEST,
+                        help='Labels kept when an annotation (user, date) differs between '
+                             'snapshots (default: latest)')
+    parser.add_argument('--keep-order', action='store_true',
+                        help='Merge in the given order instead of by modification time')
+    parser.add_argument('--conflicts', default=None, help='Write the conflicts to a csv file')
+    args = parser.parse_args()
+
+    paths = args.snapshots
+    if not args.keep_order:
+        paths = sorted(paths, key=os.path.getmtime)
+    merger = SnapshotMerger(args.on_conflict)
+    for ix, path in enumerate(paths):
+        stream = VideoBaseStream(path)
+        segments = iter(stream)
+        journal = journal_path(path)
+        if journal.exists():
+            segments = replay_stream(segments, read_journal(journal))
+        n_conflicts = len(merger.conflicts)
+        merger.add_segments(segments, source=path)
+        if merger.notes is None:
+            merger.notes = stream.notes
+        print(f'[{ix + 1}/{len(paths)}] {path}: {stream.n_segments} segments, '
+              f'{len(merger.conflicts) - n_conflicts} conflicts')
+    print(f'{len(merger.segments)} segments, {merger.n_added} annotations added, '
+          f'{len(merger.conflicts)} conflicts ({args.on_conflict} kept), '
+          f'{len(merger.mismatches)} segments with different videos or frames')
+    if args.conflicts is not None:
+        write_conflicts(merger.conflicts, args.conflicts)
+
+    with VideoBaseWriter(args.output, merger.notes) as writer:
+        writer.write_all(merger.segments.values())
+    print(f'Written to {args.output}')
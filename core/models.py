@@ -1,5 +1,5 @@
-from typing import List, Optional
-from pydantic import BaseModel, root_validator, ValidationError
+from typing import Dict, List, Optional, Tuple
+from pydantic import BaseModel, PrivateAttr, root_validator, ValidationError
 
 
 class Frames(BaseModel):
@@ -33,6 +33,37 @@ class Segment(BaseModel):
     files: List[str]
     frames: Frames
     annotations: List[Annotation]
+    # Annotations by user (first one of each user) and by (user, date), built when needed
+    _by_user: Dict[str, Annotation] = PrivateAttr(default_factory=dict)
+    _by_user_date: Dict[Tuple[str, str], Annotation] = PrivateAttr(default_factory=dict)
+    _indexed: Optional[List[Annotation]] = PrivateAttr(default=None)
+    _n_indexed: int = PrivateAttr(default=0)
+
+    def _index_annotations(self):
+        "(Re)build the annotation lookups if the annotation list was replaced or resized."
+        if self._indexed is self.annotations and self._n_indexed == len(self.annotations):
+            return
+        self._by_user, self._by_user_date = {}, {}
+        for an in self.annotations:
+            self._by_user.setdefault(an.user, an)
+            self._by_user_date.setdefault((an.user, an.date), an)
+        self._indexed = self.annotations
+        self._n_indexed = len(self.annotations)
+
+    def find_annotation(self, user: str, date: Optional[str] = None) -> Optional[Annotation]:
+        "Annotation of a user on a date, or first annotation of the user if date is None."
+        self._index_annotations()
+        if date is None:
+            return self._by_user.get(user)
+        return self._by_user_date.get((user, date))
+
+    def add_annotation(self, an: Annotation):
+        "Append an annotation, keeping the lookups up to date."
+        self._index_annotations()
+        self.annotations.append(an)
+        self._by_user.setdefault(an.user, an)
+        self._by_user_date.setdefault((an.user, an.date), an)
+        self._n_indexed += 1
     
     def has_annotations(self) -> bool:
         "Return True the segment has annotations."
@@ -0,0 +1,70 @@
+import math
+from typing import List, Optional, Tuple
+import numpy as np
+from core.frame_format import PIX_FMTS, FrameFormat
+
+
+def grid_shape(n_cells: int) -> Tuple[int, int]:
+    "Number of rows and columns of the most square grid with n_cells cells."
+    n_cols = max(1, math.ceil(math.sqrt(n_cells)))
+    return max(1, math.ceil(n_cells / n_cols)), n_cols
+
+
+class Mosaic:
+    """
+    Compose the frames of several cameras into a single image, in a grid.
+
+    Each frame is centered in its cell. Frames should be decoded to cell_format, so that
+    composing is only a copy: larger frames are subsampled to fit, which is faster but
+    uglier than letting the decoder scale them.
+
+    Parameters
+    ----------
+    width: int
+    height: int
+        Size of the composed image
+    n_cameras: int
+    pix_fmt: str
+        One of frame_format.PIX_FMTS
+    spacing: int
+        Pixels between the cells
+    """
+
+    def __init__(self, width: int, height: int, n_cameras: int, pix_fmt: str = 'rgb24',
+                 spacing: int = 2) -> None:
+        self.width = width
+        self.height = height
+        self.n_cameras = n_cameras
+        self.pix_fmt = pix_fmt
+        self.spacing = spacing
+        self.n_rows, self.n_cols = grid_shape(n_cameras)
+        self.cell_width = max(2, (width - spacing * (self.n_cols - 1)) // self.n_cols)
+        self.cell_height = max(2, (height - spacing * (self.n_rows - 1)) // self.n_rows)
+
+    def cell_format(self) -> FrameFormat:
+        return FrameFormat(self.cell_width, self.cell_height, self.pix_fmt)
+
+    def cell_origin(self, camera_ix: int) -> Tuple[int, int]:
+        "Row and column of the top left pixel of the cell of a camera."
+        row, col = divmod(camera_ix, self.n_cols)
+        return row * (self.cell_height + self.spacing), col * (self.cell_width + self.spacing)
+
+    def compose(self, frames: List[Optional[np.ndarray]]) -> np.ndarray:
+        "Image with the frames of the cameras, None frames leave their cell black."
+        n_channels = PIX_FMTS[self.pix_fmt]
+        shape = (self.height, self.width) if n_channels == 1 else (self.height, self.width,
+                                                                   n_channels)
+        # A new image each time, the previous one might still be displayed
+        image = np.zeros(shape, dtype=np.uint8)
+        for camera_ix, frame in enumerate(frames[:self.n_rows * self.n_cols]):
+            if frame is None:
+                continue
+            step = max(math.ceil(frame.shape[0] / self.cell_height),
+                       math.ceil(frame.shape[1] / self.cell_width))
+            if step > 1:
+                frame = frame[::step, ::step]
+            top, left = self.cell_origin(camera_ix)
+            top += (self.cell_height - frame.shape[0]) // 2
+            left += (self.cell_width - frame.shape[1]) // 2
+            image[top:top + frame.shape[0], left:left + frame.shape[1]] = frame
+        return image
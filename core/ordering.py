@@ -0,0 +1,252 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Union
+import numpy as np
+from pydantic import BaseModel
+from core.label_index import LabelIndex
+
+
+class OrderStrategy(ABC):
+    """
+    Criterion of a SegmentOrder: segments with the lowest keys come first.
+
+    keys is vectorized over rows of the LabelIndex. Strategies whose keys depend on the
+    annotations are recomputed by SegmentOrder.update.
+    """
+    def prepare(self, index: LabelIndex, random_keys: np.ndarray):
+        "Called once with the index and the random tie-break keys of the order."
+        pass
+
+    @abstractmethod
+    def keys(self, index: LabelIndex, rows: np.ndarray) -> np.ndarray:
+        pass
+
+
+class UnlabelledFirst(OrderStrategy):
+    "Segments without annotations (by user if provided) first."
+    def __init__(self, user: Optional[str] = None) -> None:
+        self.user = user
+
+    def keys(self, index: LabelIndex, rows: np.ndarray) -> np.ndarray:
+        return index.has_annotations(self.user)[rows].astype(np.int64)
+
+
+class LabelsFirst(OrderStrategy):
+    "Segments with any of the labels first."
+    def __init__(self, labels: Sequence[str], user: Optional[str] = None) -> None:
+        self.labels = list(labels)
+        self.user = user
+
+    def keys(self, index: LabelIndex, rows: np.ndarray) -> np.ndarray:
+        return (~index.label_in_segments(self.labels, self.user))[rows].astype(np.int64)
+
+
+class LeastAnnotatedFirst(OrderStrategy):
+    "Segments with the fewest labels given by the user first."
+    def __init__(self, user: str) -> None:
+        self.user = user
+
+    def keys(self, index: LabelIndex, rows: np.ndarray) -> np.ndarray:
+        user_id = index.user_ids.get(self.user)
+        if user_id is None:
+            return np.zeros(len(rows), dtype=np.int64)
+        return (index.counts[rows, :, user_id] > 0).sum(axis=1).astype(np.int64)
+
+
+class Stratified(OrderStrategy):
+    """
+    Alternate between groups of segments (e.g. subjects or sessions): the first segment of
+    each group, then the second of each group, and so on. Segments are drawn at random
+    in each group.
+
+    Parameters
+    ----------
+    groups: np.ndarray
+        Integer code of the group of each row of the LabelIndex, see strata
+    """
+    def __init__(self, groups: np.ndarray) -> None:
+        self.groups = np.asarray(groups, dtype=np.int64)
+        self._rank = np.zeros(len(self.groups), dtype=np.int64)
+
+    def prepare(self, index: LabelIndex, random_keys: np.ndarray):
+        # Rank of each segment in its group, in random order
+        order = np.lexsort((random_keys, self.groups))
+        sorted_groups = self.groups[order]
+        starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        group_start = np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        self._rank[order] = np.arange(len(order)) - group_start
+
+    def keys(self, index: LabelIndex, rows: np.ndarray) -> np.ndarray:
+        return self._rank[rows]
+
+
+class SegmentOrder:
+    """
+    Order in which the segments are shown, sorted by the keys of a list of strategies,
+    then at random with a seeded generator: the same seed and annotations give the
+    same order.
+
+    Segments before position were already shown and never move. update re-sorts the
+    segments after it when their annotations changed, without recomputing the others.
+
+    Parameters
+    ----------
+    index: LabelIndex
+    strategies: List[OrderStrategy]
+        Sorted by the first one, then the second one for equal keys, ...
+    seed: int, optional
+        Drawn at random if None, see the seed attribute
+    """
+
+    def __init__(self, index: LabelIndex, strategies: Iterable[OrderStrategy] = (),
+                 seed: Optional[int] = None) -> None:
+        self.index = index
+        self.strategies = list(strategies)
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2 ** 32)
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        rows = np.arange(len(index))
+        self.random_keys = rng.random(len(index))
+        for strategy in self.strategies:
+            strategy.prepare(index, self.random_keys)
+        # strategies x segments, plus the random keys
+        self.keys = np.vstack([s.keys(index, rows) for s in self.strategies]
+                              + [self.random_keys]) if len(index) else np.zeros((1, 0))
+        self.order = np.lexsort(self.keys[::-1]) if len(index) else np.zeros(0, dtype=np.intp)
+        self.position = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, pos: int) -> int:
+        return self.order[pos]
+
+    @property
+    def shown(self) -> np.ndarray:
+        "Rows of the segments up to position, in order."
+        return self.order[:self.position + 1]
+
+    def restore(self, shown: Sequence[int]):
+        """
+        Show these rows first, in this order, as saved from shown. The other segments
+        keep their order after them.
+        """
+        shown = np.asarray(shown, dtype=self.order.dtype)
+        self.order = np.r_[shown, self.order[~np.isin(self.order, shown)]]
+        self.position = max(len(shown) - 1, 0)
+
+    def update(self, rows: Optional[Iterable[int]] = None):
+        """
+        Recompute the keys of some rows (or all the ones not shown yet) and move them
+        accordingly among the segments after position.
+        """
+        if len(self.strategies) == 0:
+            return
+        start = self.position + 1
+        if rows is None:
+            tail = self.order[start:]
+            for level, strategy in enumerate(self.strategies):
+                self.keys[level, tail] = strategy.keys(self.index, tail)
+            self.order[start:] = tail[np.lexsort(self.keys[::-1, tail])]
+            return
+        for row in rows:
+            for level, strategy in enumerate(self.strategies):
+                self.keys[level, row] = strategy.keys(self.index, np.array([row]))[0]
+            pos = int(np.flatnonzero(self.order == row)[0])
+            if pos < start:
+                continue
+            tail = np.delete(self.order[start:], pos - start)
+            # First segment of the tail coming after row, lexicographically
+            key = self.keys[:, row]
+            after = np.zeros(len(tail), dtype=bool)
+            equal = np.ones(len(tail), dtype=bool)
+            for level in range(len(key)):
+                after |= equal & (self.keys[level, tail] > key[level])
+                equal &= self.keys[level, tail] == key[level]
+            insert_at = int(np.argmax(after)) if after.any() else len(tail)
+            self.order[start:] = np.insert(tail, insert_at, row)
+
+
+class OrderState(BaseModel):
+    """
+    What is needed to rebuild and resume an order, see load_order_state.
+
+    The segments already shown are stored as is: the order of the others depends on the
+    annotations for most strategies, rebuilding it from the seed would move the segments
+    annotated since then.
+    """
+    seed: int
+    strategy: str
+    # Rows of the segments shown (see SegmentOrder.shown) and position of the current one
+    shown: List[int] = []
+    current: int = 0
+    # Rows are only valid for a VideoBase with the same number of segments
+    n_segments: Optional[int] = None
+
+
+def order_state_path(vb_path: Union[Path, str]) -> Path:
+    vb_path = Path(vb_path)
+    return vb_path.with_name(f'{vb_path.stem}.order.json')
+
+
+def load_order_state(vb_path: Union[Path, str]) -> Optional[OrderState]:
+    path = order_state_path(vb_path)
+    if not path.exists():
+        return None
+    return OrderState.parse_file(path)
+
+
+def strata(vb, field: str) -> np.ndarray:
+    """Group of each segment for a Stratified strategy, by 'subject' or 'session'."""
+    from core.compact import CompactVideoBase
+    if isinstance(vb, CompactVideoBase):
+        subjects = vb.codes['subject'].astype(np.int64)
+        if field == 'subject':
+            return subjects
+        return subjects * (int(vb.codes['session'].max(initial=0)) + 1) + vb.codes['session']
+    if field == 'subject':
+        keys = [seg.subject for seg in vb.segments]
+    else:
+        keys = [(seg.subject, seg.session) for seg in vb.segments]
+    codes: dict = {}
+    return np.array([codes.setdefault(key, len(codes)) for key in keys], dtype=np.int64)
+
+
+DEFAULT = 'default'
+RANDOM = 'random'
+BY_SUBJECT = 'stratified-subject'
+BY_SESSION = 'stratified-session'
+LEAST_ANNOTATED = 'least-annotated'
+STRATEGIES = (DEFAULT, RANDOM, BY_SUBJECT, BY_SESSION, LEAST_ANNOTATED)
+
+
+def build_order(name: str, vb, index: LabelIndex, user: Optional[str] = None,
+                labels: Sequence[str] = (), seed: Optional[int] = None) -> SegmentOrder:
+    """
+    SegmentOrder for one of the STRATEGIES.
+
+    Parameters
+    ----------
+    name: str
+        'default': segments with any of labels first, or unlabelled segments first if no
+        labels are given. 'random'. 'stratified-subject' / 'stratified-session':
+        alternate between subjects / sessions. 'least-annotated': segments with the
+        fewest labels from user first.
+    vb: VideoBase or CompactVideoBase
+    index: LabelIndex
+    user: str, optional
+    labels: Sequence[str]
+    seed: int, optional
+    """
+    if name == DEFAULT:
+        strategies = [LabelsFirst(labels)] if len(labels) else [UnlabelledFirst()]
+    elif name == RANDOM:
+        strategies = []
+    elif name in (BY_SUBJECT, BY_SESSION):
+        strategies = [Stratified(strata(vb, name.split('-')[1]))]
+    elif name == LEAST_ANNOTATED:
+        strategies = [LeastAnnotatedFirst(user)]
+    else:
+        raise ValueError(f'Unknown order {name}, expected one of {STRATEGIES}')
+    return SegmentOrder(index, strategies, seed)
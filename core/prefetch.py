@@ -0,0 +1,180 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+import numpy as np
+from core.decoder import DecoderBackend, PyAVDecoder
+from core.frame_cache import FrameCache
+from core.frame_format import FULL, FrameFormat, read_frame
+from core.models import VideoBase
+
+
+class VideoPool:
+    """
+    Least recently used set of opened videos, shared by the reader and the prefetcher.
+
+    A video is either idle in the pool, being opened (and pre-decoded) in the background
+    or acquired by a decoding worker, never used by two threads at once.
+    Idle videos are closed when more than max_open files are opened.
+    The pre-decoded frames are stored in the frame cache, if any.
+
+    Parameters
+    ----------
+    max_open: int
+        Maximum number of opened video files
+    cache: FrameCache, optional
+        Where the pre-decoded frames are stored. Without it, videos are only opened.
+    n_threads: int
+        Number of background threads opening the videos
+    open_video: Callable[[str], DecoderBackend]
+        Opens a video file, see core.decoder.BACKENDS
+    """
+
+    def __init__(self, max_open: int = 32, cache: Optional[FrameCache] = None,
+                 n_threads: int = 2, open_video: Callable[[str], DecoderBackend] = PyAVDecoder) -> None:
+        self.max_open = max_open
+        self.cache = cache
+        self.open_video = open_video
+        self._lock = threading.Lock()
+        self._idle: 'OrderedDict[str, DecoderBackend]' = OrderedDict()
+        self._in_use: Dict[str, int] = {}
+        self._opening: Dict[str, Future] = {}
+        self._wanted: set = set()
+        self._executor = ThreadPoolExecutor(n_threads, thread_name_prefix='prefetch')
+
+    @property
+    def n_open(self) -> int:
+        return len(self._idle) + sum(self._in_use.values()) + len(self._opening)
+
+    def acquire(self, path: str) -> DecoderBackend:
+        """Return an opened video, waiting for it if it is being prefetched."""
+        with self._lock:
+            future = self._opening.get(path)
+        if future is not None:
+            future.result()
+        with self._lock:
+            video = self._idle.pop(path, None)
+            self._in_use[path] = self._in_use.get(path, 0) + 1
+        if video is None:
+            video = self.open_video(path)
+        return video
+
+    def release(self, path: str, video: DecoderBackend):
+        """Give back a video acquired with acquire."""
+        with self._lock:
+            self._in_use[path] -= 1
+            if self._in_use[path] == 0:
+                del self._in_use[path]
+            if path in self._idle:
+                # Another copy was opened meanwhile
+                to_close = [video]
+            else:
+                self._idle[path] = video
+                to_close = self._evict()
+        for vid in to_close:
+            vid.close()
+
+    def _evict(self) -> List[DecoderBackend]:
+        "Pop the least recently used idle videos above max_open. Call with the lock."
+        to_close = []
+        while self._idle and self.n_open > self.max_open:
+            _, video = self._idle.popitem(last=False)
+            to_close.append(video)
+        return to_close
+
+    def prefetch(self, path: str, begin: int = 0, n_frames: int = 0, fmt: FrameFormat = FULL):
+        """Open a video, and decode its first n_frames from begin, in the background."""
+        if self.cache is None:
+            n_frames = 0
+        with self._lock:
+            self._wanted.add(path)
+            if path in self._opening or path in self._in_use:
+                return
+            if path in self._idle:
+                self._idle.move_to_end(path)
+                if n_frames == 0 or (path, begin, fmt) in self.cache:
+                    return
+            self._opening[path] = self._executor.submit(self._open, path, begin, n_frames, fmt)
+
+    def _open(self, path: str, begin: int, n_frames: int, fmt: FrameFormat):
+        try:
+            with self._lock:
+                is_wanted = path in self._wanted
+                video = self._idle.pop(path, None)
+            if not is_wanted:
+                # Navigation moved on before this task started
+                if video is not None:
+                    self._release_prefetched(path, video)
+                return
+            if video is None:
+                video = self.open_video(path)
+            for frame_ix in range(begin, min(begin + n_frames, len(video))):
+                if (path, frame_ix, fmt) not in self.cache:
+                    self.cache.put(path, frame_ix, read_frame(video, frame_ix, fmt), fmt)
+            self._release_prefetched(path, video)
+        finally:
+            with self._lock:
+                self._opening.pop(path, None)
+
+    def _release_prefetched(self, path: str, video: DecoderBackend):
+        with self._lock:
+            if path in self._idle:
+                to_close = [video]
+            else:
+                self._idle[path] = video
+                to_close = self._evict()
+        for vid in to_close:
+            vid.close()
+
+    def set_wanted(self, paths: Iterable[str]):
+        "Paths still worth prefetching, pending tasks for the other ones are skipped."
+        with self._lock:
+            self._wanted = set(paths)
+
+    def close(self):
+        # Pending tasks are skipped once nothing is wanted anymore
+        self.set_wanted([])
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            to_close = list(self._idle.values())
+            self._idle.clear()
+        for vid in to_close:
+            vid.close()
+
+
+class SegmentPrefetcher:
+    """
+    Open in advance the videos of the segments surrounding the current one.
+
+    Follows the order array built by crud.create_order: the n_next following segments
+    and the n_prev previous ones are opened, and their first n_frames decoded.
+
+    Parameters
+    ----------
+    pool: VideoPool
+    n_next: int
+    n_prev: int
+    n_frames: int
+        Number of frames decoded in advance at the beginning of each segment
+    fmt: FrameFormat
+        Format of the decoded frames, the one played by the VideoReader
+    """
+
+    def __init__(self, pool: VideoPool, n_next: int = 2, n_prev: int = 1,
+                 n_frames: int = 8, fmt: FrameFormat = FULL) -> None:
+        self.pool = pool
+        self.n_next = n_next
+        self.n_prev = n_prev
+        self.n_frames = n_frames
+        self.fmt = fmt
+
+    def update(self, vb: VideoBase, order: np.ndarray, seg_ix: int):
+        """Prefetch around position seg_ix of order. Closest segments first."""
+        positions = [seg_ix + k for k in range(1, self.n_next + 1)]
+        positions += [seg_ix - k for k in range(1, self.n_prev + 1)]
+        segments = [vb.segments[order[pos]] for pos in positions if 0 <= pos < len(order)]
+        current = vb.segments[order[seg_ix]]
+        self.pool.set_wanted(f for seg in [current] + segments for f in seg.files)
+        for seg in segments:
+            for vf in seg.files:
+                self.pool.prefetch(vf, seg.frames.begin, self.n_frames, self.fmt)
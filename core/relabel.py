@@ -0,0 +1,107 @@
+import argparse
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+from core import crud
+from core.journal import journal_path, read_journal, replay_stream
+from core.models import Segment
+from core.snapshot_writer import SnapshotWriter
+from core.stream import VideoBaseStream, VideoBaseWriter
+
+
+def parse_mapping(renames: List[str], deletions: List[str],
+                  mapping_path: Optional[str] = None) -> Dict[str, Optional[str]]:
+    """
+    Build a label mapping from the command line arguments.
+
+    Parameters
+    ----------
+    renames: List[str]
+        OLD=NEW strings. Several labels renamed to the same one are merged
+    deletions: List[str]
+        Labels to delete
+    mapping_path: str, optional
+        Json file with an {old: new} dictionary, null to delete a label
+
+    Returns
+    -------
+    mapping: Dict[str, Optional[str]]
+    """
+    mapping: Dict[str, Optional[str]] = {}
+    if mapping_path is not None:
+        with open(mapping_path) as f:
+            mapping.update(json.load(f))
+    for rename in renames:
+        old, sep, new = rename.partition('=')
+        if not sep or not old or not new:
+            raise ValueError(f'Invalid rename {rename}, expected OLD=NEW')
+        mapping[old] = new
+    for label in deletions:
+        mapping[label] = None
+    return mapping
+
+
+def relabel_stream(segments: Iterable[Segment], mapping: Dict[str, Optional[str]],
+                   counts: Dict[str, int]) -> Iterator[Segment]:
+    """Apply a label mapping to segments as they are read, see crud.relabel."""
+    for seg in segments:
+        crud.relabel_segment(seg, mapping, counts)
+        yield seg
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Rename, merge or delete labels of a VideoBase and of its labels file.')
+    parser.add_argument('videobase', help='VideoBase json file')
+    parser.add_argument('--labels', default=None, help='Labels json file, updated too')
+    parser.add_argument('--rename', nargs='+', default=[], metavar='OLD=NEW',
+                        help='Labels to rename. Labels renamed to the same one are merged')
+    parser.add_argument('--delete', nargs='+', default=[], metavar='LABEL',
+                        help='Labels to delete')
+    parser.add_argument('--mapping', default=None,
+                        help='Json file with an {"old": "new"} mapping, null to delete')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Output VideoBase file (default: overwrite the input)')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the counts')
+    args = parser.parse_args()
+
+    mapping = parse_mapping(args.rename, args.delete, args.mapping)
+    if len(mapping) == 0:
+        parser.error('Nothing to do, use --rename, --delete or --mapping')
+
+    categories = [] if args.labels is None else crud.load_label_registry(args.labels)
+    crud.relabel_categories(categories, mapping)
+    mapping = {old: new for old, new in mapping.items() if old != new}
+    counts = {old: 0 for old in mapping}
+
+    # Segments are read, relabeled and written one at a time
+    stream = VideoBaseStream(args.videobase)
+    journal = journal_path(args.videobase)
+    segments = iter(stream)
+    if journal.exists():
+        segments = replay_stream(segments, read_journal(journal))
+    segments = relabel_stream(segments, mapping, counts)
+    output = Path(args.output or args.videobase)
+    if args.dry_run:
+        for _ in segments:
+            pass
+    else:
+        with VideoBaseWriter(output) as writer:
+            writer.write_all(segments)
+            writer.notes = stream.notes
+    for old, new in mapping.items():
+        action = 'deleted' if new is None else f'-> {new}'
+        print(f'{old} {action}: {counts[old]} annotations')
+    if args.dry_run:
+        raise SystemExit(0)
+
+    if args.labels is not None:
+        writer = SnapshotWriter()
+        writer.submit(args.labels, categories.to_groups().json(indent=2))
+        writer.close()
+        if writer.n_writes == 0:
+            raise SystemExit('Could not write the labels')
+    if output.resolve() == Path(args.videobase).resolve() and journal.exists():
+        # Its changes are now part of the VideoBase
+        journal.unlink()
+    print(f'Written to {output}')
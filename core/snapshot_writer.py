@@ -0,0 +1,122 @@
+import os
+import threading
+import time
+import traceback
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple, Union
+
+Content = Union[bytes, str, Callable[[], str]]
+
+
+class SnapshotWriter:
+    """
+    Write files from a background thread.
+
+    Requests for the same path are coalesced, only the latest one is written. Files are
+    written to a temporary file in the same folder then renamed, so a crash never leaves a
+    truncated file behind.
+
+    The content is either serialized by the caller, or by a function called from the
+    writing thread: the function must then work on a copy of the objects taken by the
+    caller (see crud.videobase_snapshot), so that the snapshot is consistent.
+
+    Attributes
+    ----------
+    last_latency: float
+        Duration of the last serialization (if any) and write, in seconds
+    last_bytes: int
+        Size of the last file written
+    written: Dict[Path, Tuple[float, int]]
+        Duration and size of the last file written at each path
+    n_writes: int
+    n_coalesced: int
+        Number of requests replaced by a newer one before being written
+    """
+
+    def __init__(self) -> None:
+        self._pending: Dict[Path, Tuple[Content, Optional[Callable[[], None]]]] = {}
+        self._cond = threading.Condition()
+        self._busy = False
+        self._running = True
+        self.last_latency = 0.
+        self.last_bytes = 0
+        self.total_bytes = 0
+        self.written: Dict[Path, Tuple[float, int]] = {}
+        self.n_writes = 0
+        self.n_coalesced = 0
+        self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, path: Union[Path, str], data: Content,
+               on_written: Optional[Callable[[], None]] = None):
+        """
+        Request path to be written with data.
+
+        Parameters
+        ----------
+        path: Path or str
+        data: bytes, str or Callable[[], str]
+            Content of the file, str is encoded to utf-8. A function returning it is
+            called from the writing thread, and not at all if a newer request replaces it
+        on_written: Callable[[], None], optional
+            Called from the writing thread once the file was renamed to path
+        """
+        with self._cond:
+            path = Path(path)
+            if path in self._pending:
+                self.n_coalesced += 1
+            self._pending[path] = (data, on_written)
+            self._cond.notify_all()
+
+    def flush(self):
+        """Wait for the pending requests to be written."""
+        with self._cond:
+            while self._pending or self._busy:
+                self._cond.wait()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+                if not self._pending:
+                    break
+                path = next(iter(self._pending))
+                data, on_written = self._pending.pop(path)
+                self._busy = True
+            try:
+                self._write(path, data)
+                if on_written is not None:
+                    on_written()
+            except Exception:
+                print(f'Could not write {path}')
+                traceback.print_exc()
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _write(self, path: Path, data: Content):
+        t_start = time.perf_counter()
+        if callable(data):
+            data = data()
+        if isinstance(data, str):
+            data = data.encode()
+        tmp_path = path.with_name(f'.{path.name}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.last_latency = time.perf_counter() - t_start
+        self.last_bytes = len(data)
+        self.written[path] = (self.last_latency, self.last_bytes)
+        self.total_bytes += len(data)
+        self.n_writes += 1
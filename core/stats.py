@@ -0,0 +1,191 @@
+import argparse
+import csv
+from itertools import combinations
+from pathlib import Path
+from typing import Dict, List, Union
+import numpy as np
+from core import crud
+from core.label_index import LabelIndex
+from core.models import VideoBase
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Tables are dictionaries of columns
+Table = Dict[str, list]
+
+
+def _group_counts(keys: list, matrix: np.ndarray):
+    "Sum the rows of a segments x labels matrix by key. Return the keys and the sums."
+    codes: dict = {}
+    inverse = np.array([codes.setdefault(key, len(codes)) for key in keys], dtype=np.intp)
+    groups = list(codes)
+    sums = np.zeros((len(groups), matrix.shape[1]), dtype=np.int64)
+    np.add.at(sums, inverse, matrix)
+    return groups, sums
+
+
+def _long_table(row_keys: Dict[str, list], labels: List[str], values: np.ndarray) -> Table:
+    "Flatten a groups x labels array of counts into a table, one line per non zero count."
+    rows, cols = np.nonzero(values)
+    table = {name: [keys[r] for r in rows] for name, keys in row_keys.items()}
+    table['label'] = [labels[c] for c in cols]
+    table['n_segments'] = values[rows, cols].tolist()
+    return table
+
+
+class AnnotationStats:
+    """
+    Aggregate statistics of the annotations of a VideoBase, computed on its LabelIndex.
+
+    Parameters
+    ----------
+    vb: VideoBase
+    index: LabelIndex, optional
+        Built from vb if not provided
+    """
+
+    def __init__(self, vb: VideoBase, index: LabelIndex = None) -> None:
+        self.index = LabelIndex(vb) if index is None else index
+        self.subjects = [seg.subject for seg in vb.segments]
+        self.sessions = [(seg.subject, seg.session) for seg in vb.segments]
+        # Segments x users: True if the user annotated the segment, even with no label
+        self.annotated = np.zeros((len(vb.segments), len(self.index.users)), dtype=bool)
+        user_ids = self.index.user_ids
+        for row, seg in enumerate(vb.segments):
+            for an in seg.annotations:
+                self.annotated[row, user_ids[an.user]] = True
+        self.matrix = self.index.label_matrix()
+
+    @property
+    def labels(self) -> List[str]:
+        return self.index.labels
+
+    def summary(self) -> Table:
+        return {'n_segments': [len(self.index)],
+                'n_annotated': [int(self.annotated.any(axis=1).sum())],
+                'n_users': [len(self.index.users)],
+                'n_labels': [int(self.matrix.any(axis=0).sum())]}
+
+    def label_counts(self) -> Table:
+        "Number of segments having each label, for any user."
+        return _long_table({}, self.labels, self.matrix.sum(axis=0, keepdims=True))
+
+    def user_counts(self) -> Table:
+        "Number of segments annotated with each label by each user."
+        users = self.index.users
+        values = self.index.counts.astype(bool).sum(axis=0).T
+        return _long_table({'user': users}, self.labels, values)
+
+    def subject_counts(self) -> Table:
+        subjects, sums = _group_counts(self.subjects, self.matrix)
+        return _long_table({'subject': subjects}, self.labels, sums)
+
+    def session_counts(self) -> Table:
+        sessions, sums = _group_counts(self.sessions, self.matrix)
+        return _long_table({'subject': [subject for subject, _ in sessions],
+                            'session': [session for _, session in sessions]},
+                           self.labels, sums)
+
+    def cooccurrence(self) -> Table:
+        "Number of segments having both labels, for each pair of labels (and each label)."
+        matrix = self.matrix.astype(np.int64)
+        co = matrix.T @ matrix
+        rows, cols = np.nonzero(np.triu(co))
+        return {'label_a': [self.labels[r] for r in rows],
+                'label_b': [self.labels[c] for c in cols],
+                'n_segments': co[rows, cols].tolist()}
+
+    def agreement(self) -> Table:
+        """
+        Agreement of each pair of users on each label, over the segments both annotated.
+
+        Observed agreement (fraction of segments where both users agree on the presence of
+        the label) and Cohen's kappa, nan if both users gave the same constant answer.
+        """
+        table: Table = {'user_a': [], 'user_b': [], 'label': [], 'n_segments': [],
+                        'agreement': [], 'kappa': []}
+        users = self.index.users
+        n_labels = len(self.labels)
+        for ua, ub in combinations(range(len(users)), 2):
+            both = self.annotated[:, ua] & self.annotated[:, ub]
+            n_both = int(both.sum())
+            if n_both == 0:
+                continue
+            a = self.index.counts[both, :, ua] > 0
+            b = self.index.counts[both, :, ub] > 0
+            p_obs = (a == b).mean(axis=0)
+            pa, pb = a.mean(axis=0), b.mean(axis=0)
+            p_exp = pa * pb + (1 - pa) * (1 - pb)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                kappa = np.where(p_exp < 1, (p_obs - p_exp) / (1 - p_exp), np.nan)
+            table['user_a'] += [users[ua]] * n_labels
+            table['user_b'] += [users[ub]] * n_labels
+            table['label'] += self.labels
+            table['n_segments'] += [n_both] * n_labels
+            table['agreement'] += p_obs.tolist()
+            table['kappa'] += kappa.tolist()
+        return table
+
+    def tables(self) -> Dict[str, Table]:
+        return {'summary': self.summary(),
+                'labels': self.label_counts(),
+                'users': self.user_counts(),
+                'subjects': self.subject_counts(),
+                'sessions': self.session_counts(),
+                'cooccurrence': self.cooccurrence(),
+                'agreement': self.agreement()}
+
+
+def concat_tables(tables: List[Table], keys: List[str], key_name: str = 'snapshot') -> Table:
+    "Concatenate tables with the same columns, adding a column identifying their origin."
+    out: Table = {key_name: []}
+    for key, table in zip(keys, tables):
+        n_rows = len(next(iter(table.values()), []))
+        out[key_name] += [key] * n_rows
+        for name, column in table.items():
+            out.setdefault(name, []).extend(column)
+    return out
+
+
+def write_table(table: Table, path: Union[Path, str]):
+    "Write a table as csv, or as parquet if path ends with .parquet (requires pyarrow)."
+    path = Path(path)
+    if path.suffix == '.parquet':
+        if pyarrow is None:
+            raise ImportError('pyarrow is required to write parquet files')
+        pyarrow.parquet.write_table(pyarrow.table(table), path)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(table.keys())
+        writer.writerows(zip(*table.values()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compute annotation statistics of one or several VideoBase snapshots.')
+    parser.add_argument('videobase', nargs='+', help='VideoBase json file(s)')
+    parser.add_argument('-o', '--output', default='stats', help='Output folder')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    args = parser.parse_args()
+    if args.format == 'parquet' and pyarrow is None:
+        parser.error('pyarrow is required to write parquet files')
+
+    output = Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+    per_file: Dict[str, List[Table]] = {}
+    for vb_path in args.videobase:
+        stats = AnnotationStats(crud.load_videobase(vb_path))
+        print(f'{vb_path}: {len(stats.index)} segments, {len(stats.index.users)} users, '
+              f'{len(stats.labels)} labels')
+        for name, table in stats.tables().items():
+            per_file.setdefault(name, []).append(table)
+    keys = [Path(vb_path).stem for vb_path in args.videobase]
+    for name, tables in per_file.items():
+        path = output / f'{name}.{args.format}'
+        write_table(concat_tables(tables, keys), path)
+        print(f'Written {path}')
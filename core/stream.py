@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+from pydantic import parse_obj_as
+from core import crud
+from core.models import Segment
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_WHITESPACE = ' \t\n\r'
+
+
+class VideoBaseStream:
+    """
+    Iterate over the segments of a VideoBase json file without loading the whole file.
+
+    The file is read by chunks and each segment is parsed on its own, so memory use
+    does not depend on the number of segments. The other fields of the VideoBase are
+    available once read: notes is only set after the segments if it comes after them in
+    the file.
+
+    Parameters
+    ----------
+    json_path: Path or str
+    validate: bool
+        Fully validate each segment (slower), see crud.load_videobase
+    chunk_size: int
+        Number of characters read at once
+    """
+
+    def __init__(self, json_path: Union[Path, str], validate: bool = False,
+                 chunk_size: int = 1 << 20) -> None:
+        self.json_path = Path(json_path)
+        self.validate = validate
+        self.chunk_size = chunk_size
+        self.notes: Optional[str] = None
+        # Segments read so far
+        self.n_segments = 0
+        self._decoder = json.JSONDecoder()
+
+    def __iter__(self) -> Iterator[Segment]:
+        self.n_segments = 0
+        for seg in self._iter_dicts():
+            self.n_segments += 1
+            if self.validate:
+                yield parse_obj_as(Segment, seg)
+            else:
+                yield crud.segment_from_dict(seg)
+
+    def _iter_dicts(self) -> Iterator[dict]:
+        with open(self.json_path) as f:
+            self._file, self._buf, self._pos = f, '', 0
+            self._expect('{')
+            while self._peek() != '}':
+                key = self._value()
+                self._expect(':')
+                if key == 'segments':
+                    self._expect('[')
+                    while self._peek() != ']':
+                        yield self._value()
+                        if self._peek() == ',':
+                            self._expect(',')
+                    self._expect(']')
+                elif key == 'notes':
+                    self.notes = self._value()
+                else:
+                    self._value()
+                if self._peek() == ',':
+                    self._expect(',')
+            self._file = None
+
+    def _fill(self) -> bool:
+        "Read the next chunk, dropping what was parsed. Return False at the end of the file."
+        chunk = self._file.read(self.chunk_size)
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return len(chunk) > 0
+
+    def _peek(self) -> str:
+        "Next non whitespace character."
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                raise ValueError(f'Unexpected end of {self.json_path}')
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise ValueError(f'Expected {char!r} at {self._pos} in {self.json_path}, '
+                             f'found {self._buf[self._pos:self._pos + 20]!r}')
+        self._pos += 1
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Value cut by the end of the chunk, or invalid
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self._buf) and self._fill():
+                # A number might continue in the next chunk
+                continue
+            self._pos = end
+            return value
+
+
+class VideoBaseWriter:
+    """
+    Write a VideoBase json file one segment at a time, see VideoBaseStream.
+
+    Segments are written to a temporary file, renamed to json_path on close (not if an
+    exception was raised inside the with block).
+
+    Parameters
+    ----------
+    json_path: Path or str
+    notes: str, optional
+    """
+
+    def __init__(self, json_path: Union[Path, str], notes: Optional[str] = None) -> None:
+        self.json_path = Path(json_path)
+        self.notes = notes
+        self.n_segments = 0
+        self._tmp_path = self.json_path.with_name(f'.{self.json_path.name}.tmp')
+        self._file = open(self._tmp_path, 'w')
+        self._file.write('{"segments": [')
+
+    def __enter__(self) -> 'VideoBaseWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            self._tmp_path.unlink()
+
+    def write(self, segment: Segment):
+        self._file.write(',\n' if self.n_segments > 0 else '\n')
+        if orjson is not None:
+            self._file.write(orjson.dumps(segment.dict()).decode())
+        else:
+            self._file.write(segment.json())
+        self.n_segments += 1
+
+    def write_all(self, segments: Iterable[Segment]):
+        for seg in segments:
+            self.write(seg)
+
+    def close(self):
+        self._file.write(f'\n], "notes": {json.dumps(self.notes)}}}\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._tmp_path, self.json_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count or filter the segments of a VideoBase, in constant memory.')
+    parser.add_argument('videobase', help='VideoBase json file')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Write the selected segments to this file')
+    parser.add_argument('--subject', nargs='+', default=None, help='Keep these subjects')
+    parser.add_argument('--session', nargs='+', default=None, help='Keep these sessions')
+    parser.add_argument('--label', nargs='+', default=None,
+                        help='Keep the segments with any of these labels')
+    parser.add_argument('--annotated', action='store_true',
+                        help='Keep the annotated segments')
+    parser.add_argument('--not-annotated', action='store_true',
+                        help='Keep the segments without annotations')
+    args = parser.parse_args()
+
+    def selected(seg: Segment) -> bool:
+        if args.subject is not None and seg.subject not in args.subject:
+            return False
+        if args.session is not None and seg.session not in args.session:
+            return False
+        if args.label is not None and not any(seg.label_in_segment(lb) for lb in args.label):
+            return False
+        if args.annotated and not seg.has_annotations():
+            return False
+        if args.not_annotated and seg.has_annotations():
+            return False
+        return True
+
+    stream = VideoBaseStream(args.videobase)
+    segments = (seg for seg in stream if selected(seg))
+    if args.output is None:
+        n_selected = sum(1 for _ in segments)
+    else:
+        with VideoBaseWriter(args.output) as writer:
+            writer.write_all(segments)
+            writer.notes = stream.notes
+        n_selected = writer.n_segments
+    print(f'{n_selected} / {stream.n_segments} segments selected')
+    if args.output is not None:
+        print(f'Written to {args.output}')
@@ -0,0 +1,279 @@
+import argparse
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional, Union
+import av
+import numpy as np
+from core.decoder import DecoderBackend
+from core.frame_format import FULL, FrameFormat, to_ndarray
+
+
+class VideoIndex:
+    """
+    Presentation timestamps and keyframe positions of a video stream.
+
+    Built once by demuxing the whole file (no decoding), then persisted by an IndexCache.
+    The index is rebuilt if the size or the modification time of the video changed.
+
+    Attributes
+    ----------
+    pts: np.ndarray
+        Presentation timestamp of each frame, in presentation order
+    keyframes: np.ndarray
+        Indices of the keyframes, sorted
+    time_base: float
+    """
+    SUFFIX = '.index.npz'
+
+    def __init__(self, pts: np.ndarray, keyframes: np.ndarray, time_base: float,
+                 size: int = -1, mtime: float = -1) -> None:
+        self.pts = pts
+        self.keyframes = keyframes
+        self.time_base = time_base
+        self.size = size
+        self.mtime = mtime
+
+    def __len__(self):
+        return len(self.pts)
+
+    @classmethod
+    def build(cls, video_path: Union[Path, str], stream_index: int = 0) -> 'VideoIndex':
+        stat = Path(video_path).stat()
+        with av.open(str(video_path)) as container:
+            stream = container.streams.video[stream_index]
+            pts, is_key = [], []
+            for packet in container.demux(stream):
+                ts = packet.pts if packet.pts is not None else packet.dts
+                if ts is None:
+                    # Flushing packet
+                    continue
+                pts.append(ts)
+                is_key.append(packet.is_keyframe)
+            time_base = float(stream.time_base)
+        pts = np.array(pts, dtype=np.int64)
+        order = np.argsort(pts, kind='stable')
+        keyframes = np.flatnonzero(np.array(is_key, dtype=bool)[order])
+        return cls(pts[order], keyframes, time_base, stat.st_size, stat.st_mtime)
+
+    @classmethod
+    def index_path(cls, video_path: Union[Path, str]) -> Path:
+        video_path = Path(video_path)
+        return video_path.with_name(video_path.name + cls.SUFFIX)
+
+    def save(self, path: Union[Path, str]):
+        # Write then rename, the same index might be built by several threads
+        tmp_path = f'{path}.{os.getpid()}.{id(self)}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, pts=self.pts, keyframes=self.keyframes,
+                     meta=np.array([self.time_base, self.size, self.mtime]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> 'VideoIndex':
+        with np.load(path) as data:
+            time_base, size, mtime = data['meta']
+            return cls(data['pts'], data['keyframes'], float(time_base), int(size), float(mtime))
+
+    def is_valid_for(self, video_path: Union[Path, str]) -> bool:
+        stat = Path(video_path).stat()
+        return self.size == stat.st_size and self.mtime == stat.st_mtime
+
+    def frame_index(self, pts: int) -> int:
+        "Index of the frame with the given presentation timestamp (or the one just before)."
+        return max(int(np.searchsorted(self.pts, pts, side='right')) - 1, 0)
+
+    def keyframe_before(self, frame_ix: int, n_back: int = 0) -> int:
+        "Index of the last keyframe at or before frame_ix, or the n_back-th one before it."
+        k = int(np.searchsorted(self.keyframes, frame_ix, side='right')) - 1 - n_back
+        return int(self.keyframes[max(k, 0)])
+
+    def keyframe_after(self, frame_ix: int) -> int:
+        "Index of the first keyframe after frame_ix, the number of frames if there is none."
+        k = int(np.searchsorted(self.keyframes, frame_ix, side='right'))
+        return int(self.keyframes[k]) if k < len(self.keyframes) else len(self)
+
+
+def default_cache_dir() -> Path:
+    cache_home = os.environ.get('XDG_CACHE_HOME', Path('~/.cache').expanduser())
+    return Path(cache_home) / 'inspect' / 'video_index'
+
+
+class IndexCache:
+    """
+    Persistent store of video indexes, so that reopening a video skips the scan.
+
+    Indexes are stored in directory, in files named after a hash of the absolute path,
+    size and modification time of the video: a modified video gets a new entry.
+    With directory set to None, they are stored next to the videos instead, as
+    `<video file>.index.npz`.
+
+    Parameters
+    ----------
+    directory: Path or str, optional
+    """
+
+    def __init__(self, directory: Optional[Union[Path, str]] = None) -> None:
+        self.directory = None if directory is None else Path(directory)
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, video_path: Union[Path, str]) -> Path:
+        if self.directory is None:
+            return VideoIndex.index_path(video_path)
+        video_path = Path(video_path).absolute()
+        stat = video_path.stat()
+        key = f'{video_path}|{stat.st_size}|{stat.st_mtime_ns}'
+        return self.directory / (hashlib.sha1(key.encode()).hexdigest() + VideoIndex.SUFFIX)
+
+    def get(self, video_path: Union[Path, str]) -> VideoIndex:
+        """Load the index of a video, building and saving it if needed."""
+        index_path = self.path_for(video_path)
+        if index_path.exists():
+            index = VideoIndex.load(index_path)
+            if index.is_valid_for(video_path):
+                return index
+        index = VideoIndex.build(video_path)
+        try:
+            index.save(index_path)
+        except OSError:
+            # Read-only folder, the index will be rebuilt next time
+            pass
+        return index
+
+    def warm(self, video_paths: Iterable[Union[Path, str]], n_jobs: int = 4) -> int:
+        """Build the missing indexes of a set of videos. Return the number of videos."""
+        video_paths = sorted(set(str(vp) for vp in video_paths))
+        with ThreadPoolExecutor(n_jobs) as executor:
+            for ix, (vp, index) in enumerate(zip(video_paths,
+                                                 executor.map(self.get, video_paths))):
+                print(f'[{ix + 1}/{len(video_paths)}] {vp}: {len(index)} frames, '
+                      f'{len(index.keyframes)} keyframes')
+        return len(video_paths)
+
+
+def get_index(video_path: Union[Path, str], cache: Optional[IndexCache] = None) -> VideoIndex:
+    """Load the index of a video from the cache (default directory if None)."""
+    if cache is None:
+        cache = IndexCache(default_cache_dir())
+    return cache.get(video_path)
+
+
+class IndexedVideo(DecoderBackend):
+    """
+    Random access to the frames of a (long) video file, using its keyframe index.
+
+    Reading frame i seeks to the last keyframe before i and decodes forward, unless the
+    decoder is already less than a GOP before i. Reading the frames in order only decodes
+    each frame once, without seeking. Decoder backend for ranges of long
+    recordings, see core.decoder.
+
+    Parameters
+    ----------
+    video_path: str
+    index: VideoIndex, optional
+        Loaded (or built) with get_index if not provided
+    cache: IndexCache, optional
+        Where the index is loaded from, the default cache directory if None
+    """
+    MAX_SEEK_BACK = 4
+
+    def __init__(self, video_path: Union[Path, str], index: Optional[VideoIndex] = None,
+                 cache: Optional[IndexCache] = None) -> None:
+        self.video_path = str(video_path)
+        self.index = get_index(video_path, cache) if index is None else index
+        self._container = av.open(self.video_path)
+        self._stream = self._container.streams.video[0]
+        self._frames = None
+        self._last = -1
+        # Last keyframe read, returned again if asked again in the same format
+        self._last_read = (-1, None, None)
+        # See benchmarks.decode
+        self.n_seeks = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def frame_rate(self) -> float:
+        return float(self._stream.average_rate)
+
+    def _seek(self, frame_ix: int, n_back: int = 0):
+        keyframe = self.index.keyframe_before(frame_ix, n_back)
+        self._container.seek(int(self.index.pts[keyframe]), stream=self._stream)
+        self._frames = self._container.decode(self._stream)
+        self._last = -1
+        self.n_seeks += 1
+
+    def _read_until(self, frame_ix: int) -> Optional[av.VideoFrame]:
+        "Decode forward up to frame_ix. None if the stream ended or went past it."
+        for frame in self._frames:
+            if frame.pts is None:
+                self._last += 1
+            else:
+                self._last = self.index.frame_index(frame.pts)
+            if self._last == frame_ix:
+                return frame
+            if self._last > frame_ix:
+                return None
+        self._frames = None
+        return None
+
+    def read(self, frame_ix: int, fmt: FrameFormat = FULL) -> np.ndarray:
+        if frame_ix < 0:
+            frame_ix += len(self)
+        if not 0 <= frame_ix < len(self):
+            raise IndexError(f'Frame {frame_ix} out of range for {self.video_path}')
+        if fmt.keyframes:
+            frame_ix = self.index.keyframe_before(frame_ix)
+            last_ix, last_fmt, array = self._last_read
+            if frame_ix == last_ix and fmt == last_fmt:
+                # Keyframes are asked many times in a row during fast playback
+                return array
+        if (self._frames is None or frame_ix <= self._last
+                or self.index.keyframe_before(frame_ix) > self.index.keyframe_after(self._last)):
+            # Decoding forward from the current position would go through a whole GOP
+            self._seek(frame_ix)
+        frame = self._read_until(frame_ix)
+        n_back = 0
+        while frame is None and n_back < self.MAX_SEEK_BACK:
+            # Seek landed after the frame, start from an earlier keyframe
+            n_back += 1
+            self._seek(frame_ix, n_back)
+            frame = self._read_until(frame_ix)
+        if frame is None:
+            raise IndexError(f'Frame {frame_ix} could not be decoded from {self.video_path}')
+        array = to_ndarray(frame, fmt)
+        if fmt.keyframes:
+            self._last_read = (frame_ix, fmt, array)
+        return array
+
+    def close(self):
+        self._frames = None
+        self._container.close()
+
+
+if __name__ == '__main__':
+    from core.crud import load_videobase
+
+    parser = argparse.ArgumentParser(
+        description='Pre-build the keyframe indexes of all the videos of a VideoBase.')
+    parser.add_argument('videobase', nargs='+', help='VideoBase json file(s)')
+    parser.add_argument('--cache-dir', default=None,
+                        help=f'Index cache directory (default: {default_cache_dir()})')
+    parser.add_argument('--next-to-videos', action='store_true',
+                        help='Store the indexes next to the videos instead')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of parallel scans')
+    args = parser.parse_args()
+
+    if args.next_to_videos:
+        cache = IndexCache(None)
+    else:
+        cache = IndexCache(args.cache_dir or default_cache_dir())
+    files = set()
+    for vb_path in args.videobase:
+        vb = load_videobase(vb_path)
+        files.update(vf for seg in vb.segments for vf in seg.files)
+    n_videos = cache.warm(files, args.jobs)
+    print(f'{n_videos} videos indexed')
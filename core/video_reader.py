@@ -1,37 +1,345 @@
+import threading
+import time
+from collections import deque
 from queue import Queue
-from typing import List, Optional
-from pims import Video
+from typing import Callable, List, Optional, Sequence
+import numpy as np
 from PySide2 import QtCore
+from core.decoder import DecoderBackend, PyAVDecoder
+from core.frame_cache import FrameCache
+from core.frame_format import FULL, FrameFormat, read_frame
+from core.mosaic import Mosaic
+from core.prefetch import VideoPool
+
+
+class FrameBuffer:
+    """Bounded ring buffer of (frame index, frame) pairs decoded ahead for one camera.
+
+    Not thread-safe on its own, the owning DecodeWorker guards it with its lock.
+    """
+
+    def __init__(self, size: int = 8) -> None:
+        self.size = size
+        self._items = deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def full(self) -> bool:
+        return len(self._items) >= self.size
+
+    def push(self, frame_ix: int, frame: np.ndarray):
+        self._items.append((frame_ix, frame))
+
+    def has(self, frame_ix: int) -> bool:
+        return any(ix == frame_ix for ix, _ in self._items)
+
+    def pop(self, frame_ix: int) -> Optional[np.ndarray]:
+        """Return the frame at frame_ix, dropping the frames queued before it."""
+        if not self.has(frame_ix):
+            return None
+        while True:
+            ix, frame = self._items.popleft()
+            if ix == frame_ix:
+                return frame
+
+    def clear(self):
+        self._items.clear()
+
+
+class DecodeWorker(threading.Thread):
+    """Decode the frames of one camera ahead of playback, in its own thread.
+
+    Frames are decoded sequentially from the last requested index and stored in a
+    FrameBuffer. The worker sleeps when the buffer is full or when it is not active
+    (camera not displayed), and wakes up when a frame is taken or when a seek happens.
+
+    Parameters
+    ----------
+    video_file: str
+    wrap: Callable[[int], int]
+        Maps a frame index to the index actually played (loops inside the segment)
+    on_frame: Callable[[], None]
+        Called from the worker thread each time a frame was added to the buffer
+    buffer_size: int
+    pool: VideoPool, optional
+        Pool the video is taken from (and given back to), instead of opening it
+    cache: FrameCache, optional
+        Decoded frames are looked up in, and added to, this cache
+    copy: bool
+        Copy the decoded frames. Only needed if the decoder reuses its output buffer,
+        the backends return a new array for each frame.
+    open_video: Callable[[str], DecoderBackend]
+        Opens the video file when there is no pool, see core.decoder.BACKENDS
+    fmt: FrameFormat
+        Size and pixel format of the decoded frames, see set_format
+    """
+
+    def __init__(self, video_file: str, wrap: Callable[[int], int],
+                 on_frame: Callable[[], None], buffer_size: int = 8,
+                 pool: Optional[VideoPool] = None,
+                 cache: Optional[FrameCache] = None, copy: bool = False,
+                 open_video: Callable[[str], DecoderBackend] = PyAVDecoder,
+                 fmt: FrameFormat = FULL) -> None:
+        super().__init__(daemon=True)
+        self.video_file = video_file
+        self._pool = pool
+        self._cache = cache
+        self._copy = copy
+        if pool is None:
+            self.video = open_video(video_file)
+        else:
+            self.video = pool.acquire(video_file)
+        self.buffer = FrameBuffer(buffer_size)
+        self._wrap = wrap
+        self._on_frame = on_frame
+        self._cond = threading.Condition()
+        self._next_ix = 0
+        self._generation = 0
+        self._running = True
+        self._active = True
+        self._fmt = fmt
+
+    def __len__(self):
+        return len(self.video)
+
+    @property
+    def fmt(self) -> FrameFormat:
+        return self._fmt
+
+    def set_format(self, fmt: FrameFormat, frame_ix: int):
+        """Decode the next frames in format fmt, from frame_ix. Nothing to do if unchanged."""
+        with self._cond:
+            if fmt == self._fmt:
+                return
+            self._fmt = fmt
+            self._generation += 1
+            self._next_ix = frame_ix
+            self.buffer.clear()
+            self._cond.notify_all()
+
+    def seek(self, frame_ix: int):
+        """Drop the buffered frames and resume decoding from frame_ix."""
+        with self._cond:
+            self._generation += 1
+            self._next_ix = frame_ix
+            self.buffer.clear()
+            self._cond.notify_all()
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    @active.setter
+    def active(self, value: bool):
+        with self._cond:
+            self._active = value
+            self._cond.notify_all()
+
+    def expects(self, frame_ix: int) -> bool:
+        """Return True if frame_ix was decoded, or is the next frame to decode."""
+        with self._cond:
+            return self.buffer.has(frame_ix) or self._next_ix == frame_ix
+
+    def ready(self, frame_ix: int) -> bool:
+        """Return True if frame_ix was decoded."""
+        with self._cond:
+            if self.buffer.has(frame_ix):
+                return True
+            if self.buffer.full():
+                # Buffer is filled with frames that will never be asked for
+                self._generation += 1
+                self._next_ix = frame_ix
+                self.buffer.clear()
+                self._cond.notify_all()
+            return False
+
+    def take(self, frame_ix: int) -> Optional[np.ndarray]:
+        """Return the decoded frame_ix if it is ready, None otherwise."""
+        with self._cond:
+            frame = self.buffer.pop(frame_ix)
+            self._cond.notify_all()
+            return frame
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def decode(self, frame_ix: int, fmt: FrameFormat = FULL) -> np.ndarray:
+        # In keyframes only mode, every frame index returns the same keyframe array (kept
+        # by the decoder), caching it for each index would evict the played frames
+        cache = None if fmt.keyframes else self._cache
+        if cache is not None:
+            frame = cache.get(self.video_file, frame_ix, fmt)
+            if frame is not None:
+                return frame
+        frame = read_frame(self.video, frame_ix, fmt)
+        if self._copy:
+            frame = frame.copy()
+        if cache is not None:
+            cache.put(self.video_file, frame_ix, frame, fmt)
+        return frame
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running and (self.buffer.full() or not self._active):
+                    self._cond.wait()
+                if not self._running:
+                    break
+                frame_ix, generation, fmt = self._next_ix, self._generation, self._fmt
+            frame = self.decode(frame_ix, fmt)
+            with self._cond:
+                if generation != self._generation:
+                    # A seek happened while decoding, this frame is not wanted anymore
+                    continue
+                self.buffer.push(frame_ix, frame)
+                self._next_ix = self._wrap(frame_ix + 1)
+            self._on_frame()
+        if self._pool is None:
+            self.video.close()
+        else:
+            self._pool.release(self.video_file, self.video)
+
+
+class PlaybackClock:
+    """
+    Index of the frame due at a given time, when playing at speed times the frame rate.
+
+    Frames are due at their presentation time (frame index / frame rate) divided by
+    speed, counted from the frame playback started from. Changing the speed or the frame
+    rate restarts the count from the frame due at that time.
+
+    Parameters
+    ----------
+    frame_rate: float
+    speed: float
+    """
+
+    def __init__(self, frame_rate: float = 30., speed: float = 1.) -> None:
+        self._frame_rate = frame_rate
+        self._speed = speed
+        self._origin_frame = 0
+        self._origin_time = time.perf_counter()
+
+    def start(self, frame_ix: int, now: Optional[float] = None):
+        self._origin_frame = frame_ix
+        self._origin_time = time.perf_counter() if now is None else now
+
+    def frame_at(self, now: Optional[float] = None) -> int:
+        "Frame due at now, not wrapped in the played range."
+        if now is None:
+            now = time.perf_counter()
+        elapsed = now - self._origin_time
+        return self._origin_frame + int(elapsed * self._frame_rate * self._speed)
+
+    def _restart(self):
+        now = time.perf_counter()
+        self.start(self.frame_at(now), now)
+
+    @property
+    def speed(self) -> float:
+        return self._speed
+
+    @speed.setter
+    def speed(self, value: float):
+        self._restart()
+        self._speed = value
+
+    @property
+    def frame_rate(self) -> float:
+        return self._frame_rate
+
+    @frame_rate.setter
+    def frame_rate(self, value: float):
+        self._restart()
+        self._frame_rate = value
+
+    @property
+    def fps(self) -> float:
+        "Frames due per second."
+        return self._frame_rate * self._speed
 
 
 class VideoReader(QtCore.QObject):
+    """Play a set of synchronized videos, one decoding thread per camera.
+
+    Playback follows a PlaybackClock at speed times the frame rate of the videos. The
+    timer only requests the frame due, the frames are delivered (and frames_ready is
+    emitted) from the worker thread completing the set, as soon as every camera has
+    decoded it. Frames are late when they are not delivered before the next one is due,
+    and dropped (never requested) when decoding fell behind the clock: the decoders
+    skip them. From keyframe_speed on, only the keyframes are decoded.
+
+    When visible is set to a camera index, only that camera is decoded and the other
+    entries of the delivered frame lists are None. A camera catches up with the current
+    frame when it becomes visible. With visible set to None, all cameras are decoded.
+
+    Videos are opened with open_video (or taken from the pool), one of the decoder
+    backends of core.decoder: PyAVDecoder by default, core.video_index.IndexedVideo to
+    play ranges of long recordings.
+
+    formats gives the size and pixel format of the frames of each camera during playback,
+    e.g. shrunk to the size of the display (full resolution RGB for missing cameras).
+    Frames are decoded at full resolution when full_resolution is set (except in a
+    mosaic), which stepping frame by frame does until playback starts again.
+
+    With a mosaic, the frames of the cameras are composed into a single image, by the
+    thread completing the set, and that image is queued instead of the list of frames.
+    Set visible to None to have every camera in it, and formats to its cell format.
+    """
     frames_ready = QtCore.Signal()
 
-    def __init__(self, video_files: Optional[List[str]] = None, interval: int = 30) -> None:
+    def __init__(self, video_files: Optional[List[str]] = None, speed: float = 1.,
+                 keyframe_speed: float = 4., buffer_size: int = 8, visible: Optional[int] = None,
+                 pool: Optional[VideoPool] = None,
+                 cache: Optional[FrameCache] = None, copy: bool = False,
+                 open_video: Callable[[str], DecoderBackend] = PyAVDecoder,
+                 formats: Optional[Sequence[FrameFormat]] = None,
+                 mosaic: Optional[Mosaic] = None) -> None:
         super().__init__()
+        self.mosaic = mosaic
         self._video_files = video_files
-        if video_files is not None:
-            self._videos = [Video(vf) for vf in video_files]
-        else:
-            self._videos = None
-        self._n_frames = 0
+        self.pool = pool
+        self.cache = cache
+        self._copy = copy
+        self.open_video = open_video
+        self._buffer_size = buffer_size
+        self._visible = visible
+        self._formats = list(formats or [])
+        self._full_resolution = False
+        self._workers: Optional[List[DecodeWorker]] = None
+        self._lock = threading.Lock()
+        self._pending: Optional[int] = None
+        self._delivered = deque(maxlen=60)
+        self._n_late = 0
+        self._n_dropped = 0
+        # Pending frame already counted as late
+        self._is_late = False
         self._c_frame = 0
+        # Last frame requested by the clock, not wrapped
+        self._played = 0
         self._playing = False
         self.begin = 0
         self.end = 0
         self.queue = Queue()
-        self._interval = interval
+        self.clock = PlaybackClock(speed=speed)
+        self.keyframe_speed = keyframe_speed
         self._timer = QtCore.QTimer()
+        self._timer.setTimerType(QtCore.Qt.PreciseTimer)
         self._timer.setSingleShot(False)
-        self._timer.setInterval(interval)
         self._timer.timeout.connect(self.get_next_frames)
+        self._update_timer()
+        if video_files is not None:
+            self.open_all_videos()
         self.c_frame = 0
 
     @property
     def n_frames(self):
-        if self._videos is None:
+        if self._workers is None:
             return -1
-        return len(self._videos[0])
+        return len(self._workers[0])
 
     @property
     def video_files(self):
@@ -48,78 +356,230 @@ class VideoReader(QtCore.QObject):
         if was_playing:
             self.start()
 
+    @property
+    def visible(self) -> Optional[int]:
+        return self._visible
+
+    @visible.setter
+    def visible(self, value: Optional[int]):
+        with self._lock:
+            self._visible = value
+            if self._workers is not None:
+                for ix, worker in enumerate(self._workers):
+                    is_active = self._is_visible(ix)
+                    if is_active and not worker.active:
+                        # Lazy catch-up with the other cameras
+                        worker.seek(self._c_frame)
+                    worker.active = is_active
+        self.get_current_frames()
+
+    def set_visible(self, camera_ix: int):
+        self.visible = camera_ix
+
+    @property
+    def formats(self) -> List[FrameFormat]:
+        return self._formats
+
+    @formats.setter
+    def formats(self, value: Sequence[FrameFormat]):
+        self._formats = list(value)
+        self._apply_formats()
+
+    @property
+    def full_resolution(self) -> bool:
+        return self._full_resolution
+
+    @full_resolution.setter
+    def full_resolution(self, value: bool):
+        if value != self._full_resolution:
+            self._full_resolution = value
+            self._apply_formats()
+
+    @property
+    def keyframes_only(self) -> bool:
+        return self._playing and self.clock.speed >= self.keyframe_speed
+
+    def _format_for(self, camera_ix: int) -> FrameFormat:
+        if camera_ix >= len(self._formats) or (self._full_resolution and self.mosaic is None):
+            fmt = FULL
+        else:
+            fmt = self._formats[camera_ix]
+        return fmt._replace(keyframes=self.keyframes_only)
+
+    def _apply_formats(self):
+        "Switch the workers to their current format, and deliver the current frame again."
+        with self._lock:
+            if self._workers is None:
+                return
+            for ix, worker in enumerate(self._workers):
+                worker.set_format(self._format_for(ix), self._c_frame)
+        self.get_current_frames()
+
+    def _is_visible(self, camera_ix: int) -> bool:
+        return self._visible is None or self._visible == camera_ix
+
     def start(self):
-        self._timer.start()
+        self._delivered.clear()
+        self._n_late = 0
+        self._n_dropped = 0
+        changed = self._full_resolution or self.clock.speed >= self.keyframe_speed
         self._playing = True
+        self._full_resolution = False
+        if changed:
+            self._apply_formats()
+        self.clock.start(self._c_frame)
+        self._played = self._c_frame
+        self._timer.start()
 
     def stop(self):
         self._timer.stop()
+        was_fast = self.keyframes_only
         self._playing = False
+        if was_fast:
+            # Show the actual frame, not its keyframe
+            self._apply_formats()
 
     def prev_frame(self):
+        self.full_resolution = True
         self.c_frame -= 1
 
     def next_frame(self):
+        self.full_resolution = True
         self.c_frame += 1
 
     @property
-    def interval(self):
-        return self._interval
+    def speed(self) -> float:
+        return self.clock.speed
 
-    @interval.setter
-    def interval(self, value):
-        self._interval = value
-        self._timer.stop()
-        self._timer.setInterval(value)
-        self._timer.start()
+    @speed.setter
+    def speed(self, value: float):
+        was_fast = self.keyframes_only
+        self.clock.speed = value
+        self._update_timer()
+        if self.keyframes_only != was_fast:
+            self._apply_formats()
+
+    def _update_timer(self):
+        # Ticks twice per frame, at least every 10 ms
+        self._timer.setInterval(int(min(10., max(2., 500 / self.clock.fps))))
 
     @property
-    def c_frame(self):
-        return self._c_frame
+    def requested_fps(self) -> float:
+        return self.clock.fps
 
-    @c_frame.setter
-    def c_frame(self, value):
+    @property
+    def achieved_fps(self) -> float:
+        "Frame rate actually delivered over the last few frames of playback."
+        if len(self._delivered) < 2:
+            return 0.
+        elapsed = self._delivered[-1] - self._delivered[0]
+        if elapsed <= 0:
+            return 0.
+        return (len(self._delivered) - 1) / elapsed
+
+    @property
+    def n_late(self) -> int:
+        "Number of frames not decoded in time, since playback started."
+        return self._n_late
+
+    @property
+    def n_dropped(self) -> int:
+        "Number of frames skipped to keep up with the clock (not counting keyframes only)."
+        return self._n_dropped
+
+    def _loop(self, value: int) -> int:
+        "Frame played at the unwrapped index value, looping over the segment."
+        if self.end <= self.begin:
+            return value
+        return self.begin + (value - self.begin) % (self.end - self.begin)
+
+    def _wrap(self, value: int) -> int:
         if value < self.begin:
             value = self.end - 1
         if value >= self.end:
             value = self.begin
-        self._c_frame = value
+        return value
+
+    @property
+    def c_frame(self):
+        return self._c_frame
+
+    @c_frame.setter
+    def c_frame(self, value):
+        value = self._wrap(value)
+        with self._lock:
+            if self._workers is not None:
+                for worker in self._workers:
+                    if worker.active and not worker.expects(value):
+                        worker.seek(value)
+            self._c_frame = value
         self.get_current_frames()
 
     def get_next_frames(self):
-        self.c_frame += 1
-
-    def get_frames(self, frame_ix):
-        if self._videos is None:
-            return None
-        try:
-            frames = [vid[frame_ix].copy() for vid in self._videos]
-        except AttributeError:
-            # We reached the end of the video and can't seek
-            self.close_all_videos()
-            self.open_all_videos()
-            frames = self.get_frames(frame_ix)
-        return frames
+        due = self.clock.frame_at()
+        if due <= self._played:
+            return
+        if self._pending is not None:
+            # The previous frame is still being decoded
+            if not self._is_late and due > self._played + 1:
+                self._n_late += 1
+                self._is_late = True
+            return
+        if not self.keyframes_only:
+            self._n_dropped += due - self._played - 1
+        self._played = due
+        self._is_late = False
+        self.c_frame = self._loop(due)
 
     def get_current_frames(self):
-        frames = self.get_frames(self.c_frame)
-        if frames is None:
-            return
-        self.queue.put(frames)
-        # images = [self.np_to_qimage(np_im) for np_im in frames]
+        with self._lock:
+            self._pending = self._c_frame
+        self._deliver()
+
+    def _deliver(self):
+        "Queue the pending frames if all cameras decoded them. Called from any thread."
+        with self._lock:
+            frame_ix = self._pending
+            if frame_ix is None or self._workers is None:
+                return
+            if not all([w.ready(frame_ix) for w in self._workers if w.active]):
+                return
+            frames = [w.take(frame_ix) if w.active else None for w in self._workers]
+            self._pending = None
+            mosaic = self.mosaic
+            self.queue.put(frames if mosaic is None else mosaic.compose(frames))
+            if self._playing:
+                self._delivered.append(time.perf_counter())
         self.frames_ready.emit()
 
-    def change_speed(self, interval: int):
-        self.interval = interval
+    def change_speed(self, speed: float):
+        self.speed = speed
 
     def close_all_videos(self):
-        if self._videos is not None:
-            for vf in self._videos:
-                vf.close()
+        with self._lock:
+            workers, self._workers = self._workers, None
+            self._pending = None
+        if workers is not None:
+            for worker in workers:
+                worker.stop()
+            for worker in workers:
+                worker.join()
         while not self.queue.empty():
             print('emptying')
             self.queue.get_nowait()
 
     def open_all_videos(self):
-        self._videos = [Video(vf) for vf in self.video_files]
-
+        workers = [DecodeWorker(vf, self._wrap, self._deliver, self._buffer_size,
+                                self.pool, self.cache, self._copy, self.open_video,
+                                self._format_for(ix))
+                   for ix, vf in enumerate(self.video_files)]
+        for ix, worker in enumerate(workers):
+            worker.seek(self._c_frame)
+            worker.active = self._is_visible(ix)
+            worker.start()
+        if workers:
+            self.clock.frame_rate = float(getattr(workers[0].video, 'frame_rate', 30.))
+            self._update_timer()
+        with self._lock:
+            self._workers = workers
+        self.get_current_frames()
@@ -1,15 +1,49 @@
+import time
 import typing
+from collections import deque
 from queue import Empty, Queue
 from pathlib import Path
 from typing import List
 from functools import partial
 from core.models import Category
-from typing import Optional
+from core.label_registry import LabelRegistry
+from typing import Iterable, Optional, Union
+import numpy as np
 import PySide2
 from PySide2 import QtWidgets, QtCore, QtGui
 from PySide2.QtGui import QImage, QPainter
 from PySide2.QtCore import QRectF, Slot, Signal
-from core.crud import find_category
+from core.crud import find_category, find_label_category
+
+
+class ArrayImage(QImage):
+    """
+    QImage wrapping the buffer of a numpy array, without copying it.
+
+    The array is kept alive as long as the image. Row padding is supported through
+    bytesPerLine, the array is only copied if its pixels are not packed within a row.
+    Accepts (height, width) grayscale, (height, width, 3) RGB and (height, width, 4)
+    RGBA uint8 arrays.
+    """
+    FORMATS = {1: QImage.Format_Grayscale8,
+               3: QImage.Format_RGB888,
+               4: QImage.Format_RGBA8888}
+
+    def __init__(self, array: np.ndarray) -> None:
+        if array.ndim == 2:
+            array = array[:, :, None]
+        height, width, channels = array.shape
+        if array.dtype != np.uint8:
+            array = array.astype(np.uint8)
+        # The channel stride of a single channel (added axis) is 0, and irrelevant
+        if ((channels > 1 and array.strides[2] != 1) or array.strides[1] != channels
+                or array.strides[0] < 0):
+            array = np.ascontiguousarray(array)
+        # Contiguous bytes from the first to the last pixel, including the row padding
+        n_bytes = array.strides[0] * (height - 1) + width * channels
+        buffer = np.lib.stride_tricks.as_strided(array, shape=(n_bytes,), strides=(1,))
+        super().__init__(buffer.data, width, height, array.strides[0], self.FORMATS[channels])
+        self._array = array
 
 
 class VideoTab(QtWidgets.QWidget):
@@ -28,39 +62,67 @@ class VideoTab(QtWidgets.QWidget):
 
 
 class Display(QtWidgets.QGraphicsView):
-    def __init__(self, parent: Optional[QtWidgets.QWidget] = None):
+    def __init__(self, parent: Optional[QtWidgets.QWidget] = None, smooth: bool = False):
         super().__init__(parent)
-        self.__scene = CustomGraphicsScene(self)
+        self.__scene = CustomGraphicsScene(self, smooth)
         self.setScene(self.__scene)
 
     def on_image_received(self, image: QImage):
+        # The scene schedules the repaint of the view
         self.__scene.set_image(image)
-        self.update()
+
+    @property
+    def paint_ms(self) -> float:
+        return self.__scene.paint_ms
+
+    def resizeEvent(self, event: QtGui.QResizeEvent):
+        self.__scene.invalidate_cache()
+        super().resizeEvent(event)
 
 
 class CustomGraphicsScene(QtWidgets.QGraphicsScene):
-    def __init__(self, parent: Display = None):
+    """
+    Scene painting the last image received as background, fit to the display.
+
+    The image is scaled once to the display size and kept as a pixmap, repaints reuse it
+    until a new image is set or the display is resized. Smooth (bilinear) scaling costs
+    about three times more than the default nearest neighbour scaling.
+    """
+    def __init__(self, parent: Display = None, smooth: bool = False):
         super().__init__(parent)
         self.__parent = parent
+        self.smooth = smooth
         self.__image = QImage()
+        self.__pixmap: Optional[QtGui.QPixmap] = None
+        self.__rect = QRectF()
+        # Duration of the last paints, in s
+        self._paint_times = deque(maxlen=60)
 
     def set_image(self, image: QImage):
         self.__image = image
+        self.__pixmap = None
         self.update()
 
-    def drawBackground(self, painter: QPainter, rect: QRectF):
-        # Display size
-        display_width = self.__parent.width()
-        display_height = self.__parent.height()
+    def invalidate_cache(self):
+        self.__pixmap = None
+
+    @property
+    def paint_ms(self) -> float:
+        "Mean duration of the last paints, in ms."
+        if len(self._paint_times) == 0:
+            return 0.
+        return 1000 * sum(self._paint_times) / len(self._paint_times)
+
+    def _fit_rect(self) -> QRectF:
+        "Rectangle of the image fit to the display, centered on the origin of the scene."
+        # Display size, without the frame of the view
+        display_width = self.__parent.viewport().width()
+        display_height = self.__parent.viewport().height()
 
         # Image size
         image_width = self.__image.width()
         image_height = self.__image.height()
 
-        # Return if we don't have an image yet
-        if image_width == 0 or image_height == 0:
-            return
-
         # Calculate aspect ratio of display
         ratio1 = display_width / display_height
         # Calculate aspect ratio of image
@@ -75,19 +137,45 @@ class CustomGraphicsScene(QtWidgets.QGraphicsScene):
             image_width = display_width
             image_height = display_height / ratio2
 
-        image_pos_x = -1.0 * (image_width / 2.0)
-        image_pox_y = -1.0 * (image_height / 2.0)
-
         # Remove digits after point
-        image_pos_x = int(image_pos_x)
-        image_pox_y = int(image_pox_y)
+        image_pos_x = int(-1.0 * (image_width / 2.0))
+        image_pox_y = int(-1.0 * (image_height / 2.0))
 
-        rect = QRectF(image_pos_x, image_pox_y, image_width, image_height)
+        return QRectF(image_pos_x, image_pox_y, int(image_width), int(image_height))
 
-        painter.drawImage(rect, self.__image)
+    def drawBackground(self, painter: QPainter, rect: QRectF):
+        # Return if we don't have an image yet
+        if self.__image.width() == 0 or self.__image.height() == 0:
+            return
+        if self.__parent.viewport().width() == 0 or self.__parent.viewport().height() == 0:
+            return
+        t_start = time.perf_counter()
+        if self.__pixmap is None:
+            self.__rect = self._fit_rect()
+            # Scaled to device pixels, for high dpi screens
+            ratio = self.__parent.devicePixelRatioF()
+            size = QtCore.QSize(max(1, round(self.__rect.width() * ratio)),
+                                max(1, round(self.__rect.height() * ratio)))
+            scaled = self.__image
+            if size != scaled.size():
+                # Not needed if the decoder already shrunk the frame to the display size
+                mode = QtCore.Qt.SmoothTransformation if self.smooth else QtCore.Qt.FastTransformation
+                scaled = scaled.scaled(size, QtCore.Qt.IgnoreAspectRatio, mode)
+            self.__pixmap = QtGui.QPixmap.fromImage(scaled)
+            self.__pixmap.setDevicePixelRatio(ratio)
+        painter.drawPixmap(self.__rect.topLeft(), self.__pixmap)
+        self._paint_times.append(time.perf_counter() - t_start)
 
 
 class MultiVid(QtWidgets.QWidget):
+    """
+    One tab per camera, plus a grid tab showing all the cameras at once.
+
+    The grid tab displays images already composed by the VideoReader (see
+    core.mosaic.Mosaic), the camera tabs display one of the frames of each set.
+    """
+    camera_changed = Signal(int)
+    grid_changed = Signal(bool)
 
     def __init__(self, parent: Optional[PySide2.QtWidgets.QWidget], queue: Queue,
                  min_vid: int = 5) -> None:
@@ -101,8 +189,11 @@ class MultiVid(QtWidgets.QWidget):
         for ix, tab in enumerate(self.l_video_tabs):
             # lyt.addWidget(tab)
             self.tabs.addTab(tab, f'Camera &{ix+1}')
+        self.grid_tab = VideoTab(self)
+        self.grid_ix = self.tabs.addTab(self.grid_tab, '&Grid')
         lyt.addWidget(self.tabs)
         self._c_tab_ix = 0
+        self.tabs.currentChanged.connect(self._tab_changed)
         self.setMinimumSize(1024, 780)
 
     @property
@@ -111,9 +202,32 @@ class MultiVid(QtWidgets.QWidget):
 
     @c_tab_ix.setter
     def c_tab_ix(self, value):
-        value = value % len(self.l_video_tabs)
-        self._c_tab_ix = value
-        self.tabs.setCurrentWidget(self.l_video_tabs[value])
+        # The grid comes after the last camera
+        # _tab_changed updates _c_tab_ix
+        self.tabs.setCurrentIndex(value % self.tabs.count())
+
+    @property
+    def is_grid(self) -> bool:
+        return self._c_tab_ix == self.grid_ix
+
+    @Slot(int)
+    def _tab_changed(self, ix: int):
+        was_grid = self.is_grid
+        self._c_tab_ix = ix
+        if self.is_grid != was_grid:
+            self.grid_changed.emit(self.is_grid)
+        if not self.is_grid:
+            self.camera_changed.emit(ix)
+
+    def display_size(self) -> QtCore.QSize:
+        "Size of the video displays, in device pixels."
+        display = self.tabs.widget(self._c_tab_ix).display
+        return display.viewport().size() * display.devicePixelRatioF()
+
+    @property
+    def paint_ms(self) -> float:
+        "Mean paint time of the displayed camera (or grid), in ms."
+        return self.tabs.widget(self._c_tab_ix).display.paint_ms
 
     def prev_tab(self):
         self.c_tab_ix -= 1
@@ -123,9 +237,7 @@ class MultiVid(QtWidgets.QWidget):
 
     @staticmethod
     def np_to_qimage(np_img):
-        height, width, channels = np_img.shape
-        return QtGui.QImage(np_img.copy(), width, height, channels*width,
-                            QtGui.QImage.Format_RGB888)
+        return ArrayImage(np_img)
 
     @Slot()
     def set_frames(self):
@@ -133,9 +245,20 @@ class MultiVid(QtWidgets.QWidget):
             frames = self.queue.get_nowait()
         except Empty:
             return
+        if isinstance(frames, np.ndarray):
+            # Composed grid image, unless it was queued before leaving the grid
+            if self.is_grid:
+                self.grid_tab.on_new_image(self.np_to_qimage(frames))
+            return
+        if self.is_grid:
+            # Frame list queued before switching to the grid
+            return
         ix = self.tabs.currentIndex()
+        if ix >= min(len(frames), len(self.l_video_tabs)) or frames[ix] is None:
+            # Camera not decoded (yet), or no tab for it
+            return
         qimage = self.np_to_qimage(frames[ix])
-        self.l_video_tabs[ix].on_new_image(qimage.copy())
+        self.l_video_tabs[ix].on_new_image(qimage)
         # for np_img, tab in zip(frames, self.l_video_tabs):
         #     frame = self.np_to_qimage(np_img)
         #     tab.on_new_image(frame)
@@ -146,16 +269,17 @@ class Player(QtWidgets.QWidget):
     stop = Signal()
     prev = Signal()
     next = Signal()
-    speed_adjusted = Signal(int)
+    speed_adjusted = Signal(float)
 
     def __init__(self, parent: Optional[PySide2.QtWidgets.QWidget] = None) -> None:
         super().__init__(parent)
         self.play_btn = QtWidgets.QPushButton('&Play')
         self.stop_btn = QtWidgets.QPushButton('&Stop')
         self.speed_sl = QtWidgets.QSlider(QtCore.Qt.Horizontal)
-        self.speed_sl.setRange(-500, -5)  # Large value = large interval = slow speed
+        self.speed_sl.setRange(-4, 6)  # Speed 2 ** (value / 2), 0.25x to 8x
         self.speed_sl.setSingleStep(1)
-        self.speed_sl.setValue(-30)
+        self.speed_sl.setValue(0)
+        self.speed_lbl = QtWidgets.QLabel('1.00x')
         self.prev_frame_btn = QtWidgets.QPushButton('&Backward')
         self.next_frame_btn = QtWidgets.QPushButton('&Forward')
         lyt = QtWidgets.QHBoxLayout(self)
@@ -163,6 +287,7 @@ class Player(QtWidgets.QWidget):
         lyt.addWidget(self.stop_btn)
         lyt.addWidget(QtWidgets.QLabel('Playback speed'))
         lyt.addWidget(self.speed_sl)
+        lyt.addWidget(self.speed_lbl)
         lyt.addWidget(self.prev_frame_btn)
         lyt.addWidget(self.next_frame_btn)
 
@@ -192,7 +317,9 @@ class Player(QtWidgets.QWidget):
 
     @Slot(int)
     def speed_adjustment(self, value):
-        self.speed_adjusted.emit(abs(value))
+        speed = 2 ** (value / 2)
+        self.speed_lbl.setText(f'{speed:.2f}x')
+        self.speed_adjusted.emit(speed)
 
 
 class LabelGroup(QtWidgets.QWidget):
@@ -205,6 +332,7 @@ class LabelGroup(QtWidgets.QWidget):
         self.name = category.name
         self.labels = category.labels
         self.states = {lbl: False for lbl in self.labels}
+        self._label_ix = {lbl: ix for ix, lbl in enumerate(self.labels)}
         lyt = QtWidgets.QHBoxLayout(self)
         cb_grp = QtWidgets.QGroupBox(self.name, self)
         grp_lyt = QtWidgets.QVBoxLayout(cb_grp)
@@ -219,27 +347,32 @@ class LabelGroup(QtWidgets.QWidget):
 
     @Slot(int)
     def state_changed(self, state: int, label: str):
-        self.states[label] = state > 0
-        self.labels_updated.emit(self.states)
+        checked = state > 0
+        if self.states[label] == checked:
+            return
+        self.states[label] = checked
+        # Only the label that changed
+        self.labels_updated.emit({label: checked})
 
     def reset_state(self):
         for cb in self.all_cb:
             cb.setChecked(False)
 
     def check_label(self, label):
-        if label not in self.labels:
+        ix = self._label_ix.get(label)
+        if ix is None:
             return
-        ix = self.labels.index(label)
         self.all_cb[ix].setChecked(True)
 
 
 class LabelPanel(QtWidgets.QWidget):
     new_state = Signal(str, dict)
 
-    def __init__(self, categories: List[Category],
+    def __init__(self, categories: Union[Iterable[Category], LabelRegistry],
                  parent: Optional[PySide2.QtWidgets.QWidget] = None) -> None:
         super().__init__(parent)
         lyt = QtWidgets.QGridLayout(self)
+        self.categories = categories
         self.groups = {cat.name: LabelGroup(cat, self) for cat in categories}
         for ix, gp in enumerate(self.groups.values()):
             row = ix // 2
@@ -250,9 +383,9 @@ class LabelPanel(QtWidgets.QWidget):
         self.states = {}
 
     @Slot(dict)
-    def label_clicked(self, state: dict, category: str):
-        self.states[category] = state
-        self.new_state.emit(category, state)
+    def label_clicked(self, changed: dict, category: str):
+        self.states[category] = self.groups[category].states
+        self.new_state.emit(category, changed)
 
     def reset_all(self):
         for gp in self.groups.values():
@@ -262,6 +395,13 @@ class LabelPanel(QtWidgets.QWidget):
         gp = self.groups[category]
         gp.check_label(label)
 
+    def check_labels(self, labels: Iterable[str]):
+        """Check labels of any category, labels without category are ignored."""
+        for label in labels:
+            match = find_label_category(self.categories, label)
+            if match is not None:
+                self.check_label(match[1].name, label)
+
 
 class PathPicker(QtWidgets.QWidget):
     new_path = QtCore.Signal(str)
@@ -293,7 +433,7 @@ class PathPicker(QtWidgets.QWidget):
         open_dialog = QtWidgets.QFileDialog(self)
         dpath, _ = open_dialog.getOpenFileName(self, "Choose a Video Base file",
                                                self.cwd,
-                                               "JSON files (*.json)")
+                                               "Video Base files (*.json *.sqlite *.db)")
         if dpath != '':
             self.path = dpath
 
@@ -325,7 +465,7 @@ class LabelCreator(QtWidgets.QDialog):
     def __init__(self, parent: typing.Optional[PySide2.QtWidgets.QWidget] = None) -> None:
         super().__init__(parent)
         self.setWindowTitle('Edit or add a label')
-        self._categories: List[Category] = []
+        self._categories: Union[List[Category], LabelRegistry] = []
         main_lyt = QtWidgets.QVBoxLayout(self)
         form_lyt = QtWidgets.QFormLayout()
         self.cat_cb = QtWidgets.QComboBox(self)
@@ -356,7 +496,7 @@ class LabelCreator(QtWidgets.QDialog):
         _, cat = r
         self.labels_cb.addItems(cat.labels)
 
-    def edit_label(self, categories: List[Category]):
+    def edit_label(self, categories: Union[List[Category], LabelRegistry]):
         self._categories = categories
         for cat in categories:
             self.cat_cb.addItem(cat.name, cat)
@@ -381,6 +521,30 @@ class Satus(QtWidgets.QWidget):
         h_lyt.addWidget(QtWidgets.QLabel(' / '))
         self.c_total_lbl = QtWidgets.QLabel(self)
         h_lyt.addWidget(self.c_total_lbl)
+        h_lyt.addSpacerItem(QtWidgets.QSpacerItem(50, 1, QtWidgets.QSizePolicy.Fixed,
+                                                  QtWidgets.QSizePolicy.Fixed))
+
+        h_lyt.addWidget(QtWidgets.QLabel('Playback fps (achieved / requested):'))
+        self.c_fps_lbl = QtWidgets.QLabel(self)
+        h_lyt.addWidget(self.c_fps_lbl)
+        h_lyt.addSpacerItem(QtWidgets.QSpacerItem(50, 1, QtWidgets.QSizePolicy.Fixed,
+                                                  QtWidgets.QSizePolicy.Fixed))
+
+        h_lyt.addWidget(QtWidgets.QLabel('Dropped / Late:'))
+        self.c_dropped_lbl = QtWidgets.QLabel(self)
+        h_lyt.addWidget(self.c_dropped_lbl)
+        h_lyt.addSpacerItem(QtWidgets.QSpacerItem(50, 1, QtWidgets.QSizePolicy.Fixed,
+                                                  QtWidgets.QSizePolicy.Fixed))
+
+        h_lyt.addWidget(QtWidgets.QLabel('Paint:'))
+        self.c_paint_lbl = QtWidgets.QLabel(self)
+        h_lyt.addWidget(self.c_paint_lbl)
+        h_lyt.addSpacerItem(QtWidgets.QSpacerItem(50, 1, QtWidgets.QSizePolicy.Fixed,
+                                                  QtWidgets.QSizePolicy.Fixed))
+
+        h_lyt.addWidget(QtWidgets.QLabel('Last save:'))
+        self.c_save_lbl = QtWidgets.QLabel(self)
+        h_lyt.addWidget(self.c_save_lbl)
         h_lyt.addSpacerItem(QtWidgets.QSpacerItem(1, 1, QtWidgets.QSizePolicy.Expanding,
                                                   QtWidgets.QSizePolicy.Fixed))
 
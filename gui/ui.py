@@ -1,10 +1,24 @@
+import argparse
+from functools import partial
 from pathlib import Path
 from queue import Empty, Queue
-import numpy as np
-from typing import Optional
+from typing import Callable, Optional
 import sys
 from core import crud
 from core.video_reader import VideoReader
+from core.prefetch import VideoPool, SegmentPrefetcher
+from core.decoder import BACKENDS
+from core.frame_cache import FrameCache
+from core.frame_format import FULL, PIX_FMTS, FrameFormat
+from core.mosaic import Mosaic
+from core.video_index import IndexedVideo
+from core.compact import CompactVideoBase
+from core.db import VideoBaseDB, is_database
+from core.ordering import (DEFAULT, STRATEGIES, OrderState, SegmentOrder, build_order,
+                           load_order_state, order_state_path)
+from core.journal import (AnnotationJournal, journal_path, read_journal, replay,
+                          retire_journal, ADD, REMOVE)
+from core.snapshot_writer import SnapshotWriter
 from PySide2 import QtWidgets, QtCore, QtGui
 from PySide2.QtCore import Slot, Qt
 import gui.controls as ctrl
@@ -14,10 +28,31 @@ from getpass import getuser
 
 class UI(QtWidgets.QMainWindow):
     frames_ready = QtCore.Signal()
+    # Emitted from the writing thread
+    snapshot_written = QtCore.Signal()
 
-    def __init__(self, parent: QtWidgets.QWidget = None, n_video=5, json_path="labels.json"):
+    def __init__(self, parent: QtWidgets.QWidget = None, n_video=5, json_path="labels.json",
+                 cache_mb: float = 1024, long_files: bool = False, compact_every: int = 500,
+                 compact: bool = False, order: str = DEFAULT, seed: Optional[int] = None,
+                 resume: bool = False, full_resolution: bool = False, pix_fmt: str = 'rgb24',
+                 decoder: str = 'pyav'):
         self.n_video = n_video
         self.json_path = json_path
+        # Number of journaled annotation events before the full snapshot is rewritten
+        self.compact_every = compact_every
+        # Segments are ranges of long recordings, play them through keyframe indexes
+        self.long_files = long_files
+        # Keep json VideoBases in numpy arrays (CompactVideoBase), for large bases
+        self.compact = compact
+        # Segment order strategy (see ordering.build_order), seed of its random draws, and
+        # whether to reuse the strategy and seed of the last session and start where it ended
+        self.order_name = order
+        self.seed = seed
+        self.resume = resume
+        # Decode the frames at full resolution instead of the size of the display, and in
+        # which pixel format
+        self.full_resolution = full_resolution
+        self.pix_fmt = pix_fmt
         super().__init__(parent)
         self.setWindowTitle('r2g - Video Annotator Multi-Angles')
         self.setWindowIconText('r2g')
@@ -59,7 +94,7 @@ class UI(QtWidgets.QMainWindow):
         # Right
         right_wdg = QtWidgets.QWidget(self)
         self._right_lyt = QtWidgets.QVBoxLayout(right_wdg)
-        self.categories = crud.load_labels(self.json_path)
+        self.categories = crud.load_label_registry(self.json_path)
         self.panel = ctrl.LabelPanel(self.categories)
         self.panel.new_state.connect(self.new_annotation)
         nav = ctrl.Navigator(self)
@@ -70,8 +105,15 @@ class UI(QtWidgets.QMainWindow):
         splitter.addWidget(right_wdg)
         self.lyt.addWidget(splitter)
         # Videos
-        self.video_reader = VideoReader()
+        self.frame_cache = FrameCache(cache_mb)
+        open_video = IndexedVideo if long_files else BACKENDS[decoder]
+        self.video_pool = VideoPool(cache=self.frame_cache, open_video=open_video)
+        self.prefetcher = SegmentPrefetcher(self.video_pool)
+        self.video_reader = VideoReader(visible=self.video_tabs.c_tab_ix, pool=self.video_pool,
+                                        cache=self.frame_cache, open_video=open_video)
         self.video_reader.frames_ready.connect(self.new_frames)
+        self.video_tabs.camera_changed.connect(self.video_reader.set_visible)
+        self.video_tabs.grid_changed.connect(self.set_grid)
         self.video_reader.c_frame = 1
         self.player.play.connect(self.video_reader.start)
         self.player.stop.connect(self.video_reader.stop)
@@ -87,9 +129,15 @@ class UI(QtWidgets.QMainWindow):
 
         # Internal data
         self._vb: Optional[crud.VideoBase] = None
-        self._order: Optional[np.ndarray] = None
+        self._order: Optional[SegmentOrder] = None
         self._c_seg_ix = 0
         self._c_seg: Optional[crud.Segment] = None
+        self.journal: Optional[AnnotationJournal] = None
+        # Set instead of the journal when the VideoBase is a database
+        self.db: Optional[VideoBaseDB] = None
+        self.label_index: Optional[crud.LabelIndex] = None
+        self.writer = SnapshotWriter()
+        self.snapshot_written.connect(self.show_save_stats)
         # Open main window
         self.show()
 
@@ -101,12 +149,51 @@ class UI(QtWidgets.QMainWindow):
 
     def closeEvent(self, event: QtGui.QCloseEvent) -> None:
         self.auto_save_annotations()
+        self.save_order_state()
         self.auto_save_labels()
+        self.writer.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.db is not None:
+            self.db.close()
         self.video_reader.close_all_videos()
+        self.video_pool.close()
+        print(f'Frame cache: {self.frame_cache.hits} hits, {self.frame_cache.misses} misses')
         print('Closing everything')
         event.accept()
         super().closeEvent(event)
 
+    def resizeEvent(self, event: QtGui.QResizeEvent):
+        super().resizeEvent(event)
+        if self._c_seg is not None:
+            self.update_formats()
+
+    @Slot(bool)
+    def set_grid(self, is_grid: bool):
+        "Decode all cameras, composed in a single image, or only the displayed one."
+        if self._c_seg is not None:
+            self.update_formats()
+        if is_grid:
+            self.video_reader.visible = None
+
+    def update_formats(self):
+        "Decode the frames at the size of the display, or of the cells of the grid."
+        if self.video_tabs.is_grid:
+            size = self.video_tabs.display_size()
+            mosaic = Mosaic(size.width(), size.height(), len(self.c_seg.files), self.pix_fmt)
+            self.video_reader.mosaic = mosaic
+            self.prefetcher.fmt = mosaic.cell_format()
+            self.video_reader.formats = [mosaic.cell_format()] * len(self.c_seg.files)
+            return
+        self.video_reader.mosaic = None
+        if self.full_resolution:
+            fmt = FULL._replace(pix_fmt=self.pix_fmt)
+        else:
+            size = self.video_tabs.display_size()
+            fmt = FrameFormat(size.width(), size.height(), self.pix_fmt)
+        self.prefetcher.fmt = fmt
+        self.video_reader.formats = [fmt] * len(self.c_seg.files)
+
     @property
     def c_seg(self):
         return self._c_seg
@@ -130,8 +217,12 @@ class UI(QtWidgets.QMainWindow):
         if value >= len(self._vb.segments):
             return
         self._c_seg_ix = value
+        # Segments already shown keep their place when going back
+        self._order.position = max(self._order.position, value)
         self.c_seg = self._vb.segments[self._order[value]]
-        self.auto_save_annotations()
+        if self.journal is not None and self.journal.n_events >= self.compact_every:
+            self.auto_save_annotations()
+            self.save_order_state()
         # self._vb
         self.show_annotations()
         self.display_segment()
@@ -144,11 +235,7 @@ class UI(QtWidgets.QMainWindow):
         for an in self.c_seg.annotations:
             if an.user != self.user_le.text():
                 continue
-            for lbl in an.labels:
-                r = crud.find_label_category(self.categories, lbl)
-                if r is None:
-                    continue
-                self.panel.check_label(r[1].name, lbl)
+            self.panel.check_labels(an.labels)
         self.panel.blockSignals(False)
 
     @Slot()
@@ -163,7 +250,14 @@ class UI(QtWidgets.QMainWindow):
         else:
             # Renaming a label
             self.categories, self._vb = crud.rename_label(self.categories, self._vb,
-                                                          old_label, new_label)
+                                                          old_label, new_label,
+                                                          self.label_index)
+            if self.db is not None:
+                self.db.relabel({old_label: new_label})
+            if self._order is not None:
+                self._order.update()
+            # Renaming is not journaled
+            self.auto_save_annotations()
         self.auto_save_labels()
         new_panel = ctrl.LabelPanel(self.categories)
         new_panel.new_state.connect(self.new_annotation)
@@ -172,15 +266,21 @@ class UI(QtWidgets.QMainWindow):
         self.panel = new_panel
 
     @Slot(str, dict)
-    def new_annotation(self, category: str, state: dict):
+    def new_annotation(self, category: str, changed: dict):
         if self.c_seg is None:
             return
-        for label, checked in state.items():
+        row = self._order[self._c_seg_ix]
+        for label, checked in changed.items():
             if not checked:
-                self.c_seg = crud.remove_annotation(self.c_seg, self.user_le.text(), label)
+                self.c_seg = crud.remove_annotation(self.c_seg, self.user_le.text(), label,
+                                                    self.label_index, row)
             else:
                 self.c_seg = crud.create_annotation(self.c_seg, self.user_le.text(),
-                                                    self._now, label)
+                                                    self._now, label, self.label_index, row)
+            store = self.journal if self.db is None else self.db
+            store.record(self.c_seg.uid, self.user_le.text(), self._now, label,
+                         ADD if checked else REMOVE)
+        self._order.update([row])
 
     @Slot()
     def new_frames(self):
@@ -190,17 +290,73 @@ class UI(QtWidgets.QMainWindow):
             return
         self.queue.put(frames)
         self.frames_ready.emit()
+        self.stats.c_fps_lbl.setText(f'{self.video_reader.achieved_fps:.1f} / '
+                                     f'{self.video_reader.requested_fps:.1f}')
+        self.stats.c_dropped_lbl.setText(f'{self.video_reader.n_dropped} / '
+                                         f'{self.video_reader.n_late}')
+        self.stats.c_paint_lbl.setText(f'{self.video_tabs.paint_ms:.1f} ms')
 
     @Slot(str)
     def open_file(self, new_path):
-        self._vb = crud.load_videobase(new_path)
+        self.save_order_state()
+        if self.journal is not None:
+            self.auto_save_annotations()
+            self.writer.flush()
+            self.journal.close()
+            self.journal = None
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        if is_database(new_path):
+            # Changes are written to the database as they are made, no journal or snapshot
+            self.db = VideoBaseDB(new_path)
+            self._vb = self.db.load()
+        elif self.compact:
+            self._vb = CompactVideoBase.load(new_path)
+        else:
+            self._vb = crud.load_videobase(new_path)
+        replayed = None
+        if self.db is None:
+            # Recover the annotations of a session that did not close properly
+            prev_journal = journal_path(new_path)
+            if prev_journal.exists():
+                n_events = replay(self._vb, read_journal(prev_journal))
+                print(f'Replayed {n_events} annotation events from {prev_journal}')
+                replayed = prev_journal
+        if isinstance(self._vb, CompactVideoBase):
+            self.label_index = self._vb.label_index()
+        else:
+            self.label_index = crud.LabelIndex(self._vb)
         self.c_path = new_path
-        labels_ticked_all = self.get_labels_ticked()
-        # For random permutations, remove the labels_ticked_all argument
-        self._order, n_total, n_labeled = crud.create_order(self._vb, labels_ticked_all)
+        if self.db is None:
+            self.journal = AnnotationJournal(journal_path(self.snapshot_path))
+            retire = None
+            if replayed is not None and replayed != self.journal.path:
+                # Its events are in the first snapshot of the session, not replayed again.
+                # The journal of a snapshot of this session is trimmed as usual instead.
+                retire = partial(retire_journal, replayed)
+            self.auto_save_annotations(retire)
+        labels_ticked = [label for _, label in self.get_labels_ticked()]
+        state = load_order_state(new_path) if self.resume else None
+        if state is not None:
+            self.order_name = state.strategy
+        seed = self.seed if state is None else state.seed
+        self._order = build_order(self.order_name, self._vb, self.label_index, self.user_le.text(),
+                                  labels_ticked, seed)
+        if self.order_name == DEFAULT and len(labels_ticked) > 0:
+            n_labeled = self.label_index.label_in_segments(labels_ticked).sum()
+        else:
+            n_labeled = self.label_index.has_annotations().sum()
         self.stats.c_labeled_lbl.setText(f'{n_labeled}')
-        self.stats.c_total_lbl.setText(f'{n_total}')
-        self.seg_ix = 0
+        self.stats.c_total_lbl.setText(f'{len(self._order)}')
+        start = 0
+        if state is not None and state.n_segments == len(self._order) and state.shown:
+            self._order.restore(state.shown)
+            start = min(state.current, len(state.shown) - 1)
+        elif state is not None:
+            print(f'{order_state_path(new_path)} does not match the VideoBase, starting over')
+        self.seg_ix = start
+        self.save_order_state()
    
     def get_labels_states(self):
         """Return a dictionary containing the states of each categories' labels."""
@@ -218,18 +374,49 @@ class UI(QtWidgets.QMainWindow):
                     labels_ticked_all.append([category, label])
         return labels_ticked_all
 
-    def auto_save_annotations(self):
-        if self.c_path is None:
-            return
+    @property
+    def snapshot_path(self) -> Path:
         orig_path = Path(self.c_path)
-        json_path = orig_path.parent / f'{orig_path.stem}_{self._now}.json'
-        with open(json_path, 'w') as jf:
-            jf.write(self._vb.json(indent=2))
+        return orig_path.parent / f'{orig_path.stem}_{self._now}.json'
+
+    def auto_save_annotations(self, then: Optional[Callable[[], None]] = None):
+        """
+        Write the full VideoBase snapshot in the background, then trim the journal and call
+        then (from the writing thread).
+        """
+        if self.journal is None:
+            # Nothing opened, or a database already up to date
+            return
+        trim_journal = self.journal.compaction()
+
+        def on_written():
+            trim_journal()
+            if then is not None:
+                then()
+            self.snapshot_written.emit()
+
+        self.writer.submit(self.snapshot_path, crud.videobase_snapshot(self._vb), on_written)
+
+    @Slot()
+    def show_save_stats(self):
+        written = self.writer.written.get(self.snapshot_path)
+        if written is not None:
+            latency, n_bytes = written
+            self.stats.c_save_lbl.setText(f'{latency * 1000:.0f} ms, {n_bytes / 1024:.0f} kB')
+
+    def save_order_state(self):
+        "Written when the order is built, with the snapshots and when closing."
+        if self._order is None or self.c_seg is None:
+            return
+        state = OrderState(seed=self._order.seed, strategy=self.order_name,
+                           shown=self._order.shown.tolist(), current=self._c_seg_ix,
+                           n_segments=len(self._order))
+        self.writer.submit(order_state_path(self.c_path), state.json())
 
     def auto_save_labels(self):
         json_path = Path(self.json_path).absolute()
-        with json_path.open('w') as jf:
-            jf.write(crud.AllGroups(groups=self.categories).json(indent=2))
+        groups = self.categories.to_groups()
+        self.writer.submit(json_path, groups.json(indent=2))
 
     @Slot()
     def prev_seg(self):
@@ -246,19 +433,43 @@ class UI(QtWidgets.QMainWindow):
         self.video_reader.begin = begin
         self.video_reader.end = end
         self.video_reader.c_frame = begin
+        self.update_formats()
         self.video_reader.video_files = self.c_seg.files
-        self.video_reader.end = self.video_reader.n_frames
+        if self.long_files:
+            self.video_reader.end = min(end, self.video_reader.n_frames)
+        else:
+            # Pre-cut clips are played entirely
+            self.video_reader.end = self.video_reader.n_frames
         self.video_reader.start()
+        self.prefetcher.update(self._vb, self._order, self._c_seg_ix)
 
 
 if __name__ == '__main__':
     qApp = QtWidgets.QApplication(sys.argv)
-    
-    #  Could write a clean argument parser
-    if len(sys.argv) >= 2:
-        json_path = sys.argv[1]
-    else:
-        json_path = "labels.json"
 
-    w = UI(json_path=json_path)
+    parser = argparse.ArgumentParser(description='Annotate multi-camera video segments.')
+    parser.add_argument('json_path', nargs='?', default='labels.json',
+                        help='Labels file')
+    parser.add_argument('--long-files', action='store_true',
+                        help='Segments are frame ranges of long recordings')
+    parser.add_argument('--compact', action='store_true',
+                        help='Keep the VideoBase in compact arrays (large bases)')
+    parser.add_argument('--order', choices=STRATEGIES, default=DEFAULT,
+                        help='Order of the segments (default: ticked labels first, or '
+                             'unlabelled first if none is ticked)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the random order, drawn at random by default')
+    parser.add_argument('--resume', action='store_true',
+                        help='Same order as last time, starting from the last segment seen')
+    parser.add_argument('--full-resolution', action='store_true',
+                        help='Decode the frames at full resolution, instead of the display size')
+    parser.add_argument('--pix-fmt', choices=PIX_FMTS, default='rgb24',
+                        help='Pixel format of the decoded frames (gray is cheaper)')
+    parser.add_argument('--decoder', choices=BACKENDS, default='pyav',
+                        help='Video decoder (ignored with --long-files, which uses indexed)')
+    args = parser.parse_args(qApp.arguments()[1:])
+
+    w = UI(json_path=args.json_path, long_files=args.long_files, compact=args.compact,
+           order=args.order, seed=args.seed, resume=args.resume,
+           full_resolution=args.full_resolution, pix_fmt=args.pix_fmt, decoder=args.decoder)
     sys.exit(qApp.exec_())
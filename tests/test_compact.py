@@ -0,0 +1,21 @@
+from benchmarks.synthetic import make_videobase
+from core import crud
+from core.compact import CompactVideoBase, PackedStrings
+
+
+def test_packed_strings_find():
+    strings = ['b', 'é', 'a', '', 'ab', 'b', 'z\U0001F42D', 'a\x7f']
+    packed = PackedStrings(strings)
+    for string in set(strings):
+        assert packed.find(string) == strings.index(string)
+    for missing in ('c', 'aa', 'é\x00', 'zz'):
+        assert packed.find(missing) is None
+    assert PackedStrings([]).find('a') is None
+
+
+def test_find_segment():
+    vb = crud.videobase_from_dict(make_videobase(100))
+    compact = CompactVideoBase.from_videobase(vb)
+    for row in (0, 42, 99):
+        assert compact.find_segment(vb.segments[row].uid).dict() == vb.segments[row].dict()
+    assert compact.find_segment('unknown') is None
@@ -0,0 +1,41 @@
+import pytest
+from benchmarks.synthetic import LABELS, make_videobase
+from core import crud
+from core.db import VideoBaseDB
+from core.models import Category
+
+MAPPINGS = [
+    {'Rearing_L': 'Rearing_R', 'Rearing_R': 'Rearing_L'},
+    {'Head_grooming_L': 'Head_grooming_R', 'Head_grooming_R': 'Body_grooming_L'},
+    {'Rearing_L': 'Rearing_R', 'Paw_licking': None},
+]
+
+
+def label_sets(vb):
+    return [[(an.user, an.date, sorted(an.labels)) for an in seg.annotations]
+            for seg in vb.segments]
+
+
+@pytest.mark.parametrize('mapping', MAPPINGS)
+def test_relabel_matches_crud(tmp_path, mapping):
+    vb = crud.videobase_from_dict(make_videobase(200))
+    db = VideoBaseDB(tmp_path / 'vb.sqlite')
+    db.import_videobase(vb)
+    db_counts = db.relabel(mapping)
+    relabeled = db.load()
+    db.close()
+    categories = [Category(name='all', labels=list(LABELS))]
+    counts = crud.relabel(categories, vb, mapping)
+    assert db_counts == counts
+    assert label_sets(relabeled) == label_sets(vb)
+
+
+def test_relabel_after_failed_relabel(tmp_path):
+    db = VideoBaseDB(tmp_path / 'vb.sqlite')
+    db.import_videobase(crud.videobase_from_dict(make_videobase(20)))
+    # Temporary table left by a relabel interrupted on this connection
+    db._con.execute('CREATE TEMP TABLE relabel_map (old TEXT PRIMARY KEY, new TEXT)')
+    counts = db.relabel({'Rearing_L': 'Rearing_R'})
+    assert counts['Rearing_L'] > 0
+    assert not db.label_in_segments('Rearing_L').any()
+    db.close()
@@ -0,0 +1,25 @@
+import pytest
+from benchmarks.synthetic import make_videobase
+from core import crud
+from core.label_index import LabelIndex
+
+
+def test_updates_by_row_with_duplicate_uids():
+    data = make_videobase(3, n_cameras=1)
+    for seg in data['segments']:
+        seg['uid'] = 'same'
+        seg['annotations'] = []
+    vb = crud.videobase_from_dict(data)
+    index = LabelIndex(vb)
+    crud.create_annotation(vb.segments[0], 'alice', 'd0', 'A', index, 0)
+    crud.create_annotation(vb.segments[1], 'alice', 'd0', 'B', index, 1)
+    crud.remove_annotation(vb.segments[1], 'alice', 'B', index, 1)
+    assert index.label_in_segments('A').tolist() == [True, False, False]
+    assert index.label_in_segments('B').tolist() == [False, False, False]
+    assert index.has_annotations().tolist() == [True, True, False]
+
+
+def test_row_required_with_index():
+    vb = crud.videobase_from_dict(make_videobase(2))
+    with pytest.raises(ValueError):
+        crud.create_annotation(vb.segments[0], 'alice', 'd0', 'A', LabelIndex(vb))
@@ -0,0 +1,103 @@
+import pytest
+from benchmarks.synthetic import make_videobase
+from core import crud
+from core.merge import FIRST, LATEST, UNION, SnapshotMerger
+from core.stream import VideoBaseStream, VideoBaseWriter
+
+
+def snapshot(annotations, uids=('s0', 's1')):
+    "VideoBase with the same segments, and annotations {uid: [(user, date, labels)]}."
+    data = make_videobase(len(uids), n_cameras=1)
+    for seg, uid in zip(data['segments'], uids):
+        seg['uid'] = uid
+        seg['annotations'] = [dict(user=user, date=date, labels=list(labels))
+                              for user, date, labels in annotations.get(uid, [])]
+    return crud.videobase_from_dict(data)
+
+
+def merged_labels(merger):
+    return {seg.uid: {(an.user, an.date): an.labels for an in seg.annotations}
+            for seg in merger.result().segments}
+
+
+@pytest.mark.parametrize('on_conflict, expected', [
+    (LATEST, ['B', 'C']),
+    (FIRST, ['A', 'B']),
+    (UNION, ['A', 'B', 'C']),
+])
+def test_conflicts(on_conflict, expected):
+    merger = SnapshotMerger(on_conflict)
+    merger.add(snapshot({'s0': [('alice', 'd0', ['A', 'B'])]}), 'first.json')
+    merger.add(snapshot({'s0': [('alice', 'd0', ['B', 'C'])]}), 'second.json')
+    assert merged_labels(merger)['s0'][('alice', 'd0')] == expected
+    assert len(merger.conflicts) == 1
+    conflict = merger.conflicts[0]
+    assert (conflict.uid, conflict.user, conflict.date) == ('s0', 'alice', 'd0')
+    # Labels before the resolution
+    assert conflict.merged == ['A', 'B']
+    assert conflict.other == ['B', 'C']
+    assert conflict.source == 'second.json'
+
+
+def test_same_labels_in_another_order_are_not_a_conflict():
+    merger = SnapshotMerger()
+    merger.add(snapshot({'s0': [('alice', 'd0', ['A', 'B'])]}))
+    merger.add(snapshot({'s0': [('alice', 'd0', ['B', 'A'])]}))
+    assert merger.conflicts == []
+    assert merged_labels(merger)['s0'][('alice', 'd0')] == ['A', 'B']
+
+
+def test_annotations_and_segments_are_added():
+    merger = SnapshotMerger()
+    merger.add(snapshot({'s0': [('alice', 'd0', ['A'])]}))
+    merger.add(snapshot({'s0': [('bob', 'd0', ['B'])], 's1': [('alice', 'd1', ['C'])]}))
+    merger.add(snapshot({'s2': [('carol', 'd2', ['D'])]}, uids=('s2',)))
+    assert merged_labels(merger) == {
+        's0': {('alice', 'd0'): ['A'], ('bob', 'd0'): ['B']},
+        's1': {('alice', 'd1'): ['C']},
+        's2': {('carol', 'd2'): ['D']},
+    }
+    assert merger.n_added == 2
+    assert merger.conflicts == []
+
+
+def test_three_snapshots_union():
+    merger = SnapshotMerger(UNION)
+    for labels in (['A'], ['B'], ['A', 'C']):
+        merger.add(snapshot({'s0': [('alice', 'd0', labels)]}))
+    assert merged_labels(merger)['s0'][('alice', 'd0')] == ['A', 'B', 'C']
+    assert [c.merged for c in merger.conflicts] == [['A'], ['A', 'B']]
+
+
+def test_mismatched_segments_keep_the_first():
+    first = snapshot({})
+    other = snapshot({'s0': [('alice', 'd0', ['A'])]})
+    other.segments[0].frames.end += 10
+    merger = SnapshotMerger()
+    merger.add(first)
+    merger.add(other)
+    assert merger.mismatches == ['s0']
+    assert merger.result().segments[0].frames == first.segments[0].frames
+
+
+def test_streamed_snapshots(tmp_path):
+    paths = []
+    for ix, labels in enumerate((['A'], ['B'])):
+        vb = snapshot({'s0': [('alice', 'd0', labels)], 's1': [(f'user{ix}', 'd', ['C'])]})
+        paths.append(tmp_path / f'snapshot{ix}.json')
+        with VideoBaseWriter(paths[-1], vb.notes) as writer:
+            writer.write_all(vb.segments)
+    merger = SnapshotMerger(FIRST)
+    for path in paths:
+        stream = VideoBaseStream(path)
+        merger.add_segments(stream, str(path), stream.notes)
+    assert merged_labels(merger) == {
+        's0': {('alice', 'd0'): ['A']},
+        's1': {('user0', 'd'): ['C'], ('user1', 'd'): ['C']},
+    }
+    assert merger.n_snapshots == 2
+
+
+def test_unknown_resolution():
+    with pytest.raises(ValueError):
+        SnapshotMerger('newest')
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic import make_videobase
+from core import crud
+from core.label_index import LabelIndex
+from core.ordering import DEFAULT, LEAST_ANNOTATED, RANDOM, BY_SESSION, build_order
+
+
+@pytest.mark.parametrize('name', [DEFAULT, LEAST_ANNOTATED, RANDOM, BY_SESSION])
+def test_restore_after_annotating(name):
+    vb = crud.videobase_from_dict(make_videobase(200))
+    index = LabelIndex(vb)
+    order = build_order(name, vb, index, user='alice', seed=3)
+    for pos in range(5):
+        order.position = pos
+        crud.create_annotation(vb.segments[order[pos]], 'alice', 'd0', 'Rearing_L', index,
+                               order[pos])
+        order.update([order[pos]])
+    shown = order.shown.tolist()
+    # Resumed with the annotations of the first session
+    resumed = build_order(name, vb, LabelIndex(vb), user='alice', seed=3)
+    resumed.restore(shown)
+    assert resumed.shown.tolist() == shown
+    assert sorted(resumed.order.tolist()) == list(range(len(vb.segments)))
+    assert np.array_equal(resumed.order[len(shown):], order.order[len(shown):])
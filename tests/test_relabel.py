@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from benchmarks.synthetic import LABELS, make_videobase
+from core import crud
+from core.compact import CompactVideoBase
+from core.label_index import LabelIndex
+from core.label_registry import LabelRegistry
+from core.models import Category
+
+
+def small_videobase():
+    data = make_videobase(3, n_cameras=1)
+    for seg, labels in zip(data['segments'], [['A', 'B'], ['B', 'C'], ['A', 'C', 'D']]):
+        seg['annotations'] = [dict(user='alice', date='d0', labels=labels)]
+    return crud.videobase_from_dict(data)
+
+
+def categories():
+    return [Category(name='first', labels=['A', 'B']), Category(name='second', labels=['C', 'D'])]
+
+
+def labels_of(vb):
+    return [seg.annotations[0].labels for seg in vb.segments]
+
+
+@pytest.mark.parametrize('mapping, expected, expected_cats', [
+    # Swap
+    ({'A': 'B', 'B': 'A'}, [['B', 'A'], ['A', 'C'], ['B', 'C', 'D']],
+     [['B', 'A'], ['C', 'D']]),
+    # Chain, each label moves by one
+    ({'A': 'B', 'B': 'C', 'C': 'D'}, [['B', 'C'], ['C', 'D'], ['B', 'D']],
+     [['B', 'C'], ['D']]),
+    # Delete
+    ({'B': None}, [['A'], ['C'], ['A', 'C', 'D']], [['A'], ['C', 'D']]),
+    # Merge, a single copy is kept
+    ({'A': 'C'}, [['C', 'B'], ['B', 'C'], ['C', 'D']], [['B'], ['C', 'D']]),
+])
+def test_relabel(mapping, expected, expected_cats):
+    vb = small_videobase()
+    cats = categories()
+    counts = crud.relabel(cats, vb, mapping)
+    assert labels_of(vb) == expected
+    assert [cat.labels for cat in cats] == expected_cats
+    n_with = {old: sum(old in labels for labels in labels_of(small_videobase()))
+              for old in mapping}
+    assert counts == n_with
+
+
+@pytest.mark.parametrize('mapping', [
+    {'Rearing_L': 'Rearing_R', 'Rearing_R': 'Rearing_L'},
+    {'Head_grooming_L': 'Head_grooming_R', 'Head_grooming_R': 'Body_grooming_L'},
+    {'Paw_licking': None, 'Head_scratch_L': 'Head_scratch_R'},
+    {'Rearing_L': 'Jumping'},
+])
+def test_relabel_keeps_index_and_registry(mapping):
+    vb = crud.videobase_from_dict(make_videobase(300))
+    index = LabelIndex(vb)
+    registry = LabelRegistry([Category(name='all', labels=list(LABELS))])
+    crud.relabel(registry, vb, mapping, index)
+    rebuilt = LabelIndex(vb)
+    for label in set(index.labels) | set(rebuilt.labels):
+        for user in [None] + rebuilt.users:
+            assert np.array_equal(index.label_in_segments(label, user),
+                                  rebuilt.label_in_segments(label, user)), (label, user)
+    for old, new in mapping.items():
+        # Swapped and chained labels are still there, under their new role
+        assert registry.has_label(old) == (old in mapping.values())
+        assert new is None or registry.has_label(new)
+
+
+@pytest.mark.parametrize('mapping', [
+    {'Rearing_L': 'Rearing_R', 'Rearing_R': 'Rearing_L'},
+    {'Head_grooming_L': 'Head_grooming_R', 'Head_grooming_R': 'Body_grooming_L'},
+    {'Paw_licking': None},
+])
+def test_relabel_compact(mapping):
+    # videobase_from_dict uses the dicts as is
+    vb = crud.videobase_from_dict(make_videobase(300))
+    compact = CompactVideoBase.from_videobase(crud.videobase_from_dict(make_videobase(300)))
+    counts = crud.relabel([Category(name='all', labels=list(LABELS))], vb, mapping)
+    compact_counts = crud.relabel([Category(name='all', labels=list(LABELS))], compact,
+                                  mapping)
+    assert compact_counts == counts
+    assert compact.dict() == vb.dict()
@@ -0,0 +1,47 @@
+import json
+import pytest
+from benchmarks.synthetic import make_videobase
+from core import crud
+from core.compact import CompactVideoBase
+from core.snapshot_writer import SnapshotWriter
+
+
+def annotate(vb):
+    "Changes made by the gui while a snapshot is being written."
+    for row in range(4):
+        seg = vb.segments[row]
+        crud.create_annotation(seg, 'alice', 'd0', 'A')
+        crud.create_annotation(seg, 'bob', 'd1', 'B')
+        if seg.annotations[0].labels:
+            crud.remove_annotation(seg, seg.annotations[0].user, seg.annotations[0].labels[0])
+    crud.relabel([], vb, {'Rearing_L': 'Rearing_R'})
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_snapshot_ignores_later_changes(compact):
+    vb = crud.videobase_from_dict(make_videobase(50))
+    if compact:
+        vb = CompactVideoBase.from_videobase(vb)
+        # Materialized, as shown by the gui
+        vb.segments[0]
+    expected = crud.videobase_to_json(vb)
+    serialize = crud.videobase_snapshot(vb)
+    annotate(vb)
+    assert crud.videobase_to_json(vb) != expected
+    assert serialize() == expected
+
+
+def test_writer_serializes_the_latest_snapshot(tmp_path):
+    vb = crud.videobase_from_dict(make_videobase(20))
+    path = tmp_path / 'vb.json'
+    writer = SnapshotWriter()
+    try:
+        writer.submit(path, crud.videobase_snapshot(vb))
+        annotate(vb)
+        writer.submit(path, crud.videobase_snapshot(vb))
+        writer.flush()
+    finally:
+        writer.close()
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f) == vb.dict()
+    assert writer.written[path][1] == path.stat().st_size
@@ -0,0 +1,72 @@
+import json
+import pytest
+from benchmarks.synthetic import make_videobase
+from core import crud
+from core.stream import VideoBaseStream, VideoBaseWriter
+
+
+def tricky_videobase() -> dict:
+    data = make_videobase(6, n_cameras=2)
+    data['segments'][0]['uid'] = 'quote " and backslash \\ and slash /'
+    data['segments'][1]['folder'] = 'café ☃ \U0001F42D'
+    data['segments'][2]['annotations'] = [dict(user='tab\tnew\nline', date='d',
+                                               labels=['{', '}', '[', ']', ',', ':'])]
+    data['segments'][3]['frames'] = dict(begin=123456789, end=1234567890)
+    data['notes'] = 'notes with "quotes", \\escapes\\ and é'
+    return data
+
+
+def dumps(data: dict, style: str) -> str:
+    if style == 'compact':
+        return json.dumps(data, separators=(',', ':'))
+    if style == 'indent':
+        return json.dumps(data, indent=2)
+    if style == 'ascii':
+        return json.dumps(data, indent='\t', ensure_ascii=True)
+    if style == 'spaces':
+        text = json.dumps(data, separators=(' ,\r\n ', ' :\t'))
+        return f' \n\t{text}\r\n '
+    # Notes before the segments
+    notes = json.dumps(data['notes'])
+    return f'{{"notes": {notes}, "segments": {json.dumps(data["segments"])}, "other": [1, 2.5]}}'
+
+
+def stream_dicts(path, chunk_size: int):
+    stream = VideoBaseStream(path, chunk_size=chunk_size)
+    return [seg.dict() for seg in stream], stream.notes
+
+
+@pytest.mark.parametrize('style', ['compact', 'indent', 'ascii', 'spaces', 'notes_first'])
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, 1 << 20])
+def test_stream_matches_json_load(tmp_path, style, chunk_size):
+    path = tmp_path / 'vb.json'
+    path.write_text(dumps(tricky_videobase(), style), encoding='utf-8')
+    with open(path, encoding='utf-8') as f:
+        expected = json.load(f)
+    segments, notes = stream_dicts(path, chunk_size)
+    assert segments == [crud.segment_from_dict(seg).dict() for seg in expected['segments']]
+    assert notes == expected['notes']
+
+
+@pytest.mark.parametrize('text', ['{"segments": [], "notes": null}', '{}', ' { "segments" : [ ] } '])
+def test_stream_empty(tmp_path, text):
+    path = tmp_path / 'vb.json'
+    path.write_text(text)
+    assert stream_dicts(path, 3) == ([], None)
+
+
+def test_stream_truncated(tmp_path):
+    path = tmp_path / 'vb.json'
+    path.write_text(json.dumps(tricky_videobase())[:-40])
+    with pytest.raises(ValueError):
+        stream_dicts(path, 16)
+
+
+def test_writer_round_trip(tmp_path):
+    vb = crud.videobase_from_dict(tricky_videobase())
+    path = tmp_path / 'vb.json'
+    with VideoBaseWriter(path, vb.notes) as writer:
+        writer.write_all(vb.segments)
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f) == vb.dict()
+    assert stream_dicts(path, 5) == ([seg.dict() for seg in vb.segments], vb.notes)